@@ -3,6 +3,7 @@ from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 
 import cost_claimer.routing
 import cost_claimer.consumers
+from cost_claimer.shards import worker_channels
 
 application = ProtocolTypeRouter({
     'websocket': AuthMiddlewareStack(
@@ -11,6 +12,6 @@ application = ProtocolTypeRouter({
         )
     ),
     "channel": ChannelNameRouter({
-        "user_action": cost_claimer.consumers.GroupCostWorker,
+        channel: cost_claimer.consumers.GroupCostWorker for channel in worker_channels()
     }),
 })
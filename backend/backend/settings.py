@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -84,16 +85,78 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Worker processes that share the user_action messages, each reading its own user_action.<k> channel.
+# The server and the workers have to be started with the same COST_CLAIMER_WORKER_SHARDS.
+WORKER_SHARDS = int(os.environ.get('COST_CLAIMER_WORKER_SHARDS', 1))
+
+
+# Cache
+# Responses are cached in the same Redis that the channel layer uses, in a separate database.
+# COST_CLAIMER_CACHE=locmem caches them in each process's memory instead. Tests and benchmarks make throwaway
+# databases, so they always get a local memory cache (see backend/test_runner.py).
+
+TEST_RUNNER = 'backend.test_runner.TestRunner'
+
+if os.environ.get('COST_CLAIMER_CACHE') == 'locmem':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': 'redis://127.0.0.1:6379/1',
+            'KEY_PREFIX': 'cost_claimer',
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                # If Redis goes away, act like everything is a cache miss instead of failing requests.
+                'IGNORE_EXCEPTIONS': True,
+            },
+        },
+    }
+
+# Lobby store
+# Review lobbies are kept in another database of the same Redis, so every worker process sees them.
+# COST_CLAIMER_LOBBY_STORE=memory keeps them in the worker's memory instead, which only works with one worker.
+# Tests and benchmarks always keep them in memory (see backend/test_runner.py).
+
+if os.environ.get('COST_CLAIMER_LOBBY_STORE') == 'memory':
+    LOBBY_STORE_URL = None
+else:
+    LOBBY_STORE_URL = 'redis://127.0.0.1:6379/2'
 
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default, set up for the server and worker writing at the same time in cost_claimer/database.py.
+# Set COST_CLAIMER_DATABASE=postgresql and the COST_CLAIMER_DB_* variables to use PostgreSQL (needs psycopg2).
+
+if os.environ.get('COST_CLAIMER_DATABASE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('COST_CLAIMER_DB_NAME', 'cost_claimer'),
+            'USER': os.environ.get('COST_CLAIMER_DB_USER', 'postgres'),
+            'PASSWORD': os.environ.get('COST_CLAIMER_DB_PASSWORD', ''),
+            'HOST': os.environ.get('COST_CLAIMER_DB_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('COST_CLAIMER_DB_PORT', '5432'),
+            # Keep connections open between requests instead of reconnecting for every one.
+            'CONN_MAX_AGE': 600,
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            # Django's SQLite backend, except transactions take the write lock when they start
+            'ENGINE': 'cost_claimer.sqlite',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Seconds to wait for the other process to finish writing before failing with "database is locked"
+                'timeout': 20,
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -135,6 +198,10 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATICFILES_DIRS = ['static/']
 
+# Item images uploaded by the receipt parser, and the resized copies made from them
+RECEIPT_IMAGE_DIR = BASE_DIR / 'static' / 'receipt_items'
+THUMBNAIL_CACHE_DIR = BASE_DIR / 'thumbnail_cache'
+
 
 # Additional Settings
 
@@ -0,0 +1,28 @@
+"""
+Settings for anything that runs against a throwaway database, so it never touches the cache or lobbies of the real
+one.
+The test runner applies them to every test, and the benchmark command to every suite.
+"""
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+ISOLATED_SETTINGS = {
+    'CACHES': {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    },
+    'LOBBY_STORE_URL': None,
+}
+
+
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.isolated_settings = override_settings(**ISOLATED_SETTINGS)
+        self.isolated_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.isolated_settings.disable()
+        super().teardown_test_environment(**kwargs)
@@ -4,3 +4,5 @@ from django.apps import AppConfig
 class CostClaimerConfig(AppConfig):
     name = 'cost_claimer'
 
+    def ready(self):
+        from . import database, signals  # noqa: F401
@@ -0,0 +1,545 @@
+"""
+Benchmarks for the receipt pipeline, run with `python manage.py benchmark`.
+Each suite is a function that takes the benchmark options and returns a list of result dicts.
+"""
+import json
+import logging
+import multiprocessing
+import random
+import re as regex
+import statistics
+import sys
+import threading
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from rest_framework.test import APIClient
+
+from . import database, ledger, shards
+from .models import Balance, CacheVersion, Cover, Item, Payment, Receipt, User
+from .review_lobby import GroupLobbyOrganizer, recalculate_receipt
+from .scheduler import Scheduler
+from .shards import HashRing
+
+sys.path.append(str(settings.BASE_DIR.parent / "receipt_parser"))
+import ReceiptParser  # noqa: E402
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+suites = {}
+
+
+def suite(func):
+    suites[func.__name__] = func
+    return func
+
+
+def time_call(func, repeat):
+    """
+    Returns timing stats in seconds for calling func repeat times.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "max": max(timings),
+        "repeat": repeat,
+    }
+
+
+def synthetic_receipt_html(item_count, distinct_items=None):
+    """
+    Builds a page shaped like a saved Walmart receipt, which is what parse_receipt navigates.
+    Items repeat after distinct_items so the parser has duplicates to count.
+    Prices are kept to a few cents since receipt totals have to fit in 5 digits.
+    """
+    distinct_items = distinct_items or max(1, item_count // 2)
+    subtotal = Decimal("0.00")
+    items = []
+    for index in range(item_count):
+        product = index % distinct_items
+        price = Decimal(1 + product % 8) / 100
+        subtotal += price
+        items.append(
+            '<li><div><div><img src="https://i5.walmartimages.com/asr/item{0}.jpeg" alt="Product {0}"/>'
+            '<div><div><span>${1}</span></div></div></div></div></li>'.format(product, price)
+        )
+    tax = (subtotal * Decimal("0.08")).quantize(Decimal("0.01"))
+    # No whitespace between tags since the parser walks siblings directly.
+    return (
+        '<html><body><ul class="results-list"><div>{}</div></ul>'
+        '<div class="receipt-summary-v2"><div><div>'
+        '<table><tbody><tr><td>Subtotal</td><td>${}</td></tr><tr><td>Tax</td><td>${}</td></tr></tbody></table>'
+        '<table><tr><td>Total</td><td><h2>${}</h2></td></tr></table>'
+        '</div></div></div></body></html>'
+    ).format("".join(items), subtotal, tax, subtotal + tax)
+
+
+def receipt_payload(receipt):
+    return {
+        "payer": receipt.payer,
+        "date": receipt.date,
+        "subtotal": receipt.subtotal,
+        "tax": receipt.tax,
+        "total": receipt.total,
+        "tax_rate": receipt.taxRate,
+        "items": [{
+            "name": item.name,
+            "count": item.count,
+            "price": item.price,
+            "imgSrc": item.imgSrc,
+            "taxed": index % 3 == 0,
+        } for index, item in enumerate(receipt.items.values())],
+    }
+
+
+def benchmark_date(index):
+    return str(date(2000, 1, 1) + timedelta(days=index))
+
+
+@suite
+def ingest(options):
+    """
+    Parsing saved pages, aggregating items and uploading them through both upload endpoints.
+    """
+    payer, _ = User.objects.get_or_create(buy_index=1, defaults={"name": "Benchmark", "username": "benchmark"})
+    client = APIClient()
+    results = []
+    uploads = 0
+    for size in options["sizes"]:
+        html = synthetic_receipt_html(size)
+        parsed = ReceiptParser.build_receipt(html, benchmark_date(0), payer.buy_index)
+        results.append({
+            "name": "parse",
+            "items": size,
+            **time_call(lambda: ReceiptParser.build_receipt(html, benchmark_date(0), payer.buy_index),
+                        options["repeat"]),
+        })
+
+        lines = [(item.name, item.price, item.imgSrc) for item in parsed.items.values()]
+        lines = [lines[index % len(lines)] for index in range(size)]
+
+        def aggregate():
+            receipt = ReceiptParser.Receipt(payer.buy_index, benchmark_date(0))
+            for name, price, imgSrc in lines:
+                receipt.add_item(name, price, imgSrc)
+
+        results.append({"name": "aggregate", "items": size, **time_call(aggregate, options["repeat"])})
+
+        payload = receipt_payload(parsed)
+
+        def upload_bulk():
+            nonlocal uploads
+            uploads += 1
+            response = client.post("/cost_claimer/upload/receipt_items/",
+                                   {**payload, "date": benchmark_date(uploads)}, format="json")
+            assert response.status_code == 200, response.data
+
+        results.append({"name": "upload_bulk", "items": size, **time_call(upload_bulk, options["repeat"])})
+
+        def upload_two_calls():
+            nonlocal uploads
+            uploads += 1
+            receipt_date = benchmark_date(uploads)
+            receipt = {key: value for key, value in payload.items() if key != "items"}
+            response = client.post("/cost_claimer/upload/receipt/", {**receipt, "date": receipt_date})
+            assert response.status_code == 200, response.data
+            response = client.post("/cost_claimer/upload/items/",
+                                   {"date": receipt_date, "items": json.dumps(payload["items"])})
+            assert response.status_code == 200, response.data
+
+        results.append({"name": "upload_two_calls", "items": size, **time_call(upload_two_calls, options["repeat"])})
+        Receipt.objects.all().delete()
+    clear_rows()
+    return results
+
+
+# Queries on the hot paths, as functions of a receipt date and a user that return the queryset to explain.
+HOT_QUERIES = {
+    "add_items_duplicate_check": lambda date, user: Item.objects.filter(name="Product 7", receipt=date),
+    "upload_known_names": lambda date, user: Item.objects.filter(receipt=date).values_list("name", flat=True),
+    "receipt_items": lambda date, user: Item.objects.filter(receipt=date),
+    "recalculate_bought_items": lambda date, user: Item.objects.filter(receipt=date).exclude(buyers=0),
+    "recalculate_cover": lambda date, user: Cover.objects.filter(transaction=date, user=user)[:1],
+    "balance_covered": lambda date, user: Cover.objects.filter(transaction_payer=user).values_list("user", "amount"),
+    "balance_covered_by": lambda date, user: Cover.objects.filter(user=user).values_list("transaction_payer",
+                                                                                          "amount"),
+    "balance_paid": lambda date, user: Payment.objects.filter(transaction_payer=user).values_list("user", "amount"),
+    "balance_paid_by": lambda date, user: Payment.objects.filter(user=user).values_list("transaction_payer",
+                                                                                         "amount"),
+    "balances": lambda date, user: Balance.objects.filter(Q(user_a=user) | Q(user_b=user)).values_list(
+        "user_a", "user_b", "cents"),
+    "login": lambda date, user: User.objects.filter(username="user7", password="password"),
+}
+
+# Matches plan lines that read a whole table or index, like "SCAN cost_claimer_item".
+# Sorting with "USE TEMP B-TREE" doesn't count.
+FULL_SCAN = regex.compile(r"\bSCAN\b(?! CONSTANT ROW)")
+
+
+def seed_rows(rows, users=100, receipts=None):
+    """
+    Fills the database with about rows items and payments and a cover for every user on every receipt.
+    Items are spread over the given number of receipts, rows / users by default. Returns the receipts and users.
+    Bulk creates skip the signals, so nothing is cached or recalculated along the way. The ledger is rebuilt at the end.
+    """
+    receipts = receipts or max(1, rows // users)
+    items_per_receipt = max(1, rows // receipts)
+    people = User.objects.bulk_create([
+        User(buy_index=index + 1, bit=index, name="User {}".format(index), username="user{}".format(index),
+             password="password")
+        for index in range(users)
+    ])
+    receipts = Receipt.objects.bulk_create([
+        Receipt(date=benchmark_date(index), subtotal=1, tax=0, total=1, tax_rate=0, payer=people[index % users])
+        for index in range(receipts)
+    ])
+    Item.objects.bulk_create((
+        Item(receipt=receipt, name="Product {}".format(index), count=1, price=Decimal("0.01"), imgSrc="",
+             buyers=(1 << index % users) if index % 3 else 0)
+        for receipt in receipts for index in range(items_per_receipt)
+    ), batch_size=1000)
+    Cover.objects.bulk_create((
+        Cover(transaction=receipt, transaction_payer=receipt.payer, user=user, amount=Decimal("0.01"))
+        for receipt in receipts for user in people
+    ), batch_size=1000)
+    Payment.objects.bulk_create((
+        Payment(transaction=None, transaction_payer=people[index % users], user=people[index * 7 % users],
+                amount=Decimal("0.01"))
+        for index in range(rows)
+    ), batch_size=1000)
+    ledger.rebuild_ledger()
+    return receipts, people
+
+
+def clear_rows():
+    # Deleting through the ORM would send a signal per row.
+    with connection.cursor() as cursor:
+        for model in (Balance, Payment, Cover, Item, Receipt, User, CacheVersion):
+            cursor.execute("DELETE FROM {}".format(connection.ops.quote_name(model._meta.db_table)))
+
+
+@suite
+def query_plans(options):
+    """
+    Explains every hot query against a database with each size worth of rows and flags full table scans.
+    Needs SQLite, since the plans come from EXPLAIN QUERY PLAN.
+    """
+    if connection.vendor != "sqlite":
+        return [{"name": "query_plans", "skipped": "EXPLAIN QUERY PLAN needs SQLite, not {}".format(connection.vendor)}]
+    results = []
+    for size in options["sizes"]:
+        receipts, people = seed_rows(size)
+        # Give the planner real statistics, like a database that has been in use.
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        receipt_date, user = receipts[len(receipts) // 2].date, people[7]
+        for name, make_query in HOT_QUERIES.items():
+            plan = make_query(receipt_date, user).explain().splitlines()
+            results.append({
+                "name": name,
+                "rows": size,
+                "plan": plan,
+                "full_scan": any(FULL_SCAN.search(line) for line in plan),
+                **time_call(lambda: list(make_query(receipt_date, user)), options["repeat"]),
+            })
+        clear_rows()
+    return results
+
+
+# The SQLite setup from before WAL and retries, and the current one: (pragmas, BEGIN statement, busy timeout, retries)
+CONCURRENCY_MODES = {
+    "rollback_journal": ({"journal_mode": "DELETE", "synchronous": "FULL"}, "BEGIN", 5, 0),
+    "wal_immediate_with_retries": (database.SQLITE_PRAGMAS, database.SQLITE_BEGIN, 20, database.LOCK_RETRIES),
+}
+UPLOADS_PER_THREAD = 10
+UPLOAD_ITEMS = 20
+LOBBY_WRITES_PER_THREAD = 50
+# A lobby write recalculates its receipt this often, like the end of a review would.
+RECALCULATE_EVERY = 10
+
+
+def upload_worker(thread_index, start, failures):
+    client = APIClient()
+    start.wait()
+    try:
+        for upload in range(UPLOADS_PER_THREAD):
+            try:
+                response = client.post("/cost_claimer/upload/receipt_items/", {
+                    "date": benchmark_date(20000 + thread_index * UPLOADS_PER_THREAD + upload),
+                    "payer": 1, "subtotal": "1.00", "tax": "0.00", "total": "1.00", "tax_rate": "0.0000",
+                    "items": [{"name": "Upload {}".format(index), "count": 1, "price": "0.01", "imgSrc": "",
+                               "taxed": False} for index in range(UPLOAD_ITEMS)],
+                }, format="json")
+                if response.status_code != 200:
+                    failures.append(response.status_code)
+            except Exception as error:
+                failures.append(repr(error))
+    finally:
+        connection.close()
+
+
+def lobby_worker(receipt_date, user_ids, start, failures):
+    receipt = Receipt.objects.get(date=receipt_date)
+    lobby = GroupLobbyOrganizer.Lobby(InMemoryChannelLayer(), receipt)
+    lobby.load_review("benchmark")
+    # Covers are only written by the recalculations below.
+    lobby.running_shares = None
+    start.wait()
+    try:
+        for write in range(LOBBY_WRITES_PER_THREAD):
+            active_users = random.sample(user_ids, random.randint(1, len(user_ids)))
+            try:
+                lobby.update_item(write % len(lobby.items), active_users)
+                if write % RECALCULATE_EVERY == RECALCULATE_EVERY - 1:
+                    recalculate_receipt(receipt)
+            except Exception as error:
+                failures.append(repr(error))
+    finally:
+        connection.close()
+
+
+@suite
+def concurrency(options):
+    """
+    Receipt uploads (like the server) and lobby item and cover writes (like the worker) from several threads at once,
+    with the old SQLite setup and the current one. Sizes are the number of threads on each side.
+    """
+    if connection.vendor != "sqlite" or connection.is_in_memory_db():
+        return [{"name": "concurrency", "skipped": "Needs a SQLite database file"}]
+    settings_dict = connection.settings_dict
+    saved = (database.SQLITE_PRAGMAS, database.SQLITE_BEGIN, settings_dict["OPTIONS"].get("timeout"),
+             database.LOCK_RETRIES)
+    # Failed uploads are counted in the results, they don't need a traceback each in the output too.
+    request_logger = logging.getLogger("django.request")
+    saved_level = request_logger.level
+    request_logger.setLevel(logging.CRITICAL)
+    results = []
+    try:
+        for mode, (pragmas, begin, timeout, retries) in CONCURRENCY_MODES.items():
+            database.SQLITE_PRAGMAS, database.SQLITE_BEGIN, database.LOCK_RETRIES = pragmas, begin, retries
+            settings_dict["OPTIONS"]["timeout"] = timeout
+            for size in options["sizes"]:
+                # New connections pick up the mode's pragmas.
+                connection.close()
+                receipts, people = seed_rows(size * 20, users=8, receipts=size)
+                user_ids = [user.buy_index for user in people]
+                start = threading.Barrier(size * 2 + 1)
+                failures = []
+                stats = dict(database.lock_stats)
+                threads = [threading.Thread(target=upload_worker, args=(index, start, failures))
+                           for index in range(size)]
+                threads += [threading.Thread(target=lobby_worker, args=(receipt.date, user_ids, start, failures))
+                            for receipt in receipts]
+                for thread in threads:
+                    thread.start()
+                start.wait()
+                began = time.perf_counter()
+                for thread in threads:
+                    thread.join()
+                seconds = time.perf_counter() - began
+                results.append({
+                    "name": mode,
+                    "threads": size * 2,
+                    "seconds": seconds,
+                    "uploads_per_second": size * UPLOADS_PER_THREAD / seconds,
+                    "lobby_writes_per_second": size * LOBBY_WRITES_PER_THREAD / seconds,
+                    "failures": len(failures),
+                    "failure_examples": sorted(set(map(str, failures)))[:3],
+                    "retries": database.lock_stats["retries"] - stats.get("retries", 0),
+                })
+                clear_rows()
+    finally:
+        database.SQLITE_PRAGMAS, database.SQLITE_BEGIN, database.LOCK_RETRIES = saved[0], saved[1], saved[3]
+        settings_dict["OPTIONS"]["timeout"] = saved[2]
+        request_logger.setLevel(saved_level)
+        connection.close()
+    return results
+
+
+# Users in the settle_up suite's household
+SETTLE_UP_USERS = 300
+
+
+@suite
+def settle_up(options):
+    """
+    Rebuilding the ledger and working out the transfers that settle it, for SETTLE_UP_USERS users with about three
+    times each size worth of covers and payments between them. Settling up is timed with and without the cache.
+    """
+    generator = random.Random(19)
+    results = []
+    for size in options["sizes"]:
+        seed_rows(size, users=SETTLE_UP_USERS)
+        # Payments of random amounts, so that users' nets don't all cancel out neatly
+        Payment.objects.bulk_create((
+            Payment(transaction_payer_id=generator.randint(1, SETTLE_UP_USERS),
+                    user_id=generator.randint(1, SETTLE_UP_USERS), amount=Decimal(generator.randint(1, 99999)) / 100)
+            for _ in range(size)
+        ), batch_size=1000)
+        entries = Cover.objects.count() + Payment.objects.count()
+        info = {"users": SETTLE_UP_USERS, "entries": entries}
+        results.append({"name": "rebuild_ledger", **info, **time_call(ledger.rebuild_ledger, options["repeat"])})
+        nets = ledger.net_balances()
+        transfers = ledger.settle_up(nets)
+        results.append({"name": "settle_up", **info, "users_to_settle": len(nets), "transfers": len(transfers),
+                        **time_call(lambda: ledger.settle_up(ledger.net_balances()), options["repeat"])})
+        ledger.get_settle_up()
+        results.append({"name": "settle_up_cached", **info, **time_call(ledger.get_settle_up, options["repeat"])})
+        clear_rows()
+    return results
+
+
+# Ticks in each lobby_timers countdown, and seconds between them
+COUNTDOWN_TICKS = 5
+COUNTDOWN_INTERVAL = 0.2
+
+
+def run_countdowns(count, start_timer):
+    """
+    Runs count countdowns at once, each starting its next tick with start_timer(deadline, tick) when a tick runs.
+    Returns how late every tick ran in seconds and the most threads that were running at once.
+    """
+    lateness = []
+    peak_threads = [threading.active_count()]
+    done = threading.Semaphore(0)
+
+    def tick(deadline, ticks_left):
+        lateness.append(time.monotonic() - deadline)
+        peak_threads.append(threading.active_count())
+        if ticks_left:
+            start_timer(deadline + COUNTDOWN_INTERVAL, lambda: tick(deadline + COUNTDOWN_INTERVAL, ticks_left - 1))
+        else:
+            done.release()
+
+    for _ in range(count):
+        deadline = time.monotonic() + COUNTDOWN_INTERVAL
+        start_timer(deadline, lambda deadline=deadline: tick(deadline, COUNTDOWN_TICKS - 1))
+    for _ in range(count):
+        done.acquire()
+    return lateness, max(peak_threads)
+
+
+def start_thread_timer(deadline, func):
+    # The old way, a threading.Timer (so a new thread) for every tick
+    timer = threading.Timer(max(0, deadline - time.monotonic()), func)
+    timer.start()
+
+
+@suite
+def lobby_timers(options):
+    """
+    Lobby countdowns ticking at once, with a thread per tick and with one scheduler thread.
+    Sizes are the number of countdowns. Reports how late ticks ran and how many threads were running.
+    """
+    scheduler = Scheduler("benchmark-scheduler")
+    modes = {"thread_per_tick": start_thread_timer, "scheduler": scheduler.call_at}
+    results = []
+    for size in options["sizes"]:
+        for mode, start_timer in modes.items():
+            lateness, peak_threads = run_countdowns(size, start_timer)
+            lateness.sort()
+            results.append({
+                "name": mode,
+                "countdowns": size,
+                "median_lateness": statistics.median(lateness),
+                "p99_lateness": lateness[int(len(lateness) * 0.99)],
+                "max_lateness": lateness[-1],
+                "peak_threads": peak_threads,
+            })
+    return results
+
+
+# Sessions sending messages in the worker_shards suite, the actions they send in turn, and how many each sends
+SHARD_SESSIONS = 64
+SHARD_ACTIONS = [{"action": "view_balances"}, {"action": "settle_up"}]
+SHARD_MESSAGES_PER_SESSION = 50
+# More shards than this would just be measuring forking
+MAX_SHARDS = 32
+
+
+def session_events(index, user):
+    uuid = "benchmark-session-{}".format(index)
+    actions = [{"action": "login", "username": user.username, "password": user.password}]
+    actions += [SHARD_ACTIONS[message % len(SHARD_ACTIONS)] for message in range(SHARD_MESSAGES_PER_SESSION)]
+    return uuid, [{"type": "session_connect", "uuid": uuid}] + [
+        {"type": "session_action", "uuid": uuid, "text_data": action} for action in actions
+    ] + [{"type": "session_disconnect", "uuid": uuid}]
+
+
+def run_shard(events, start, results):
+    # Runs in a forked process, handling one shard's messages in order like its worker would.
+    from .consumers import GroupCostWorker
+    worker = GroupCostWorker({"type": "channel"})
+    worker.channel_layer = InMemoryChannelLayer()
+    start.wait()
+    began = time.perf_counter()
+    for event in events:
+        getattr(worker, event["type"])(event)
+    results.put(time.perf_counter() - began)
+    connection.close()
+
+
+@suite
+def worker_shards(options):
+    """
+    Throughput of the worker's session messages (logging in, then looking at balances and settling up) split over
+    each size's number of shards, one process each. Sessions are placed on shards like the server places them.
+    """
+    if connection.is_in_memory_db() or "fork" not in multiprocessing.get_all_start_methods():
+        return [{"name": "worker_shards", "skipped": "Needs a database file and forked processes"}]
+    _, people = seed_rows(SHARD_SESSIONS * 100, users=SHARD_SESSIONS)
+    sessions = [session_events(index, user) for index, user in enumerate(people)]
+    messages = sum(len(events) for uuid, events in sessions)
+    context = multiprocessing.get_context("fork")
+    results = []
+    # Logging every message would mostly measure writing log.txt.
+    logging.disable(logging.INFO)
+    try:
+        for size in options["sizes"]:
+            if size > MAX_SHARDS:
+                results.append({"name": "worker_shards", "shards": size, "skipped": "More than MAX_SHARDS"})
+                continue
+            ring = HashRing(shards.worker_channels(size))
+            shard_events = {channel: [] for channel in shards.worker_channels(size)}
+            for uuid, events in sessions:
+                shard_events[ring.node(uuid)] += events
+            timings = []
+            for _ in range(options["repeat"]):
+                # Forked workers shouldn't share this process's connection.
+                connection.close()
+                start, shard_results = context.Barrier(size + 1), context.Queue()
+                processes = [context.Process(target=run_shard, args=(events, start, shard_results))
+                             for events in shard_events.values()]
+                for process in processes:
+                    process.start()
+                start.wait()
+                began = time.perf_counter()
+                shard_seconds = [shard_results.get() for _ in processes]
+                timings.append(time.perf_counter() - began)
+                for process in processes:
+                    process.join()
+            spread = [len(events) for events in shard_events.values()]
+            results.append({
+                "name": "worker_shards",
+                "shards": size,
+                "messages": messages,
+                "seconds": statistics.median(timings),
+                "messages_per_second": messages / statistics.median(timings),
+                "slowest_shard_seconds": max(shard_seconds),
+                "fewest_shard_messages": min(spread),
+                "most_shard_messages": max(spread),
+            })
+    finally:
+        logging.disable(logging.NOTSET)
+        clear_rows()
+    return results
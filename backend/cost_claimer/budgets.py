@@ -0,0 +1,444 @@
+"""
+Query count and time budgets for every REST endpoint and worker action.
+Each call is run against databases of increasing size, and goes over budget if it makes more queries or takes longer
+than it declares, or if its query count changes with the size of the database (an N+1 query).
+The tests only check query counts, since times depend on the machine, and `python manage.py benchmark budgets` checks
+both.
+"""
+import json
+import logging
+import math
+import time
+from collections import namedtuple
+
+from channels.layers import InMemoryChannelLayer
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from .benchmarks import benchmark_date, clear_rows, seed_rows, suite
+from .consumers import GroupCostWorker
+from .lobby_store import lobby_store
+from .models import Receipt
+from .review_lobby import GroupLobbyOrganizer, recalculate_receipt
+from .user_directory import user_directory
+
+# Users in every fixture database, so per user work doesn't change between sizes.
+FIXTURE_USERS = 8
+
+Budget = namedtuple("Budget", ["queries", "milliseconds"])
+
+# Name -> (budget, setup, call). setup(fixture) runs untimed and returns what call(fixture, state) needs.
+calls = {}
+
+
+def budget(name, queries, milliseconds, setup=None):
+    def register(func):
+        calls[name] = (Budget(queries, milliseconds), setup or (lambda fixture: None), func)
+        return func
+    return register
+
+
+class Fixture(object):
+    """
+    A seeded database with a REST client and a worker whose channel layer goes nowhere.
+    """
+
+    def __init__(self, rows):
+        # Both the number of receipts and the items per receipt grow with rows.
+        receipts, self.users = seed_rows(rows, users=FIXTURE_USERS, receipts=max(1, math.isqrt(rows)))
+        self.receipt = receipts[len(receipts) // 2]
+        self.date = str(self.receipt.date)
+        self.item_ids = list(self.receipt.item_set.order_by("id").values_list("id", flat=True))
+        self.client = APIClient()
+        self.uploads = 0
+        # Every view that a request was made to, so the tests can check that none are missing a budget.
+        self.views = set()
+
+    def request(self, method, path, data=None, status=200, **kwargs):
+        response = getattr(self.client, method)("/cost_claimer/" + path, data, **kwargs)
+        self.views.add(response.resolver_match.func)
+        if response.status_code != status:
+            raise CallFailed("Expected status {}, got {}".format(status, response.status_code))
+        return response
+
+    def new_date(self):
+        # Far past every fixture receipt
+        self.uploads += 1
+        return benchmark_date(100000 + self.uploads)
+
+    def worker(self):
+        worker = RecordingWorker({"type": "channel"})
+        worker.channel_layer = InMemoryChannelLayer()
+        return worker
+
+    def session(self, worker, user_index=0, lobby=False):
+        """
+        Connects a session to the worker, logged in as a fixture user and in the fixture receipt's lobby if asked.
+        """
+        uuid = "session-{}".format(user_index)
+        worker.session_connect({"uuid": uuid})
+        user = self.users[user_index]
+        act(worker, uuid, "login", username=user.username, password=user.password)
+        if lobby:
+            act(worker, uuid, "join_lobby", receipt_date=self.date)
+        return uuid
+
+
+class RecordingWorker(GroupCostWorker):
+
+    def __init__(self, scope):
+        super().__init__(scope)
+        self.responses = []
+
+    def _respond(self, group_name, response):
+        self.responses.append(response)
+        super()._respond(group_name, response)
+
+
+class CallFailed(Exception):
+    pass
+
+
+def act(worker, uuid, action, **params):
+    """
+    Runs a worker action the way a websocket message would and returns its last response.
+    """
+    worker.responses = []
+    worker.session_action({"uuid": uuid, "text_data": {"action": action, **params}})
+    for response in worker.responses:
+        if response["type"] == "invalid_action":
+            raise CallFailed("{}: {}".format(action, response["message"]))
+    return worker.responses[-1] if worker.responses else None
+
+
+def expect(response, *types):
+    if response is None or response["type"] not in types:
+        raise CallFailed("Expected a {} response, got {}".format(" or ".join(types), response))
+
+
+def close_lobbies():
+    # Lobbies count down on timers, which shouldn't go off after the fixture is gone.
+    for lobby in GroupLobbyOrganizer._lobbies.values():
+        lobby.cancel_countdown()
+    GroupLobbyOrganizer._lobbies.clear()
+    lobby_store.clear()
+
+
+def set_active_users(lobby, users):
+    # Like everyone picking whether they bought the item, without a message each.
+    def update(state):
+        state["active_users"] = sorted(user.buy_index for user in users)
+        return state, None
+
+    lobby.transition(update)
+
+
+def current_item(lobby):
+    return lobby.items[lobby.get_state()["item_index"]]
+
+
+# REST endpoints
+
+@budget("POST upload/receipt/", queries=10, milliseconds=200)
+def upload_receipt(fixture, state):
+    fixture.request("post", "upload/receipt/", {
+        "date": fixture.new_date(), "payer": fixture.users[0].buy_index,
+        "subtotal": "1.00", "tax": "0.00", "total": "1.00", "tax_rate": "0.0000",
+    })
+
+
+@budget("POST upload/items/", queries=19, milliseconds=200)
+def upload_items(fixture, state):
+    # The older upload checks and saves each item on its own, so its budget is for these 5 items.
+    fixture.request("post", "upload/items/", {"date": fixture.date, "items": json.dumps([
+        {"name": "New {}".format(index), "count": 1, "price": "0.01", "imgSrc": "", "taxed": False}
+        for index in range(5)
+    ])})
+
+
+@budget("POST upload/receipt_items/", queries=13, milliseconds=200)
+def upload_receipt_items(fixture, state):
+    fixture.request("post", "upload/receipt_items/", {
+        "date": fixture.new_date(), "payer": fixture.users[0].buy_index,
+        "subtotal": "1.00", "tax": "0.00", "total": "1.00", "tax_rate": "0.0000",
+        "items": [
+            {"name": "New {}".format(index), "count": 1, "price": "0.01", "imgSrc": "", "taxed": False}
+            for index in range(50)
+        ],
+    }, format="json")
+
+
+@budget("GET taxability/", queries=1, milliseconds=500)
+def get_taxability(fixture, state):
+    fixture.request("get", "taxability/")
+
+
+@budget("GET user/<roommate>/", queries=0, milliseconds=100)
+def get_user(fixture, state):
+    fixture.request("get", "user/Roommate 1/")
+
+
+@budget("GET users/", queries=0, milliseconds=100)
+def get_users(fixture, state):
+    fixture.request("get", "users/")
+
+
+@budget("GET receipt/<date>/", queries=3, milliseconds=200)
+def get_receipt(fixture, state):
+    fixture.request("get", "receipt/{}/".format(fixture.date))
+
+
+@budget("GET receipt/<date>/?size=small", queries=3, milliseconds=200)
+def get_receipt_thumbnails(fixture, state):
+    fixture.request("get", "receipt/{}/?size=small".format(fixture.date))
+
+
+@budget("GET receipts/", queries=2, milliseconds=200)
+def get_receipts(fixture, state):
+    fixture.request("get", "receipts/")
+
+
+@budget("GET valid_receipts/", queries=3, milliseconds=100)
+def get_valid_receipts(fixture, state):
+    fixture.request("get", "valid_receipts/")
+
+
+@budget("GET receipt_index/", queries=3, milliseconds=100)
+def get_receipt_index(fixture, state):
+    fixture.request("get", "receipt_index/?limit=50")
+
+
+@budget("GET settle_up/", queries=3, milliseconds=200)
+def get_settle_up(fixture, state):
+    fixture.request("get", "settle_up/")
+
+
+@budget("GET thumbnail/<size>/<date>/<img>", queries=0, milliseconds=100)
+def get_thumbnail(fixture, state):
+    # Fixture items have no images, so this covers the lookup and the 404, which Django would log every time.
+    logger = logging.getLogger("django.request")
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        fixture.request("get", "thumbnail/small/{}/missing.jpeg".format(fixture.date), status=404)
+    finally:
+        logger.setLevel(level)
+
+
+@budget("GET index", queries=0, milliseconds=100)
+def get_index(fixture, state):
+    fixture.request("get", "anything/", status=302)
+
+
+# Worker actions, from a session set up by the setup function.
+
+def logged_in(fixture):
+    worker = fixture.worker()
+    return worker, fixture.session(worker)
+
+
+def in_lobby(fixture):
+    worker = fixture.worker()
+    return worker, fixture.session(worker, lobby=True)
+
+
+def viewing_items(fixture):
+    worker, uuid = in_lobby(fixture)
+    GroupLobbyOrganizer._lobbies[fixture.date].start_item_viewing()
+    return worker, uuid
+
+
+def connected(fixture):
+    worker = fixture.worker()
+    worker.session_connect({"uuid": "new-session"})
+    return worker, "new-session"
+
+
+@budget("change_password", queries=5, milliseconds=100, setup=logged_in)
+def change_password(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "change_password", password="password", new_password="new"), "user_change")
+
+
+@budget("change_status", queries=0, milliseconds=100, setup=in_lobby)
+def change_status(fixture, state):
+    worker, uuid = state
+    act(worker, uuid, "change_status", new_status="true")
+
+
+@budget("change_username", queries=5, milliseconds=100, setup=logged_in)
+def change_username(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "change_username", password="password", new_username="renamed"), "user_change")
+
+
+@budget("claim_item", queries=0, milliseconds=100, setup=viewing_items)
+def claim_item(fixture, state):
+    worker, uuid = state
+    act(worker, uuid, "claim_item", item_id=current_item(GroupLobbyOrganizer._lobbies[fixture.date]).id)
+
+
+def without_account(fixture):
+    # Users get an account by picking a password for the name they were given in the admin site.
+    user = fixture.users[-1]
+    user.password = None
+    user.save()
+    return connected(fixture)
+
+
+@budget("create_account", queries=2, milliseconds=100, setup=without_account)
+def create_account(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "create_account", name=fixture.users[-1].name, username="newuser", password="password"),
+           "user_change")
+
+
+@budget("join_lobby", queries=1, milliseconds=100, setup=logged_in)
+def join_lobby(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "join_lobby", receipt_date=fixture.date), "lobby_init")
+
+
+def reviewing_without_user(fixture):
+    worker, uuid = viewing_items(fixture)
+    return worker, fixture.session(worker, user_index=1)
+
+
+@budget("join_lobby mid-review", queries=0, milliseconds=100, setup=reviewing_without_user)
+def join_reviewing_lobby(fixture, state):
+    # The current item is sent from what the lobby loaded when the review started.
+    worker, uuid = state
+    expect(act(worker, uuid, "join_lobby", receipt_date=fixture.date), "lobby_init")
+
+
+@budget("leave_lobby", queries=10, milliseconds=200, setup=in_lobby)
+def leave_lobby(fixture, state):
+    # The last user out of a lobby recalculates the receipt.
+    worker, uuid = state
+    act(worker, uuid, "leave_lobby")
+
+
+@budget("login", queries=0, milliseconds=100, setup=connected)
+def login(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "login", username="user0", password="password"), "user_change")
+
+
+@budget("logout", queries=0, milliseconds=100, setup=logged_in)
+def logout(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "logout"), "user_change")
+
+
+@budget("record_payment", queries=3, milliseconds=100, setup=logged_in)
+def record_payment(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "record_payment", user_id=fixture.users[1].buy_index, amount="$5.00"), "payment_success")
+
+
+@budget("settle_up", queries=2, milliseconds=200, setup=logged_in)
+def settle_up(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "settle_up"), "settle_up")
+
+
+@budget("view_balances", queries=1, milliseconds=200, setup=logged_in)
+def view_balances(fixture, state):
+    worker, uuid = state
+    expect(act(worker, uuid, "view_balances"), "balances")
+
+
+@budget("view_next_item", queries=7, milliseconds=200, setup=viewing_items)
+def view_next_item(fixture, state):
+    # Moving on from an item saves its buyers and their covers when the countdown runs out.
+    lobby = GroupLobbyOrganizer._lobbies[fixture.date]
+    set_active_users(lobby, fixture.users[1:3])
+    lobby.view_next_item()
+
+
+@budget("recalculate_receipt", queries=11, milliseconds=200)
+def recalculate(fixture, state):
+    recalculate_receipt(Receipt.objects.get(date=fixture.date))
+
+
+def measure(fixture, name, repeat):
+    """
+    Runs a call repeat times, each in a transaction that is rolled back so calls don't see each other's changes.
+    Returns the query count and the fastest time. Caches are cleared first so the call does all of its work.
+    """
+    _, setup, func = calls[name]
+    queries, timings = None, []
+    for _ in range(repeat):
+        with transaction.atomic():
+            try:
+                state = setup(fixture)
+                cache.clear()
+                # Loads the user directory now, so its queries aren't counted against the call.
+                user_directory.all()
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    func(fixture, state)
+                    timings.append(time.perf_counter() - start)
+            finally:
+                close_lobbies()
+                transaction.set_rollback(True)
+        # Saves inside the rolled back transaction may have left the directory with users that were never saved.
+        user_directory.invalidate()
+        if queries is None or len(captured) > queries:
+            queries = len(captured)
+    return queries, min(timings) * 1000
+
+
+def run_budgets(sizes, repeat=1, names=None):
+    """
+    Measures every call against a database of each size and returns a result dict per call and size.
+    """
+    results = []
+    for size in sizes:
+        fixture = Fixture(size)
+        user_directory.invalidate()
+        try:
+            for name in names or calls:
+                queries, milliseconds = measure(fixture, name, repeat)
+                results.append({"name": name, "rows": size, "queries": queries, "milliseconds": milliseconds})
+        finally:
+            clear_rows()
+            user_directory.invalidate()
+    return results
+
+
+def over_budget(results, timed=True):
+    """
+    Returns a message for every call that went over its budget or whose query count changed with the database size.
+    Times are only checked if timed.
+    """
+    problems = []
+    counts = {}
+    for result in results:
+        limit = calls[result["name"]][0]
+        if result["queries"] > limit.queries:
+            problems.append("{name} made {queries} queries with {rows} rows, over its budget of {limit}".format(
+                limit=limit.queries, **result))
+        if timed and result["milliseconds"] > limit.milliseconds:
+            problems.append("{name} took {milliseconds:.1f}ms with {rows} rows, over its budget of {limit}ms".format(
+                limit=limit.milliseconds, **result))
+        counts.setdefault(result["name"], {})[result["rows"]] = result["queries"]
+    for name, by_size in counts.items():
+        if len(set(by_size.values())) > 1:
+            problems.append("{} makes a different number of queries as rows grow: {}".format(
+                name, ", ".join("{} with {} rows".format(count, rows) for rows, count in sorted(by_size.items()))))
+    return problems
+
+
+@suite
+def budgets(options):
+    """
+    Query counts and times for every REST endpoint and worker action, flagged when they go over budget.
+    """
+    results = run_budgets(options["sizes"], options["repeat"])
+    problems = over_budget(results)
+    for result in results:
+        result["over_budget"] = [problem for problem in problems if problem.startswith(result["name"] + " ")]
+    return results
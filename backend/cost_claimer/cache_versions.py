@@ -0,0 +1,54 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import CacheVersion
+
+
+# Bumped when any receipt is added, changed or removed
+RECEIPTS_KEY = "receipts"
+# Bumped when any user is added, changed or removed
+USERS_KEY = "users"
+# Bumped when any balance between users changes
+LEDGER_KEY = "ledger"
+
+
+def receipt_key(receipt_date):
+    return "receipt:{}".format(receipt_date)
+
+
+def version_token(version, modified):
+    # The bump time is included so a recreated database can't line up with versions cached before it.
+    return "{}.{}".format(version, int(modified.timestamp() * 1000000)) if modified else "0"
+
+
+def get_versions(keys):
+    """
+    Returns a token for the current version of every key, with one query.
+    """
+    rows = {key: version_token(version, modified) for key, version, modified in
+            CacheVersion.objects.filter(key__in=keys).values_list("key", "version", "modified")}
+    return {key: rows.get(key, "0") for key in keys}
+
+
+def get_version(key):
+    return get_versions([key])[key]
+
+
+def get_version_info(key):
+    """
+    Returns the version token of key and when it was last bumped (None if it never was).
+    """
+    version, modified = CacheVersion.objects.filter(key=key).values_list("version", "modified").first() or (0, None)
+    return version_token(version, modified), modified
+
+
+def bump_version(key):
+    if CacheVersion.objects.filter(key=key).update(version=F("version") + 1, modified=timezone.now()):
+        return
+    try:
+        with transaction.atomic():
+            CacheVersion.objects.create(key=key, version=1)
+    except IntegrityError:
+        # Another process created it first
+        CacheVersion.objects.filter(key=key).update(version=F("version") + 1, modified=timezone.now())
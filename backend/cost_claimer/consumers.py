@@ -1,7 +1,7 @@
+import copy
 import json
 import logging
 import re as regex
-from collections import defaultdict
 from decimal import Decimal
 from functools import wraps
 from uuid import uuid1 as get_new_uuid
@@ -9,12 +9,21 @@ from uuid import uuid1 as get_new_uuid
 from channels.generic.websocket import WebsocketConsumer, SyncConsumer
 from asgiref.sync import async_to_sync
 
-from .models import User, Cover, Payment
+from .database import retry_when_locked
+from .ledger import get_balances, get_settle_up
+from .lobby_store import LOGIN_TTL, lobby_store
+from .models import Payment
 from .review_lobby import GroupLobbyOrganizer
+from .scheduler import lobby_scheduler
 from .serializers import UserSerializer
+from .shards import worker_channel
+from .user_directory import user_directory
 
 logging.basicConfig(filename='log.txt', level=logging.INFO)
 
+# Seconds between a worker's refreshes of its sessions' logins, well within LOGIN_TTL so they never expire while used
+LOGIN_REFRESH_SECONDS = LOGIN_TTL / 4
+
 
 def log_redacted(message, obj):
     original = True
@@ -27,10 +36,24 @@ def log_redacted(message, obj):
     logging.info(message, obj)
 
 
+def save_user(user, **changes):
+    """
+    Saves changes to a copy of a user and returns the copy. Users from user_directory are shared by every session, so
+    they keep their saved values if the save fails, and are replaced by the directory reloading once it succeeds.
+    """
+    changed = copy.copy(user)
+    for field, value in changes.items():
+        setattr(changed, field, value)
+    retry_when_locked(changed.save)()
+    return changed
+
+
 class GroupCostConsumer(WebsocketConsumer):
 
     def connect(self):
         self.uuid = str(get_new_uuid())
+        # Every message of this session goes to the same worker, so they're handled in order.
+        self.worker_channel = worker_channel(self.uuid)
         self.group_names = set()
         self.commands = {
             "join_group": self._join_group,
@@ -38,7 +61,7 @@ class GroupCostConsumer(WebsocketConsumer):
         }
         self._join_group(self.uuid)
         async_to_sync(self.channel_layer.send)(
-            "user_action",
+            self.worker_channel,
             {
                 "uuid": self.uuid,
                 "type": "session_connect",
@@ -48,7 +71,7 @@ class GroupCostConsumer(WebsocketConsumer):
 
     def disconnect(self, close_code):
         async_to_sync(self.channel_layer.send)(
-            "user_action",
+            self.worker_channel,
             {
                 "uuid": self.uuid,
                 "type": "session_disconnect",
@@ -62,7 +85,7 @@ class GroupCostConsumer(WebsocketConsumer):
 
     def receive(self, text_data=None, bytes_data=None):
         async_to_sync(self.channel_layer.send)(
-            "user_action",
+            self.worker_channel,
             {
                 "uuid": self.uuid,
                 "type": "session_action",
@@ -74,6 +97,18 @@ class GroupCostConsumer(WebsocketConsumer):
     def lobby_update(self, event):
         self.send(text_data=json.dumps(event["update"]))
 
+    # Lobbies close by telling their group, since their users' sessions can be on any worker.
+    def lobby_close(self, event):
+        self._leave_group(event["receipt_date"])
+        async_to_sync(self.channel_layer.send)(
+            self.worker_channel,
+            {
+                "uuid": self.uuid,
+                "type": "lobby_close",
+                "receipt_date": event["receipt_date"],
+            }
+        )
+
     # Responses are messages that don't need further processing and can be sent to the client.
     def worker_response(self, event):
         self.send(text_data=json.dumps(event["response"]))
@@ -150,6 +185,7 @@ class GroupCostWorker(SyncConsumer):
         "login": ["username", "password"],
         "logout": [],
         "record_payment": ["user_id", "amount"],
+        "settle_up": [],
         "view_balances": [],
     }
 
@@ -157,6 +193,16 @@ class GroupCostWorker(SyncConsumer):
         super().__init__(scope)
         self.sessions = {}
         self.user_sessions = {}
+        GroupLobbyOrganizer.start_sweeping()
+        if lobby_store.shared:
+            lobby_scheduler.call_later(LOGIN_REFRESH_SECONDS, self.refresh_logins)
+
+    def refresh_logins(self):
+        try:
+            lobby_store.refresh_logins({user_id: session.uuid for user_id, session in list(self.user_sessions.items())})
+        except Exception:
+            logging.exception("Refreshing logins failed")
+        lobby_scheduler.call_later(LOGIN_REFRESH_SECONDS, self.refresh_logins)
 
     def _respond(self, group_name, response):
         async_to_sync(self.channel_layer.group_send)(
@@ -236,17 +282,15 @@ class GroupCostWorker(SyncConsumer):
             })
 
     def lobby_close(self, event):
-        users = event["users"]
-        for user in users:
-            session = self.user_sessions[int(user)]
-            self._command(session.uuid, "leave_group", [session.lobby.receipt_date])
+        # The session could have left the lobby, or joined another, since the lobby closed.
+        session = self.sessions.get(event["uuid"])
+        if session and session.lobby and session.lobby.receipt_date == event["receipt_date"]:
             session.lobby = None
 
     @requires_login
     def _change_password(self, session, password, new_password):
         if session.user.password == password:
-            session.user.password = new_password
-            session.user.save()
+            session.user = save_user(session.user, password=new_password)
             self._respond(session.uuid, {
                 "type": "user_change",
                 "valid": True,
@@ -274,8 +318,7 @@ class GroupCostWorker(SyncConsumer):
     @requires_login
     def _change_username(self, session, password, new_username):
         if session.user.password == password:
-            session.user.username = new_username
-            session.user.save()
+            session.user = save_user(session.user, username=new_username)
             self._respond(session.uuid, {
                 "type": "user_change",
                 "valid": True,
@@ -293,20 +336,20 @@ class GroupCostWorker(SyncConsumer):
         session.lobby.activate_exclusive_user(session.user, item_id)
 
     def _create_account(self, session, name, username, password):
-        new_user = User.objects.filter(name=name).first()
+        new_user = user_directory.by_name(name)
         if new_user:
             if new_user.password is None:
-                if User.objects.filter(username=username).exists():
+                if user_directory.by_username(username):
                     self._respond(session.uuid, {
                         "type": "account_error",
                         "message": "Username Already Taken",
                     })
                 else:
-                    new_user.username = username
-                    new_user.password = password
-                    new_user.save()
+                    new_user = save_user(new_user, username=username, password=password)
                     session.user = new_user
                     self.user_sessions[new_user.buy_index] = session
+                    # Nobody could log in without a password, so this always gets the login.
+                    lobby_store.claim_login(new_user.buy_index, session.uuid)
                     self._respond(session.uuid, {
                         "type": "user_change",
                         "valid": True,
@@ -350,9 +393,10 @@ class GroupCostWorker(SyncConsumer):
 
     def _login(self, session, username, password):
         self._logout(session, notify_if_invalid=False)
-        user = User.objects.filter(username=username, password=password).first()
+        user = user_directory.authenticate(username, password)
         if user:
-            if user.buy_index in self.user_sessions:
+            # Logins are claimed in the lobby store, since the user's other sessions could be on other workers.
+            if user.buy_index in self.user_sessions or not lobby_store.claim_login(user.buy_index, session.uuid):
                 self._respond(session.uuid, {
                     "type": "account_error",
                     "message": "You are already logged in.",
@@ -376,6 +420,7 @@ class GroupCostWorker(SyncConsumer):
     def _logout(self, session):
         self._leave_lobby(session, notify_if_invalid=False)
         self.user_sessions.pop(session.user.buy_index)
+        lobby_store.release_login(session.user.buy_index, session.uuid)
         session.user = None
         self._respond(session.uuid, {
             "type": "user_change",
@@ -385,10 +430,11 @@ class GroupCostWorker(SyncConsumer):
 
     @requires_login
     def _record_payment(self, session, user_id, amount):
-        if regex.match(r"/\$?\d+(?:\.\d\d)?$", amount):
-            payer = User.objects.filter(buy_index=user_id).first()
+        if regex.match(r"^\$?\d+(?:\.\d\d)?$", amount):
+            payer = user_directory.get(user_id)
             if payer:
-                Payment(transaction_payer=session.user, user=payer, amount=Decimal(amount)).save()
+                payment = Payment(transaction_payer=session.user, user=payer, amount=Decimal(amount.lstrip("$")))
+                retry_when_locked(payment.save)()
                 self._respond(session.uuid, {
                     "type": "payment_success",
                     "message": "Payment Recorded",
@@ -404,33 +450,25 @@ class GroupCostWorker(SyncConsumer):
                 "message": "Amount Must be a Positive Dollar Amount",
             })
 
+    @requires_login
+    def _settle_up(self, session):
+        self._respond(session.uuid, {
+            "type": "settle_up",
+            "transfers": get_settle_up(),
+        })
+
     @requires_login
     def _view_balances(self, session):
-        # Money that the user needs back
-        all_due = defaultdict(lambda: Decimal("0.00"))
-        # Money that the user needs to give back
-        all_owed = defaultdict(lambda: Decimal("0.00"))
-
-        # All the times the user covered someone
-        for transaction in Cover.objects.filter(transaction_payer=session.user):
-            all_due[transaction.user.buy_index] += transaction.amount
-        # All the times the user was covered by someone
-        for transaction in Cover.objects.filter(user=session.user):
-            all_owed[transaction.transaction_payer.buy_index] += transaction.amount
-        # All the times the user was paid back
-        for transaction in Payment.objects.filter(transaction_payer=session.user):
-            all_due[transaction.user.buy_index] -= transaction.amount
-        # All the times the user paid someone back
-        for transaction in Payment.objects.filter(user=session.user):
-            all_owed[transaction.transaction_payer.buy_index] -= transaction.amount
+        # What every other user owes the user in cents, net of every cover and payment (negative if the user owes them)
+        balances = get_balances(session.user)
 
         # The net money the user needs back
         net_due = {}
         # The net money that the user needs to give back
         net_owed = {}
 
-        for user in User.objects.exclude(buy_index=session.user.buy_index):
-            net_total = all_due[user.buy_index] - all_owed[user.buy_index]
+        for user in user_directory.others(session.user):
+            net_total = Decimal(balances.get(user.buy_index, 0)).scaleb(-2)
             if net_total < 0:
                 net_owed[str(user.buy_index)] = str(Decimal.copy_abs(net_total))
             elif net_total > 0:
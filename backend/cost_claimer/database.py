@@ -0,0 +1,76 @@
+"""
+SQLite settings for the server and worker sharing one database file, and retrying writes that find it locked.
+"""
+import random
+import time
+from collections import Counter
+from functools import wraps
+
+from django.db import OperationalError, connection, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+SQLITE_PRAGMAS = {
+    # Readers don't wait for the writer and the writer doesn't wait for readers, only writers wait for each other.
+    "journal_mode": "WAL",
+    # Safe with WAL: a power loss can lose the last few commits, but can't corrupt the database.
+    "synchronous": "NORMAL",
+}
+
+# Statement that starts transactions in the cost_claimer.sqlite backend
+SQLITE_BEGIN = "BEGIN IMMEDIATE"
+
+# Times a locked write is tried again, waiting LOCK_RETRY_DELAY seconds at first and twice as long each time after.
+LOCK_RETRIES = 5
+LOCK_RETRY_DELAY = 0.05
+
+# Counts of "retries" and "failures" (writes that were still locked after every retry), for benchmarks.
+lock_stats = Counter()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            for pragma, value in SQLITE_PRAGMAS.items():
+                cursor.execute("PRAGMA {} = {}".format(pragma, value))
+
+
+def is_lock_error(error):
+    # SQLite says "database is locked" (or "database table is locked" for shared cache databases).
+    return isinstance(error, OperationalError) and "locked" in str(error)
+
+
+def retry_when_locked(func):
+    """
+    Runs func in a transaction, running it again if the database was locked even after waiting the busy timeout.
+    Inside another transaction, func is just called, since only the outermost transaction can be started over.
+    """
+    @wraps(func)
+    def retrying(*args, **kwargs):
+        if connection.in_atomic_block:
+            return func(*args, **kwargs)
+        for attempt in range(LOCK_RETRIES + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as error:
+                if not is_lock_error(error):
+                    raise
+                if attempt == LOCK_RETRIES:
+                    lock_stats["failures"] += 1
+                    raise
+                lock_stats["retries"] += 1
+                # Jitter so the writers that collided don't collide again.
+                time.sleep(LOCK_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    return retrying
+
+
+def batches(rows, columns):
+    """
+    Splits rows (lists of values for columns) into batches small enough to insert with one statement each, the way
+    bulk_create splits objects, so multi-row statements stay within the database's limit on query parameters.
+    """
+    size = max(connection.ops.bulk_batch_size(columns, rows), 1)
+    return [rows[start:start + size] for start in range(0, len(rows), size)]
@@ -0,0 +1,158 @@
+"""
+Net balances between every pair of users, kept up to date as covers and payments are saved and deleted,
+so a user's balances are one row per other user however long the history of covers and payments gets.
+"""
+import heapq
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+
+from .cache_versions import LEDGER_KEY, bump_version
+from .database import batches
+from .models import Balance, Cover, Payment, to_cents
+from .response_cache import cached_data
+
+
+def add_entry(totals, creditor, debtor, cents):
+    # Adds cents owed to creditor by debtor to totals of (user_a id, user_b id) pairs.
+    if creditor < debtor:
+        totals[creditor, debtor] += cents
+    elif creditor > debtor:
+        totals[debtor, creditor] -= cents
+
+
+def adjust_balances(entries):
+    """
+    Adds (id of the user owed, id of the user owing, cents) entries to the balances, with one query per batch of pairs.
+    """
+    totals = Counter()
+    for entry in entries:
+        add_entry(totals, *entry)
+    rows = [[user_a, user_b, cents] for (user_a, user_b), cents in totals.items() if cents]
+    if not rows:
+        return
+    table = connection.ops.quote_name(Balance._meta.db_table)
+    with connection.cursor() as cursor:
+        for batch in batches(rows, ["user_a_id", "user_b_id", "cents"]):
+            cursor.execute(
+                "INSERT INTO {0} (user_a_id, user_b_id, cents) VALUES {1} "
+                "ON CONFLICT (user_a_id, user_b_id) DO UPDATE SET cents = {0}.cents + excluded.cents"
+                .format(table, ", ".join(["(%s, %s, %s)"] * len(batch))),
+                [value for row in batch for value in row],
+            )
+    bump_version(LEDGER_KEY)
+
+
+def reverse(entry):
+    creditor, debtor, cents = entry
+    return creditor, debtor, -cents
+
+
+def get_balances(user):
+    """
+    Returns {id of other user: cents they owe user} (negative when user owes them), for users with a balance.
+    """
+    balances = {}
+    rows = Balance.objects.filter(Q(user_a=user) | Q(user_b=user)).values_list("user_a", "user_b", "cents")
+    for user_a, user_b, cents in rows:
+        if not cents:
+            continue
+        if user_a == user.buy_index:
+            balances[user_b] = cents
+        else:
+            balances[user_a] = -cents
+    return balances
+
+
+def expected_balances():
+    """
+    Adds up every cover and payment from scratch. Returns {(user_a id, user_b id): cents} like Balance rows.
+    """
+    totals = Counter()
+    for model in (Cover, Payment):
+        rows = model.objects.values_list("transaction_payer", "user").annotate(total=Sum("amount")).order_by()
+        for creditor, debtor, total in rows:
+            add_entry(totals, creditor, debtor, model.ledger_sign * to_cents(total))
+    return {pair: cents for pair, cents in totals.items() if cents}
+
+
+def ledger_differences():
+    """
+    Returns [(user_a id, user_b id, expected cents, stored cents)] for every pair whose balance is wrong.
+    """
+    expected = expected_balances()
+    stored = {(user_a, user_b): cents for user_a, user_b, cents in
+              Balance.objects.values_list("user_a", "user_b", "cents") if cents}
+    return [(user_a, user_b, expected.get((user_a, user_b), 0), stored.get((user_a, user_b), 0))
+            for user_a, user_b in sorted(expected.keys() | stored.keys())
+            if expected.get((user_a, user_b), 0) != stored.get((user_a, user_b), 0)]
+
+
+@transaction.atomic
+def rebuild_ledger():
+    """
+    Replaces every balance with ones added up from scratch. Returns the number of balances.
+    """
+    Balance.objects.all().delete()
+    balances = Balance.objects.bulk_create([
+        Balance(user_a_id=user_a, user_b_id=user_b, cents=cents)
+        for (user_a, user_b), cents in expected_balances().items()
+    ], batch_size=1000)
+    bump_version(LEDGER_KEY)
+    return len(balances)
+
+
+def net_balances():
+    """
+    Returns {user id: cents} of what every user with a balance is owed overall (negative for what they owe).
+    """
+    nets = Counter()
+    for user_a, user_b, cents in Balance.objects.values_list("user_a", "user_b", "cents"):
+        nets[user_a] += cents
+        nets[user_b] -= cents
+    return {user_id: cents for user_id, cents in nets.items() if cents}
+
+
+def settle_up(nets):
+    """
+    Returns [(id of user paying, id of user paid, cents)] transfers that bring every net balance to 0.
+    Nets that exactly cancel are paired up first, then the biggest debt always goes to the biggest credit, which takes
+    at most one fewer transfer than there are users left to settle.
+    """
+    transfers = []
+    creditors = defaultdict(list)
+    for user_id, cents in sorted(nets.items()):
+        if cents > 0:
+            creditors[cents].append(user_id)
+    debts = []
+    for user_id, cents in sorted(nets.items()):
+        if cents < 0:
+            if creditors[-cents]:
+                transfers.append((user_id, creditors[-cents].pop(0), -cents))
+            else:
+                debts.append((cents, user_id))
+    credits = [(-cents, user_id) for cents, user_ids in creditors.items() for user_id in user_ids]
+    heapq.heapify(debts)
+    heapq.heapify(credits)
+    while debts and credits:
+        debt, debtor = heapq.heappop(debts)
+        credit, creditor = heapq.heappop(credits)
+        cents = min(-debt, -credit)
+        transfers.append((debtor, creditor, cents))
+        if debt + cents:
+            heapq.heappush(debts, (debt + cents, debtor))
+        if credit + cents:
+            heapq.heappush(credits, (credit + cents, creditor))
+    return transfers
+
+
+def get_settle_up():
+    """
+    Transfers that settle every balance, ready to send. Cached until a balance changes.
+    """
+    return cached_data("settle_up", [LEDGER_KEY], lambda: [
+        {"from_user": debtor, "to_user": creditor, "amount": str(Decimal(cents).scaleb(-2))}
+        for debtor, creditor, cents in settle_up(net_balances())
+    ])
@@ -0,0 +1,201 @@
+"""
+Where review lobbies keep their state, so any worker process can pick a lobby up and lobbies outlive restarts.
+Lobbies are kept in Redis, or in a dictionary in this process when LOBBY_STORE_URL is None (tests and benchmarks).
+The session each user is logged in to is kept here too, so a user can't be logged in on two workers at once.
+"""
+import json
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Lobbies nobody has touched in this long are dropped.
+LOBBY_TTL = 24 * 60 * 60
+# Logins that their worker stops refreshing (because it went away) are dropped after this many seconds.
+LOGIN_TTL = 60
+
+
+def new_state():
+    return {
+        "all_users": [],
+        "active_users": [],
+        # Id of the user who claimed the current item for themself
+        "exclusive_user": None,
+        "viewing": False,
+        # Id of the review started when viewing began, so workers can tell when the items they loaded are out of date
+        "review": None,
+        # Index of the item being reviewed, in id order
+        "item_index": -1,
+        # time.time() when the running countdown ends, None if there isn't one
+        "deadline": None,
+    }
+
+
+def is_overdue(encoded, before):
+    deadline = json.loads(encoded)["deadline"]
+    return deadline is not None and deadline < before
+
+
+class MemoryLobbyStore(object):
+    # Only this process sees the lobbies, so there's never another worker's countdown to finish.
+    shared = False
+
+    def __init__(self):
+        self._states = {}
+        # User id -> uuid of the session they're logged in to
+        self._logins = {}
+        self._lock = threading.Lock()
+
+    def get(self, receipt_date):
+        with self._lock:
+            encoded = self._states.get(receipt_date)
+        return json.loads(encoded) if encoded else None
+
+    def transition(self, receipt_date, func):
+        """
+        Calls func with the lobby's state (None if there's no lobby), which returns the new state and a result.
+        The new state (or deleting the lobby, if it's None) is saved atomically, and the result returned.
+        func may be called more than once, so it shouldn't have side effects, and it mustn't use the store.
+        """
+        with self._lock:
+            encoded = self._states.get(receipt_date)
+            state, result = func(json.loads(encoded) if encoded else None)
+            if state is None:
+                self._states.pop(receipt_date, None)
+            else:
+                self._states[receipt_date] = json.dumps(state)
+        return result
+
+    def overdue(self, before):
+        """
+        Dates of the lobbies with a countdown that should have finished before the given time.time().
+        """
+        with self._lock:
+            return [receipt_date for receipt_date, encoded in self._states.items() if is_overdue(encoded, before)]
+
+    def claim_login(self, user_id, uuid):
+        """
+        Logs the user in to the session unless they're logged in to another one. Returns whether they're now logged in
+        to this one.
+        """
+        with self._lock:
+            return self._logins.setdefault(user_id, uuid) == uuid
+
+    def release_login(self, user_id, uuid):
+        with self._lock:
+            if self._logins.get(user_id) == uuid:
+                del self._logins[user_id]
+
+    def refresh_logins(self, logins):
+        """
+        Keeps the given {user id: session uuid} logins from expiring. Logins in this process never do.
+        """
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._logins.clear()
+
+
+class RedisLobbyStore(object):
+    shared = True
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.watch_error = redis.WatchError
+
+    @staticmethod
+    def key(receipt_date):
+        return "cost_claimer:lobby:{}".format(receipt_date)
+
+    @staticmethod
+    def login_key(user_id):
+        return "cost_claimer:login:{}".format(user_id)
+
+    def get(self, receipt_date):
+        encoded = self.redis.get(self.key(receipt_date))
+        return json.loads(encoded) if encoded else None
+
+    def transition(self, receipt_date, func):
+        # Same as MemoryLobbyStore.transition. If another worker changes the lobby first, func runs again on that.
+        key = self.key(receipt_date)
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    encoded = pipe.get(key)
+                    state, result = func(json.loads(encoded) if encoded else None)
+                    pipe.multi()
+                    if state is None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, json.dumps(state), ex=LOBBY_TTL)
+                    pipe.execute()
+                    return result
+                except self.watch_error:
+                    continue
+
+    def overdue(self, before):
+        keys = list(self.redis.scan_iter(self.key("*")))
+        if not keys:
+            return []
+        prefix = len(self.key(""))
+        return [key.decode()[prefix:] for key, encoded in zip(keys, self.redis.mget(keys))
+                if encoded and is_overdue(encoded, before)]
+
+    def claim_login(self, user_id, uuid):
+        key = self.login_key(user_id)
+        return bool(self.redis.set(key, uuid, nx=True, ex=LOGIN_TTL)) or self.redis.get(key) == uuid.encode()
+
+    def release_login(self, user_id, uuid):
+        key = self.login_key(user_id)
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    if pipe.get(key) != uuid.encode():
+                        return
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+                    return
+                except self.watch_error:
+                    continue
+
+    def refresh_logins(self, logins):
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id, uuid in logins.items():
+                # Takes the login back if it expired before this refresh, and pushes its expiry back either way.
+                pipe.set(self.login_key(user_id), uuid, nx=True, ex=LOGIN_TTL)
+                pipe.expire(self.login_key(user_id), LOGIN_TTL)
+            pipe.execute()
+
+
+class SettingsLobbyStore(object):
+    """
+    The store that settings.LOBBY_STORE_URL picks, made when it's first used and again when the setting is changed
+    (like by the test runner). Only the in-memory store can be cleared, so tests can never clear real lobbies.
+    """
+
+    def __init__(self):
+        self._store = None
+
+    def __getattr__(self, name):
+        if self._store is None:
+            url = settings.LOBBY_STORE_URL
+            self._store = RedisLobbyStore(url) if url else MemoryLobbyStore()
+        return getattr(self._store, name)
+
+    def reset(self):
+        self._store = None
+
+
+lobby_store = SettingsLobbyStore()
+
+
+@receiver(setting_changed)
+def lobby_store_setting_changed(setting, **kwargs):
+    if setting == "LOBBY_STORE_URL":
+        lobby_store.reset()
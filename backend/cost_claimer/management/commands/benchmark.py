@@ -0,0 +1,60 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from backend.test_runner import ISOLATED_SETTINGS
+from cost_claimer import benchmarks
+# Registers the budgets suite, which is built on the benchmark helpers so it can't be imported by them.
+from cost_claimer import budgets  # noqa: F401
+
+
+class Command(BaseCommand):
+    help = "Runs benchmark suites against a throwaway database and prints the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("suites", nargs="*", help="Suites to run, defaults to all of: {}".format(
+            ", ".join(benchmarks.suites)))
+        parser.add_argument("--sizes", default=",".join(str(size) for size in benchmarks.DEFAULT_SIZES),
+                            help="Comma separated problem sizes, like item counts per receipt")
+        parser.add_argument("--repeat", type=int, default=3, help="Times each measurement is repeated")
+        parser.add_argument("--output", default=None, help="File to write the results to instead of stdout")
+
+    def handle(self, *args, **options):
+        suite_names = options["suites"] or list(benchmarks.suites)
+        unknown = [name for name in suite_names if name not in benchmarks.suites]
+        if unknown:
+            raise CommandError("Unknown suites: {}".format(", ".join(unknown)))
+        options["sizes"] = [int(size) for size in options["sizes"].split(",")]
+
+        # Same setup as the test runner, so the real database is never touched.
+        # SQLite test databases are kept in memory, so use a file instead to lock and journal like the real one.
+        temporary_dir = None
+        if connection.vendor == "sqlite":
+            temporary_dir = tempfile.mkdtemp()
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(temporary_dir, "benchmark.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(**ISOLATED_SETTINGS):
+                results = {name: benchmarks.suites[name](options) for name in suite_names}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if temporary_dir:
+                shutil.rmtree(temporary_dir, ignore_errors=True)
+
+        report = json.dumps({
+            "python": platform.python_version(),
+            "database": connection.vendor,
+            "html_parser": benchmarks.ReceiptParser.HTML_PARSER,
+            "results": results,
+        }, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
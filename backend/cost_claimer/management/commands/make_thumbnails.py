@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from cost_claimer.models import Item
+from cost_claimer import thumbnails
+
+
+class Command(BaseCommand):
+    help = "Renders item thumbnails ahead of time so the first review of a receipt doesn't have to."
+
+    def add_arguments(self, parser):
+        parser.add_argument("dates", nargs="*", help="Receipt dates (YYYY-MM-DD) to render, defaults to all receipts")
+
+    def handle(self, *args, **options):
+        items = Item.objects.order_by("receipt_id")
+        if options["dates"]:
+            items = items.filter(receipt__in=options["dates"])
+        rendered, missing = 0, 0
+        for receipt_date, img_src in items.values_list("receipt_id", "imgSrc").distinct():
+            try:
+                thumbnails.make_thumbnails(str(receipt_date), img_src)
+                rendered += 1
+            except thumbnails.UnknownImage:
+                missing += 1
+                self.stderr.write("Missing image {} for {}".format(img_src, receipt_date))
+        self.stdout.write("Rendered thumbnails for {} images, {} missing".format(rendered, missing))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cost_claimer.models import Item, User, iter_bits
+
+
+class Command(BaseCommand):
+    help = "Gives every user a bit in Item.buyers and checks that the buyers already stored still decode to users."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Report what would change without saving it")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # Users with old bit flags go first so they get their old bits back.
+            users = sorted(User.objects.filter(bit=None), key=lambda user: User.legacy_bit(user.buy_index) is None)
+            for user in users:
+                user.save()
+                self.stdout.write("{} gets bit {}".format(user.name, user.bit))
+
+            known = set(User.objects.values_list("bit", flat=True))
+            unknown = set()
+            for buyers in Item.objects.exclude(buyers=0).values_list("buyers", flat=True).distinct():
+                unknown.update(bit for bit in iter_bits(buyers) if bit not in known)
+            for bit in sorted(unknown):
+                self.stderr.write("Items have buyer bit {} but no user has it".format(bit))
+
+            if options["dry_run"]:
+                transaction.set_rollback(True)
+        self.stdout.write("{} {} users".format("Would update" if options["dry_run"] else "Updated", len(users)))
@@ -0,0 +1,34 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cost_claimer.ledger import ledger_differences, rebuild_ledger
+from cost_claimer.user_directory import user_directory
+
+
+class Command(BaseCommand):
+    help = "Adds up every cover and payment again to rebuild the balances between users, or checks them with --verify."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--verify", action="store_true", help="Report wrong balances without rebuilding them")
+
+    def handle(self, *args, **options):
+        if options["verify"]:
+            differences = ledger_differences()
+            for user_a, user_b, expected, stored in differences:
+                self.stderr.write("{} owes {} ${} but the ledger has ${}".format(
+                    self.name_of(user_b), self.name_of(user_a), self.dollars(expected), self.dollars(stored)))
+            if differences:
+                raise CommandError("{} balances are wrong, run rebuild_ledger to fix them".format(len(differences)))
+            self.stdout.write("Every balance is right")
+        else:
+            self.stdout.write("Rebuilt {} balances".format(rebuild_ledger()))
+
+    @staticmethod
+    def name_of(user_id):
+        user = user_directory.get(user_id)
+        return user.name if user else "Deleted user {}".format(user_id)
+
+    @staticmethod
+    def dollars(cents):
+        return Decimal(cents).scaleb(-2)
@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date as Date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from cost_claimer.database import retry_when_locked
+from cost_claimer.models import Cover, Receipt
+from cost_claimer.review_lobby import user_amounts
+from cost_claimer.splits import ReceiptItems, calculate_shares, save_covers
+from cost_claimer.user_directory import user_directory
+
+
+def calculate_chunk(receipts):
+    # Runs in the worker processes. Returns the shares of every buyer bit of each receipt.
+    return [(receipt.date, calculate_shares(ReceiptItems(receipt))) for receipt in receipts]
+
+
+class Command(BaseCommand):
+    help = "Recalculates the covers of past receipts, like the end of a review does, after the way splits work changes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="First receipt date (YYYY-MM-DD) to recalculate, defaults to the first")
+        parser.add_argument("--until", help="Last receipt date (YYYY-MM-DD) to recalculate, defaults to the last")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Processes to calculate shares in, defaults to one per CPU")
+        parser.add_argument("--chunk-size", type=int, default=50,
+                            help="Receipts sent to a worker at a time and saved in one transaction")
+        parser.add_argument("--dry-run", action="store_true", help="Report covers that would change without saving")
+
+    def handle(self, *args, **options):
+        receipts = Receipt.objects.order_by("date")
+        try:
+            if options["since"]:
+                receipts = receipts.filter(date__gte=Date.fromisoformat(options["since"]))
+            if options["until"]:
+                receipts = receipts.filter(date__lte=Date.fromisoformat(options["until"]))
+        except ValueError as error:
+            raise CommandError(error)
+        receipts = list(receipts)
+        size = max(1, options["chunk_size"])
+        chunks = [receipts[start:start + size] for start in range(0, len(receipts), size)]
+
+        start = time.perf_counter()
+        changed_receipts, changed_covers = 0, 0
+        for chunk, shares in zip(chunks, self.calculate(chunks, options["workers"])):
+            shares = dict(shares)
+            stored = {receipt.date: {} for receipt in chunk}
+            for receipt_date, user_id, amount in Cover.objects.filter(transaction__in=chunk).values_list(
+                    "transaction", "user", "amount"):
+                stored[receipt_date][user_id] = amount
+            changes = {receipt.date: self.cover_changes(receipt, stored[receipt.date], shares[receipt.date])
+                       for receipt in chunk}
+            for receipt in chunk:
+                for user_id, (old, new) in changes[receipt.date].items():
+                    self.stdout.write("{} {}: {} -> {}".format(
+                        receipt.date, user_directory.get(user_id).name, old or "none", new or "none"))
+            changed = [receipt for receipt in chunk if changes[receipt.date]]
+            changed_receipts += len(changed)
+            changed_covers += sum(len(changes[receipt.date]) for receipt in changed)
+            if not options["dry_run"]:
+                self.save_chunk(changed, shares)
+        seconds = time.perf_counter() - start
+
+        self.stdout.write("{} {} covers on {} of {} receipts in {:.2f}s ({:.0f} receipts/s)".format(
+            "Would change" if options["dry_run"] else "Changed", changed_covers, changed_receipts, len(receipts),
+            seconds, len(receipts) / seconds if seconds else 0))
+
+    @staticmethod
+    def calculate(chunks, workers):
+        """
+        Yields the shares of every chunk in order, from worker processes if there's more than one worker.
+        """
+        # Workers are forked so they get Django already set up. They can't see in-memory databases.
+        if workers <= 1 or len(chunks) <= 1 or connection.is_in_memory_db() or \
+                "fork" not in multiprocessing.get_all_start_methods():
+            yield from map(calculate_chunk, chunks)
+            return
+        # Forked workers shouldn't share the parent's database connection.
+        connections.close_all()
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            yield from executor.map(calculate_chunk, chunks)
+
+    @staticmethod
+    def cover_changes(receipt, stored, shares):
+        """
+        Returns {user id: (stored amount, recalculated amount)} for the receipt's covers that would change.
+        None stands for no cover. The payer's own cover is left alone, like recalculate_receipt leaves it.
+        """
+        amounts = user_amounts(shares)
+        user_ids = (stored.keys() | amounts.keys()) - {receipt.payer_id}
+        return {user_id: (stored.get(user_id), amounts.get(user_id)) for user_id in sorted(user_ids)
+                if stored.get(user_id) != amounts.get(user_id)}
+
+    @staticmethod
+    @retry_when_locked
+    def save_chunk(receipts, shares):
+        for receipt in receipts:
+            save_covers(receipt, user_directory.get(receipt.payer_id), user_amounts(shares[receipt.date]))
@@ -0,0 +1,45 @@
+import signal
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+from cost_claimer.shards import worker_channels
+
+
+class Command(BaseCommand):
+    help = ("Starts a worker process for every user_action shard (COST_CLAIMER_WORKER_SHARDS, which the server must "
+            "be started with too) and stops them all together.")
+
+    def handle(self, *args, **options):
+        channels = worker_channels()
+        # Workers get the same settings from the environment this was started with.
+        workers = [subprocess.Popen([sys.executable, sys.argv[0], "runworker", channel]) for channel in channels]
+        self.stdout.write("Started {} worker{} for {}".format(
+            len(workers), "" if len(workers) == 1 else "s", ", ".join(channels)))
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            # If a worker stops on its own, its sessions have nowhere to go, so stop the rest too.
+            while all(worker.poll() is None for worker in workers):
+                try:
+                    workers[0].wait(1)
+                except subprocess.TimeoutExpired:
+                    pass
+            failed = [channel for channel, worker in zip(channels, workers) if worker.poll() is not None]
+            self.stderr.write("Worker for {} stopped, stopping the others".format(", ".join(failed)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.send_signal(signal.SIGINT)
+            for worker in workers:
+                try:
+                    worker.wait(10)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+        self.stdout.write("Stopped every worker")
@@ -1,6 +1,49 @@
 from decimal import Decimal
 
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+
+
+def iter_bits(bitset):
+    """
+    Yields the position of every set bit, lowest first. Only loops once per set bit, however wide the bitset is.
+    """
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+def make_bitset(bits):
+    bitset = 0
+    for bit in bits:
+        bitset |= 1 << bit
+    return bitset
+
+
+class BitSetField(models.TextField):
+    """
+    A non-negative integer of any width, stored as its decimal string since database integers stop at 64 bits.
+    Integer columns converted to this keep their values, so old bitmasks read back unchanged.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else int(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, int):
+            return value
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValidationError("'%(value)s' must be a whole number.", code="invalid", params={"value": value})
+        if value < 0:
+            raise ValidationError("'%(value)s' can't be negative.", code="invalid", params={"value": value})
+        return value
+
+    def get_prep_value(self, value):
+        value = self.to_python(value)
+        return None if value is None else str(value)
 
 
 class User(models.Model):
@@ -8,21 +51,57 @@ class User(models.Model):
     # Passwords are NOT SECURED
     password = models.CharField(max_length=32, default=None, blank=True, null=True)
     name = models.CharField(max_length=16)
-    # Bit Flag for this user
-    buy_indexes = [
-        (1, "Roommate 1"),
-        (2, "Roommate 2"),
-        (4, "Roommate 3"),
-        (8, "Roommate 4"),
-        (16, "Roommate 5"),
-        (32, "Roommate 6"),
-        (64, "Roommate 7"),
-        (128, "Roommate 8"),
-    ]
-    buy_index = models.PositiveIntegerField(primary_key=True, choices=buy_indexes, default=0)
+    # Id of this user. It used to be this user's bit flag, so older users have powers of two.
+    buy_index = models.PositiveIntegerField(primary_key=True, default=0)
+    # Position of this user's bit in Item.buyers, filled in on the first save.
+    bit = models.PositiveIntegerField(unique=True, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Logging in looks users up by username. Not unique since users made in the admin site may share one.
+            models.Index(fields=["username"], name="user_username_idx"),
+        ]
 
     def __str__(self):
-        return "{} ({})".format(self.name, self.get_buy_index_display())
+        return "{} ({})".format(self.name, self.label)
+
+    @property
+    def label(self):
+        return "Roommate {}".format(self.bit + 1) if self.bit is not None else "New Roommate"
+
+    @staticmethod
+    def legacy_bit(buy_index):
+        # Users from before bits were stored keep the bit that their buy_index was a flag for.
+        if buy_index and buy_index & (buy_index - 1) == 0:
+            return buy_index.bit_length() - 1
+        return None
+
+    def assign_bit(self):
+        """
+        Picks a bit no other user has, preferring the one this user's old bit flag used.
+        Bits above every taken one are used otherwise. Bits still on items count as taken, so the items of deleted users
+        don't become a new user's purchases.
+        """
+        taken = set()
+        for buy_index, bit in User.objects.exclude(buy_index=self.buy_index).values_list("buy_index", "bit"):
+            taken.add(bit if bit is not None else User.legacy_bit(buy_index))
+        taken.discard(None)
+        bought = 0
+        for buyers in Item.objects.exclude(buyers=0).values_list("buyers", flat=True).distinct():
+            bought |= buyers
+        legacy = User.legacy_bit(self.buy_index)
+        # Users from before bits were stored bought their items with their old bit, but new users didn't buy anything.
+        if legacy is not None and legacy not in taken and not (self._state.adding and bought >> legacy & 1):
+            self.bit = legacy
+        else:
+            self.bit = max(max(taken, default=-1), bought.bit_length() - 1) + 1
+
+    def save(self, *args, **kwargs):
+        if not self.buy_index:
+            self.buy_index = (User.objects.aggregate(models.Max("buy_index"))["buy_index__max"] or 0) + 1
+        if self.bit is None:
+            self.assign_bit()
+        super().save(*args, **kwargs)
 
 
 class Receipt(models.Model):
@@ -41,42 +120,144 @@ class Item(models.Model):
     name = models.CharField(max_length=192)
     count = models.PositiveIntegerField(default=0)
     price = models.DecimalField(max_digits=5, decimal_places=2)
-    receipt = models.ForeignKey(Receipt, on_delete=models.CASCADE)
+    # Indexed by unique_item_name first
+    receipt = models.ForeignKey(Receipt, on_delete=models.CASCADE, db_index=False)
     imgSrc = models.CharField(max_length=192)
     taxed = models.BooleanField(default=False)
-    buyers = models.PositiveIntegerField(default=0)
+    # Bit set of the User.bit of everyone who bought this item
+    buyers = BitSetField(default=0)
+
+    class Meta:
+        constraints = [
+            # Uploads skip items whose name the receipt already has, and every item query starts from its receipt.
+            models.UniqueConstraint(fields=["receipt", "name"], name="unique_item_name"),
+        ]
 
     def join_buyers(self):
-        return ", ".join([buyNames[1] for buyNames in User.buy_indexes if self.buyers & buyNames[0]])
+        return ", ".join(["Roommate {}".format(bit + 1) for bit in iter_bits(self.buyers)])
 
-    def get_buyer_set(self):
-        return {buy_index[0] for buy_index in User.buy_indexes if self.buyers & buy_index[0]}
+    def get_buyer_bits(self):
+        return list(iter_bits(self.buyers))
 
     def makeURL(self):
         return "static/receipt_items/{}/{}".format(self.receipt.date, self.imgSrc)
 
+    def makeThumbnailURL(self, size):
+        return "cost_claimer/thumbnail/{}/{}/{}".format(size, self.receipt.date, self.imgSrc)
+
     def __str__(self):
         return "{} x {} bought on {} for ${}".format(self.count, self.name, self.receipt.date, self.price)
 
 
-class Cover(models.Model):
-    transaction = models.ForeignKey(Receipt, on_delete=models.CASCADE, blank=True, null=True)
-    transaction_payer = models.ForeignKey(User, on_delete=models.CASCADE, related_name="coverer")
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="coveree")
+def to_cents(amount):
+    return int(Decimal(str(amount)).scaleb(2))
+
+
+class LedgerEntry(object):
+    """
+    Covers and payments are money between two users, which Balance keeps running totals of (see ledger.py).
+    Rows remember what they were when loaded, so that changing or deleting them can take that back out of the total.
+    """
+    # 1 when the amount is owed to transaction_payer by user, -1 when it's money user paid back.
+    ledger_sign = 1
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        deferred = instance.get_deferred_fields()
+        instance.loaded_entry = None if {"transaction_payer_id", "user_id", "amount"} & deferred \
+            else instance.ledger_entry()
+        return instance
+
+    def ledger_entry(self):
+        # (id of the user owed, id of the user owing, cents owed)
+        return self.transaction_payer_id, self.user_id, self.ledger_sign * to_cents(self.amount)
+
+    def save(self, *args, **kwargs):
+        # Balances are updated by the post_save signal, which has to commit or roll back along with the row.
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+
+
+class Cover(LedgerEntry, models.Model):
+    # The foreign keys are indexed by the constraints and indexes below instead of on their own.
+    transaction = models.ForeignKey(Receipt, on_delete=models.CASCADE, blank=True, null=True, db_index=False)
+    transaction_payer = models.ForeignKey(User, on_delete=models.CASCADE, related_name="coverer", db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="coveree", db_index=False)
     amount = models.DecimalField(max_digits=5, decimal_places=2)
 
     quantizer = Decimal("0.01")
 
+    class Meta:
+        constraints = [
+            # Recalculating a receipt keeps one cover per user for it.
+            models.UniqueConstraint(fields=["transaction", "user"], name="unique_cover_user"),
+        ]
+        indexes = [
+            # Balances read (other user, amount) for everything one user covered or was covered by.
+            # Including the amount lets those be answered from the index alone.
+            models.Index(fields=["transaction_payer", "user", "amount"], name="cover_payer_idx"),
+            models.Index(fields=["user", "transaction_payer", "amount"], name="cover_user_idx"),
+        ]
+
     def __str__(self):
         return "{} covered {} ${}".format(self.transaction_payer.name, self.user.name, self.amount)
 
 
-class Payment(models.Model):
+class Payment(LedgerEntry, models.Model):
     transaction = models.ForeignKey(Receipt, on_delete=models.CASCADE, blank=True, null=True)
-    transaction_payer = models.ForeignKey(User, on_delete=models.CASCADE, related_name="payee")
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="payer")
+    # Indexed by the indexes below instead of on their own
+    transaction_payer = models.ForeignKey(User, on_delete=models.CASCADE, related_name="payee", db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="payer", db_index=False)
     amount = models.DecimalField(max_digits=5, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            # Same as the Cover indexes, for balances
+            models.Index(fields=["transaction_payer", "user", "amount"], name="payment_payer_idx"),
+            models.Index(fields=["user", "transaction_payer", "amount"], name="payment_user_idx"),
+        ]
+
+    ledger_sign = -1
+
     def __str__(self):
         return "{} paid {} ${}".format(self.user.name, self.transaction_payer.name, self.amount)
 
+
+class Balance(models.Model):
+    # Net of every cover and payment between two users: what user_b owes user_a (negative if user_a owes user_b).
+    # One row per pair, with user_a the lower id. Kept up to date by ledger.py and rebuilt by rebuild_ledger.
+    # Users' rows are deleted by a signal after their covers and payments are, so there's no database constraint.
+    user_a = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name="+", db_constraint=False,
+                               db_index=False)
+    user_b = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name="+", db_constraint=False,
+                               db_index=False)
+    # Whole cents, so adding to it in the database stays exact
+    cents = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user_a", "user_b"], name="unique_balance_pair"),
+        ]
+        indexes = [
+            # With the constraint's index, a user's balances are found by index whichever side of the pair they're on.
+            models.Index(fields=["user_b", "user_a", "cents"], name="balance_user_b_idx"),
+        ]
+
+    @property
+    def amount(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __str__(self):
+        return "{} owes {} ${}".format(self.user_b.name, self.user_a.name, self.amount)
+
+
+class CacheVersion(models.Model):
+    # Counters that are bumped whenever the rows behind a cached response change.
+    # They live in the database so the server and the worker see each other's changes.
+    key = models.CharField(max_length=64, primary_key=True)
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{} (version {})".format(self.key, self.version)
@@ -0,0 +1,24 @@
+import hashlib
+
+from django.core.cache import cache
+
+from .cache_versions import get_versions
+
+# Entries are keyed by version so they never go stale, this only bounds how long unused ones stick around.
+RESPONSE_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def cached_data(name, version_keys, build):
+    """
+    Returns build(), cached under name and the current versions of version_keys.
+    The versions are read before building so a change made in between can't be cached as current.
+    """
+    versions = get_versions(version_keys)
+    digest = hashlib.sha1(":".join([name] + [versions[key] for key in version_keys]).encode()).hexdigest()
+    cache_key = "response:{}".format(digest)
+    cached = cache.get(cache_key)
+    if cached is None:
+        # Wrapped so that None can be cached too.
+        cached = (build(),)
+        cache.set(cache_key, cached, RESPONSE_CACHE_TIMEOUT)
+    return cached[0]
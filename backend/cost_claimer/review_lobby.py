@@ -1,268 +1,547 @@
-from threading import Timer
+import logging
+import math
+import time
 from functools import wraps
-from collections import defaultdict
-from decimal import Decimal, ROUND_UP
+from uuid import uuid4
 
 from django.core.exceptions import ValidationError
 from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 
-from .models import Receipt, Item, User, Cover
+from .database import retry_when_locked
+from .lobby_store import lobby_store, new_state
+from .models import Receipt, Item, make_bitset
+from .splits import ReceiptItems, RunningShares, calculate_shares, save_covers
+from .scheduler import lobby_scheduler
 from .serializers import ItemSerializer, UserSerializer
+from .user_directory import user_directory
 
+# Thumbnail size that lobby clients are sent for the item being reviewed
+LOBBY_IMAGE_SIZE = "medium"
 
-# Placeholder for random things before they are initialized with real values.
-class _Placeholder:
-    buyers = None
-    id = None
+# Seconds that lobbies count down before moving on, and after an item is claimed
+COUNTDOWN_SECONDS = 5
+CLAIM_COUNTDOWN_SECONDS = 2
 
-    @staticmethod
-    def cancel():
-        pass
+# Items after the current one whose images clients are told to start loading
+PRELOAD_ITEMS = 2
 
-    @staticmethod
-    def save():
-        pass
+# Seconds past the end of a countdown before a worker finishes it for the worker that started it, which must be gone
+TAKEOVER_SECONDS = 2
+# Seconds between each worker's checks for countdowns like that
+SWEEP_SECONDS = 5
+
+# Format of the lobby_delta frames that updates from one lobby action are sent to clients in together
+LOBBY_DELTA_VERSION = 1
+
+# Whether lobbies recalculate the whole receipt after every item to check their running shares against
+VERIFY_RUNNING_SHARES = False
 
 
 def require_lock(func):
+    # Lobbies are changed by the worker and by countdowns on the scheduler thread, which holds this lock for those.
+    # There is one lock for the whole process, so it also serializes the database writes of every lobby, not just
+    # the changes to one.
     @wraps(func)
-    def func_requiring_lock(self, *args):
-        with self._lock:
-            return func(self, *args)
+    def func_requiring_lock(*args, **kwargs):
+        with lobby_scheduler.lock:
+            return func(*args, **kwargs)
 
     return func_requiring_lock
 
 
+def sends_updates(func):
+    # Lobby updates sent while func runs go to clients together when it's done, instead of a message each.
+    @wraps(func)
+    def func_sending_updates(self, *args, **kwargs):
+        self.update_depth += 1
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.update_depth -= 1
+            if not self.update_depth:
+                self.flush_updates()
+
+    return func_sending_updates
+
+
+def user_amounts(shares):
+    # Bits of deleted users still take their share, it just isn't covered by anyone.
+    return {user_directory.by_bit(bit).buy_index: amount for bit, amount in shares.items()
+            if user_directory.by_bit(bit)}
+
+
+@retry_when_locked
 def recalculate_receipt(receipt):
-    items = Item.objects.filter(receipt=receipt, buyers__gt=0)
-    tax_rate = receipt.tax_rate + 1
-    amounts = defaultdict(lambda: Decimal("0.00"))
-    for item in items:
-        buyers = [buy_index for buy_index, _ in User.buy_indexes if item.buyers & buy_index]
-        item_cost = item.count * item.price
-        if item.taxed:
-            item_cost *= tax_rate
-        share = item_cost / len(buyers)
-        for buyer in buyers:
-            amounts[buyer] += share
-    amounts = {user: amount.quantize(Cover.quantizer, rounding=ROUND_UP) for user, amount in amounts.items()}
-    users = User.objects.all()
-    for user in users:
-        if user != receipt.payer:
-            cover = Cover.objects.filter(transaction=receipt, user=user).first()
-            if cover:
-                if user.buy_index in amounts:
-                    cover.amount = amounts[user.buy_index]
-                    cover.save()
-                else:
-                    cover.delete()
-            elif user.buy_index in amounts:
-                Cover(transaction=receipt, transaction_payer=receipt.payer,
-                      user=user, amount=amounts[user.buy_index]).save()
+    amounts = user_amounts(calculate_shares(ReceiptItems(receipt)))
+    save_covers(receipt, user_directory.get(receipt.payer_id), amounts)
     return amounts
 
 
 class GroupLobbyOrganizer(object):
+    # This process's handles on lobbies. What's going on in each lobby is kept in the lobby store.
     _lobbies = {}
+    _sweeping = False
 
     @classmethod
+    @require_lock
     def get_lobby(cls, receipt_date, channel_layer):
         if receipt_date in cls._lobbies:
-            return cls._lobbies[receipt_date]
-        try:
-            receipt = Receipt.objects.filter(date=receipt_date).first()
-        except ValidationError:
-            return None
-        if receipt:
-            newLobby = cls.Lobby(channel_layer, receipt)
-            cls._lobbies[receipt_date] = newLobby
-            return newLobby
-        return None
+            lobby = cls._lobbies[receipt_date]
+        else:
+            try:
+                receipt = Receipt.objects.filter(date=receipt_date).first()
+            except ValidationError:
+                return None
+            if not receipt:
+                return None
+            lobby = cls.Lobby(channel_layer, receipt)
+            cls._lobbies[receipt_date] = lobby
+        lobby.take_over()
+        return lobby
 
     @classmethod
     def delete_lobby(cls, receipt_date):
-        cls._lobbies.pop(receipt_date)
+        cls._lobbies.pop(receipt_date, None)
+
+    @classmethod
+    def start_sweeping(cls):
+        """
+        Starts finishing countdowns that other workers left behind, every SWEEP_SECONDS, once per process.
+        Lobbies only outlive their worker in a shared lobby store.
+        """
+        if lobby_store.shared and not cls._sweeping:
+            cls._sweeping = True
+            lobby_scheduler.call_later(SWEEP_SECONDS, cls.sweep)
+
+    @classmethod
+    def sweep(cls):
+        try:
+            cls.finish_overdue_countdowns(get_channel_layer())
+        except Exception:
+            logging.exception("Sweeping lobbies failed")
+        lobby_scheduler.call_later(SWEEP_SECONDS, cls.sweep)
+
+    @classmethod
+    def finish_overdue_countdowns(cls, channel_layer):
+        for receipt_date in lobby_store.overdue(time.time() - TAKEOVER_SECONDS):
+            # Getting a lobby takes over its countdown if it's overdue.
+            cls.get_lobby(receipt_date, channel_layer)
 
     # This class is nested because Lobbies should be obtained from the Organizer and not made on their own.
     class Lobby(object):
+        """
+        A worker's handle on a lobby. Changes go through lobby_store transitions, and the messages, saves and timers
+        that follow from them happen once the transition is saved, so any worker can handle any lobby.
+        """
 
         def __init__(self, channel_layer, receipt):
             self.channel_layer = channel_layer
             self.receipt = receipt
             self.receipt_date = str(receipt.date)
-            self.all_users = set()
-            self.active_users = set()
-            self.exclusive_active_user = None
-            self.ticks = 5
-            self.timer = _Placeholder
-            self.on_tick_finish = self.start_item_viewing
-            self.tick_condition = lambda: len(self.active_users) == len(self.all_users)
+            # Scheduler handles for the countdown this worker started
+            self.timers = []
+            # The review that the items, their serialized forms and the running shares were loaded for, and the item
+            # this worker last moved the lobby on to. If another worker moved it since, they're out of date.
+            self.review = None
+            self.item_index = None
             self.items = []
-            self.item_iter = None
-            self.item = _Placeholder
-
-        def is_counting_down(self):
-            return self.ticks < 5
-
-        def has_viewing_started(self):
-            return self.on_tick_finish != self.start_item_viewing
-
+            self.serialized_items = []
+            # Shares of the receipt's buyers as items are reviewed, so covers are updated one item at a time
+            self.running_shares = None
+            self.verify_shares = VERIFY_RUNNING_SHARES
+            # Updates waiting to be sent, and how many sends_updates calls deep this lobby is
+            self.pending_updates = []
+            self.update_depth = 0
+
+        def get_state(self):
+            return lobby_store.get(self.receipt_date)
+
+        def transition(self, func):
+            return lobby_store.transition(self.receipt_date, func)
+
+        @require_lock
+        @sends_updates
         def add_user(self, user):
-            user_id = user.buy_index
-            self.all_users.add(user_id)
-            self.update_users()
-
+            def add(state):
+                new_lobby = state is None
+                state = state or new_state()
+                state["all_users"] = sorted(set(state["all_users"]) | {user.buy_index})
+                return state, (new_lobby, dict(state), self.check_countdown(state))
+
+            new_lobby, state, countdown = self.transition(add)
+            if new_lobby:
+                # Anything this worker remembers is from a lobby that has since finished.
+                self.cancel_countdown()
+                self.review = None
+                self.running_shares = None
+            self.update_users(state, countdown)
+
+        @require_lock
         def get_current_state(self):
+            state = self.get_state() or new_state()
+            exclusive_user = user_directory.get(state["exclusive_user"]) if state["exclusive_user"] else None
+            item, preload = None, []
+            if state["viewing"] and state["item_index"] >= 0:
+                self.load_review(state["review"])
+                item, preload = self.serialized_items[state["item_index"]], self.preload_sources(state["item_index"])
             return {
-                "all_users": list(self.all_users),
-                "active_users": list(self.active_users),
-                "exclusive_active_user":
-                    None if self.exclusive_active_user is None else UserSerializer(self.exclusive_active_user).data,
-                "time": self.ticks + 1 if self.is_counting_down() else None,
-                "item": ItemSerializer(self.item).data if self.has_viewing_started() else None,
+                "all_users": state["all_users"],
+                "active_users": state["active_users"],
+                "exclusive_active_user": None if exclusive_user is None else UserSerializer(exclusive_user).data,
+                "time": self.time_left(state["deadline"]) if state["deadline"] else None,
+                "item": item,
+                "preload": preload,
             }
 
+        def serialize_item(self, item):
+            return ItemSerializer(item, context={"image_size": LOBBY_IMAGE_SIZE}).data
+
+        @staticmethod
+        def time_left(deadline):
+            return max(1, math.ceil(deadline - time.time()))
+
+        @require_lock
+        @sends_updates
         def remove_user(self, user):
-            user_id = user.buy_index
-            self.all_users.discard(user_id)
-            if len(self.all_users) > 0:
-                if not self.has_viewing_started():
-                    self.active_users.discard(user_id)
-                self.update_users()
+            def remove(state):
+                if state is None:
+                    return None, None
+                state["all_users"] = [user_id for user_id in state["all_users"] if user_id != user.buy_index]
+                if not state["all_users"]:
+                    return None, (None, None)
+                if not state["viewing"]:
+                    state["active_users"] = [user_id for user_id in state["active_users"] if user_id != user.buy_index]
+                return state, (dict(state), self.check_countdown(state))
+
+            result = self.transition(remove)
+            if result is None:
+                return
+            state, countdown = result
+            if state is not None:
+                self.update_users(state, countdown)
             else:
                 GroupLobbyOrganizer.delete_lobby(self.receipt_date)
-                self.timer.cancel()
-                if self.has_viewing_started:
-                    recalculate_receipt(self.receipt)
-
+                self.cancel_countdown()
+                self.final_shares()
+
+        def change_active_users(self, change):
+            def update(state):
+                if state is None or state["exclusive_user"] is not None:
+                    return state, None
+                state["active_users"] = sorted(change(set(state["active_users"])))
+                return state, (dict(state), self.check_countdown(state))
+
+            result = self.transition(update)
+            if result is not None:
+                self.update_users(*result)
+
+        @require_lock
+        @sends_updates
         def activate_user(self, user):
-            if self.exclusive_active_user is None:
-                self.active_users.add(user.buy_index)
-                self.update_users()
+            self.change_active_users(lambda active_users: active_users | {user.buy_index})
 
+        @require_lock
+        @sends_updates
         def deactivate_user(self, user):
-            if self.exclusive_active_user is None:
-                self.active_users.discard(user.buy_index)
-                self.update_users()
+            self.change_active_users(lambda active_users: active_users - {user.buy_index})
 
+        @require_lock
+        @sends_updates
         def activate_exclusive_user(self, user, item_id):
-            if self.exclusive_active_user is None and self.item.id == item_id:
-                self.timer.cancel()
-                self.exclusive_active_user = user
-                self.active_users = {user.buy_index}
-                async_to_sync(self.channel_layer.group_send)(
-                    self.receipt_date,
-                    {
-                        "type": "lobby_update",
-                        "update": {
-                            "type": "lobby_item_claim",
-                            "user": UserSerializer(user).data,
-                        }
-                    }
-                )
-                self.ticks = 2
-                self.tick()
-
-        def update_users(self):
-            self.check_tick()
-            async_to_sync(self.channel_layer.group_send)(
-                self.receipt_date,
-                {
-                    "type": "lobby_update",
-                    "update": {
-                        "type": "lobby_user_change",
-                        "all_users": list(self.all_users),
-                        "active_users": list(self.active_users),
-                    }
-                }
-            )
+            state = self.get_state()
+            if state is None or not state["viewing"]:
+                return
+            review = state["review"]
+            self.load_review(review)
+            items = self.items
+
+            def claim(state):
+                if state is None or state["exclusive_user"] is not None or state["review"] != review or \
+                        not 0 <= state["item_index"] < len(items) or items[state["item_index"]].id != item_id:
+                    return state, None
+                state["exclusive_user"] = user.buy_index
+                state["active_users"] = [user.buy_index]
+                state["deadline"] = time.time() + CLAIM_COUNTDOWN_SECONDS
+                return state, state["deadline"]
+
+            deadline = self.transition(claim)
+            if deadline is None:
+                return
+            self.cancel_countdown()
+            self.send_update({
+                "type": "lobby_item_claim",
+                "user": UserSerializer(user).data,
+            })
+            self.start_countdown(deadline)
+
+        def update_users(self, state, countdown):
+            self.apply_countdown(countdown)
+            self.send_update({
+                "type": "lobby_user_change",
+                "all_users": state["all_users"],
+                "active_users": state["active_users"],
+            })
 
         def send_time(self, time):
+            self.send_update({
+                "type": "lobby_time_change",
+                "time": time,
+            })
+
+        def send_update(self, update):
+            # A later update of the same type sets everything an earlier one did, so only the latest is kept.
+            self.pending_updates = [pending for pending in self.pending_updates if pending["type"] != update["type"]]
+            self.pending_updates.append(update)
+            if not self.update_depth:
+                self.flush_updates()
+
+        def flush_updates(self):
+            """
+            Sends the pending updates to the lobby's clients in one message, a lobby_delta if there's more than one.
+            Clients apply a delta's updates in order, like separate messages.
+            """
+            updates, self.pending_updates = self.pending_updates, []
+            if not updates:
+                return
+            if len(updates) > 1:
+                updates = [{"type": "lobby_delta", "version": LOBBY_DELTA_VERSION, "updates": updates}]
             async_to_sync(self.channel_layer.group_send)(
                 self.receipt_date,
                 {
                     "type": "lobby_update",
-                    "update": {
-                        "type": "lobby_time_change",
-                        "time": time,
-                    }
+                    "update": updates[0],
                 }
             )
 
-        def tick(self):
-            # If the countdown isn't finished, keep counting down.
-            if self.ticks > 0:
-                self.timer = Timer(1, self.tick)
-                self.timer.start()
-                self.send_time(self.ticks)
-                self.ticks -= 1
-            # If the countdown is finished, start looking at items.
+        @staticmethod
+        def check_countdown(state):
+            """
+            Starts or stops the state's countdown if whether it should be running changed. Called in transitions, so
+            it only changes the state. Returns what apply_countdown should do about it once the state is saved.
+            """
+            # Before viewing, everyone has to be ready. After, someone has to have bought the item.
+            if state["viewing"]:
+                ready = len(state["active_users"]) > 0
+            else:
+                ready = len(state["active_users"]) == len(state["all_users"])
+            if ready and state["deadline"] is None:
+                state["deadline"] = time.time() + COUNTDOWN_SECONDS
+                return "start", state["deadline"]
+            if not ready and state["deadline"] is not None:
+                state["deadline"] = None
+                return "stop", None
+            return None
+
+        def apply_countdown(self, countdown):
+            if countdown is None:
+                return
+            action, deadline = countdown
+            if action == "start":
+                self.start_countdown(deadline)
             else:
-                self.ticks = 5
-                self.on_tick_finish()
-
-        def check_tick(self):
-            # If the tick condition is met, start the countdown.
-            if self.tick_condition():
-                if not self.is_counting_down():
-                    self.tick()
-            # Otherwise, if the countdown is active then stop it.
-            elif self.is_counting_down():
-                self.timer.cancel()
-                self.ticks = 5
+                self.cancel_countdown()
                 self.send_time(None)
 
+        def start_countdown(self, deadline):
+            """
+            Sends the time left every second until deadline (a time.time()), then finishes the countdown.
+            """
+            self.cancel_countdown()
+            seconds = self.time_left(deadline)
+            self.send_time(seconds)
+            # The scheduler runs on time.monotonic(), which doesn't jump when the clock is changed.
+            offset = time.monotonic() - time.time()
+            for time_left in range(seconds - 1, 0, -1):
+                timer = lobby_scheduler.call_at(deadline - time_left + offset, self.tick, deadline, time_left)
+                self.timers.append(timer)
+            self.timers.append(lobby_scheduler.call_at(deadline + offset, self.finish_countdown, deadline))
+
+        def cancel_countdown(self):
+            for timer in self.timers:
+                timer.cancel()
+            self.timers = []
+
+        @sends_updates
+        def tick(self, deadline, time_left):
+            # Another worker could have stopped the countdown.
+            state = self.get_state()
+            if state and state["deadline"] == deadline:
+                self.send_time(time_left)
+
+        @sends_updates
+        def finish_countdown(self, deadline):
+            def finish(state):
+                if state is None or state["deadline"] != deadline:
+                    return state, None
+                state["deadline"] = None
+                return state, state["viewing"]
+
+            viewing = self.transition(finish)
+            self.timers = []
+            if viewing is None:
+                return
+            if viewing:
+                self.view_next_item()
+            else:
+                self.start_item_viewing()
+
+        @require_lock
+        def take_over(self):
+            """
+            Finishes the lobby's countdown if the worker that started it has been gone for a while.
+            """
+            state = self.get_state()
+            if state and state["deadline"] and not self.timers and time.time() > state["deadline"] + TAKEOVER_SECONDS:
+                self.finish_countdown(state["deadline"])
+
+        def load_review(self, review, item_index=None):
+            """
+            Loads the receipt's items in review order, along with what clients are sent for each of them and the
+            running shares, if they weren't already loaded for this review. Moving on from an item passes its index,
+            so they're also loaded again if another worker moved the lobby on to that item and saved the one before.
+            """
+            if review == self.review and item_index in (None, self.item_index):
+                return
+            self.items = list(Item.objects.filter(receipt=self.receipt).order_by("id"))
+            for item in self.items:
+                # Item links have the receipt's date in them.
+                item.receipt = self.receipt
+            self.serialized_items = [self.serialize_item(item) for item in self.items]
+            # If another worker started the review, it has saved covers for every item up to the current one.
+            self.running_shares = RunningShares(self.receipt)
+            self.review = review
+            self.item_index = item_index
+
+        def preload_sources(self, index):
+            return [item["src"] for item in self.serialized_items[index + 1:index + 1 + PRELOAD_ITEMS] if item["src"]]
+
+        @require_lock
+        @sends_updates
         def start_item_viewing(self):
-            self.tick_condition = lambda: len(self.active_users) > 0
-            self.on_tick_finish = self.view_next_item
-            self.items = Item.objects.filter(receipt=self.receipt)
-            self.item_iter = iter(list(self.items))
-            self.view_next_item()
-
-        def update_item(self):
-            buyers = 0
-            for buy_index in self.active_users:
-                buyers += buy_index
-            self.item.buyers = buyers
-            self.item.save()
-
+            review = uuid4().hex
+            self.load_review(review)
+            # Covers start out matching the items, then only the buyers of each reviewed item have theirs changed.
+            self.save_shares(None)
+
+            def start(state):
+                if state is None:
+                    return None, False
+                state.update(viewing=True, review=review, item_index=-1, exclusive_user=None)
+                return state, True
+
+            if self.transition(start):
+                self.item_index = -1
+                self.view_next_item()
+
+        def update_item(self, index, active_users):
+            item = self.items[index]
+            # Users deleted while the lobby was open have no bit to set.
+            item.buyers = make_bitset(user.bit for user in map(user_directory.get, active_users) if user)
+            changed_bits = set()
+            if self.running_shares is not None and item.id in self.running_shares:
+                changed_bits = self.running_shares.set_buyers(item.id, item.buyers)
+            self.save_item(item, changed_bits)
+            self.serialized_items[index] = self.serialize_item(item)
+
+        @retry_when_locked
+        def save_item(self, item, changed_bits):
+            item.save()
+            if changed_bits:
+                self.save_shares(changed_bits)
+
+        @retry_when_locked
+        def save_shares(self, bits):
+            """
+            Saves the covers of the given buyer bits (or all of them) from the running shares.
+            """
+            amounts = user_amounts(self.running_shares.shares(bits))
+            users = None if bits is None else [user.buy_index for user in map(user_directory.by_bit, bits) if user]
+            save_covers(self.receipt, user_directory.get(self.receipt.payer_id), amounts, users)
+            if self.verify_shares:
+                self.verify_running_shares()
+
+        def verify_running_shares(self):
+            expected = recalculate_receipt(self.receipt)
+            actual = user_amounts(self.running_shares.shares())
+            if actual != expected:
+                logging.error("Running shares of %s were %s instead of %s", self.receipt_date, actual, expected)
+                self.running_shares = RunningShares(self.receipt)
+
+        def final_shares(self):
+            """
+            The shares of the receipt once reviewing is over, recalculated if items weren't being followed.
+            """
+            if self.running_shares is None or self.verify_shares:
+                return recalculate_receipt(self.receipt)
+            return user_amounts(self.running_shares.shares())
+
+        @require_lock
+        @sends_updates
         def view_next_item(self):
-            self.update_item()
-            try:
-                self.item = next(self.item_iter)
-            except StopIteration:
+            state = self.get_state()
+            if state is None:
+                return
+            review, current = state["review"], state["item_index"]
+            self.load_review(review, current)
+
+            def moved_on(state):
+                # Another worker finished the item first.
+                return state is None or state["review"] != review or state["item_index"] != current
+
+            def finish_item(buyers):
+                # Only saved once this worker has moved the lobby on, so a worker that lost the race doesn't change
+                # the buyers of an item the lobby is already past.
+                if current >= 0:
+                    self.update_item(current, buyers)
+
+            index = current + 1
+            if index >= len(self.items):
+                def finish(state):
+                    if moved_on(state):
+                        return state, None
+                    return None, state["active_users"]
+
+                buyers = self.transition(finish)
+                if buyers is None:
+                    return
+                finish_item(buyers)
                 GroupLobbyOrganizer.delete_lobby(self.receipt_date)
+                self.send_update({
+                    "type": "lobby_finished",
+                    "payer": self.receipt.payer_id,
+                    "shares": {str(user): str(amount) for user, amount in self.final_shares().items()},
+                })
+                # Clients stop getting the lobby's messages once it closes.
+                self.flush_updates()
                 async_to_sync(self.channel_layer.group_send)(
                     self.receipt_date,
-                    {
-                        "type": "lobby_update",
-                        "update": {
-                            "type": "lobby_finished",
-                            "payer": self.receipt.payer.buy_index,
-                            "shares": {str(user): str(amount) for user, amount in
-                                       recalculate_receipt(self.receipt).items()},
-                        },
-                    }
-                )
-                async_to_sync(self.channel_layer.send)(
-                    "user_action",
                     {
                         "type": "lobby_close",
-                        "users": [user for user in self.all_users]
+                        "receipt_date": self.receipt_date,
                     }
                 )
                 return
-            self.exclusive_active_user = None
-            self.active_users = self.item.get_buyer_set()
-            async_to_sync(self.channel_layer.group_send)(
-                self.receipt_date,
-                {
-                    "type": "lobby_update",
-                    "update": {
-                        "type": "lobby_item_change",
-                        "item": ItemSerializer(self.item).data,
-                        "active_users": list(self.active_users),
-                    }
-                }
-            )
-            self.update_users()
+            active_users = [user.buy_index for user in user_directory.buyers(self.items[index].buyers)]
+
+            def advance(state):
+                if moved_on(state):
+                    return state, None
+                buyers = state["active_users"]
+                state.update(item_index=index, exclusive_user=None, active_users=active_users, deadline=None)
+                return state, (buyers, dict(state), self.check_countdown(state))
+
+            result = self.transition(advance)
+            if result is None:
+                return
+            self.item_index = index
+            buyers, *result = result
+            finish_item(buyers)
+            self.send_update({
+                "type": "lobby_item_change",
+                "item": self.serialized_items[index],
+                "active_users": active_users,
+                # Clients load the next items' images while this one is reviewed, so they show up right away.
+                "preload": self.preload_sources(index),
+            })
+            self.update_users(*result)
@@ -0,0 +1,78 @@
+"""
+One thread that runs every lobby's countdown, instead of a thread per tick per lobby.
+Timer callbacks hold the scheduler's lock while they run, and so do lobby changes made from the worker
+(see review_lobby.require_lock), so a lobby is only ever changed by one of them at a time.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class TimerHandle(object):
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # Cancelled handles stay queued until they're due, then get skipped.
+        self.cancelled = True
+
+
+class Scheduler(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self._condition = threading.Condition()
+        # Heap of (deadline, order added, handle), so handles due at the same time run in the order they were added
+        self._queue = []
+        self._order = itertools.count()
+        self._thread = None
+        # Callbacks that have run
+        self.runs = 0
+
+    def call_at(self, deadline, func, *args):
+        """
+        Runs func(*args) on the scheduler thread once time.monotonic() reaches deadline. Returns a cancellable handle.
+        """
+        handle = TimerHandle(deadline, func, args)
+        with self._condition:
+            heapq.heappush(self._queue, (deadline, next(self._order), handle))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return handle
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(time.monotonic() + delay, func, *args)
+
+    def _next_due(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._queue and self._queue[0][0] <= now:
+                    return heapq.heappop(self._queue)[2]
+                self._condition.wait(self._queue[0][0] - now if self._queue else None)
+
+    def _run(self):
+        while True:
+            handle = self._next_due()
+            if handle.cancelled:
+                continue
+            self.runs += 1
+            try:
+                with self.lock:
+                    # Cancelled while waiting for the lock
+                    if not handle.cancelled:
+                        handle.func(*handle.args)
+            except Exception:
+                logging.exception("Scheduled call to %s failed", handle.func)
+
+
+lobby_scheduler = Scheduler("lobby-scheduler")
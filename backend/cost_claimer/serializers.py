@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Receipt, Item, User
+from .thumbnails import THUMBNAIL_SIZES
 
 
 class ReceiptSerializer(serializers.ModelSerializer):
@@ -11,12 +12,22 @@ class ReceiptSerializer(serializers.ModelSerializer):
 
 class ItemSerializer(serializers.ModelSerializer):
     buyer_names = serializers.CharField(source="join_buyers")
-    src = serializers.CharField(source="makeURL")
+    src = serializers.SerializerMethodField()
 
     class Meta:
         model = Item
         fields = ("name", "count", "price", "src", "taxed", "buyer_names", "id")
 
+    # Pass an "image_size" from THUMBNAIL_SIZES in the context to link a thumbnail instead of the full image.
+    # Items without an image (like ones read off of paper receipts) have no link.
+    def get_src(self, item):
+        if not item.imgSrc:
+            return None
+        size = self.context.get("image_size")
+        if size in THUMBNAIL_SIZES:
+            return item.makeThumbnailURL(size)
+        return item.makeURL()
+
 
 class UserSerializer(serializers.ModelSerializer):
     user_id = serializers.IntegerField(source="buy_index")
@@ -0,0 +1,50 @@
+"""
+Which worker process handles each session when the worker is split into shards (settings.WORKER_SHARDS).
+Sessions are placed on the shards' channels by consistent hashing on their uuid, so all of a session's messages go to
+one worker in the order they were sent, and changing the number of shards only moves sessions onto or off the shards
+that were added or removed. A lobby's users can be on any shard: its state changes atomically in the lobby store, and
+a worker reloads the items and running shares it keeps for a lobby whenever another worker moved the lobby on. Logins
+are claimed in the lobby store too, so a user's sessions on different shards can't both be logged in.
+"""
+import bisect
+import hashlib
+
+from django.conf import settings
+
+WORKER_CHANNEL = "user_action"
+# Points each shard gets on the ring. More points spread sessions more evenly.
+RING_REPLICAS = 100
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        points = sorted((ring_hash("{}#{}".format(node, replica)), node)
+                        for node in nodes for replica in range(replicas))
+        self.hashes = [point for point, node in points]
+        self.nodes = [node for point, node in points]
+
+    def node(self, key):
+        # The first point clockwise from the key's hash, wrapping around past the last one
+        return self.nodes[bisect.bisect(self.hashes, ring_hash(key)) % len(self.nodes)]
+
+
+def worker_channels(shards=None):
+    """
+    The channels the workers read, plain user_action when there's only one worker.
+    """
+    shards = settings.WORKER_SHARDS if shards is None else shards
+    if shards <= 1:
+        return [WORKER_CHANNEL]
+    return ["{}.{}".format(WORKER_CHANNEL, shard) for shard in range(shards)]
+
+
+worker_ring = HashRing(worker_channels())
+
+
+def worker_channel(uuid):
+    return worker_ring.node(uuid)
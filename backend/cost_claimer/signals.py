@@ -0,0 +1,61 @@
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .cache_versions import RECEIPTS_KEY, USERS_KEY, bump_version, receipt_key
+from .ledger import adjust_balances, reverse
+from .models import Balance, Cover, Item, Payment, Receipt, User
+from .user_directory import user_directory
+
+
+@receiver([post_save, post_delete], sender=Receipt)
+def receipt_changed(sender, instance, **kwargs):
+    bump_version(receipt_key(instance.date))
+    bump_version(RECEIPTS_KEY)
+
+
+@receiver([post_save, post_delete], sender=Item)
+def item_changed(sender, instance, **kwargs):
+    bump_version(receipt_key(instance.receipt_id))
+
+
+@receiver([post_save, post_delete], sender=Cover)
+def cover_changed(sender, instance, **kwargs):
+    if instance.transaction_id:
+        bump_version(receipt_key(instance.transaction_id))
+
+
+@receiver(pre_save, sender=Cover)
+@receiver(pre_save, sender=Payment)
+def ledger_entry_saving(sender, instance, **kwargs):
+    # Rows that weren't loaded from the database (like ones made with an existing id) don't know their old entry.
+    if instance.pk is not None and getattr(instance, "loaded_entry", None) is None:
+        old = sender.objects.filter(pk=instance.pk).first()
+        instance.loaded_entry = old.loaded_entry if old else None
+
+
+@receiver(post_save, sender=Cover)
+@receiver(post_save, sender=Payment)
+def ledger_entry_saved(sender, instance, **kwargs):
+    entry = instance.ledger_entry()
+    old = getattr(instance, "loaded_entry", None)
+    adjust_balances([entry] if old is None else [reverse(old), entry])
+    instance.loaded_entry = entry
+
+
+@receiver(post_delete, sender=Cover)
+@receiver(post_delete, sender=Payment)
+def ledger_entry_deleted(sender, instance, **kwargs):
+    adjust_balances([reverse(getattr(instance, "loaded_entry", None) or instance.ledger_entry())])
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    user_directory.invalidate()
+    bump_version(USERS_KEY)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    # Deleting the user's covers and payments first already brought these to 0.
+    Balance.objects.filter(Q(user_a=instance) | Q(user_b=instance)).delete()
@@ -0,0 +1,205 @@
+"""
+Splitting a receipt's items between their buyers and saving what each buyer owes the payer as covers.
+Shares are added up exactly in integers, one pass over every item at once, then rounded up to the cent.
+"""
+from collections import Counter, defaultdict
+from decimal import ROUND_UP, Decimal
+from fractions import Fraction
+from math import ceil
+
+import numpy as np
+from django.db import connection
+
+from .cache_versions import bump_version, receipt_key
+from .database import batches
+from .ledger import adjust_balances
+from .models import Cover, Item, iter_bits, to_cents
+
+# Item costs are counted in millionths of a dollar: prices have 2 decimal places and tax rates 4.
+MICROS_PER_CENT = 10 ** 4
+# Past this common denominator of a buyer's split counts, exact shares could get too close to a cent boundary to tell
+# apart from the rounding in the Decimal calculation, so those buyers are calculated the Decimal way instead.
+MAX_EXACT_DENOMINATOR = 10 ** 12
+
+
+class ReceiptItems(object):
+    """
+    The bought items of a receipt (or all of them) as columns, in the order the items were added.
+    """
+
+    def __init__(self, receipt, bought_only=True):
+        self.tax_rate = receipt.tax_rate
+        items = Item.objects.filter(receipt=receipt)
+        if bought_only:
+            items = items.exclude(buyers=0)
+        rows = list(items.order_by("id").values_list("id", "count", "price", "taxed", "buyers"))
+        self.ids = [row[0] for row in rows]
+        rows = [row[1:] for row in rows]
+        self.count = np.array([row[0] for row in rows], dtype=np.int64)
+        self.price = [row[1] for row in rows]
+        self.price_cents = np.array([int(row[1] * 100) for row in rows], dtype=np.int64)
+        self.taxed = np.array([row[2] for row in rows], dtype=bool)
+        self.buyers = [row[3] for row in rows]
+
+    def __len__(self):
+        return len(self.buyers)
+
+    def cost_micros(self):
+        rate = int(self.tax_rate * MICROS_PER_CENT)
+        return self.count * self.price_cents * np.where(self.taxed, MICROS_PER_CENT + rate, MICROS_PER_CENT)
+
+
+def decimal_shares(items, bits=None):
+    """
+    What each buyer bit owes, calculated one item at a time in Decimal the way covers used to be.
+    Only the given bits are added up if any are given. Amounts are rounded up to the cent.
+    """
+    tax_rate = items.tax_rate + 1
+    amounts = {}
+    for count, price, taxed, buyers in zip(items.count, items.price, items.taxed, items.buyers):
+        item_bits = list(iter_bits(buyers))
+        if not item_bits:
+            continue
+        item_cost = int(count) * price
+        if taxed:
+            item_cost *= tax_rate
+        share = item_cost / len(item_bits)
+        for bit in item_bits:
+            if bits is None or bit in bits:
+                amounts[bit] = amounts.get(bit, Decimal("0.00")) + share
+    return {bit: amount.quantize(Cover.quantizer, rounding=ROUND_UP) for bit, amount in amounts.items()}
+
+
+def calculate_shares(items):
+    """
+    Returns what each buyer bit owes, rounded up to the cent, matching decimal_shares exactly.
+    """
+    if not len(items):
+        return {}
+    # One (item, bit) pair per buyer of each item
+    pair_items, pair_bits = [], []
+    for index, buyers in enumerate(items.buyers):
+        for bit in iter_bits(buyers):
+            pair_items.append(index)
+            pair_bits.append(bit)
+    pair_items = np.array(pair_items, dtype=np.int64)
+    buyer_counts = np.bincount(pair_items, minlength=len(items))
+
+    # Each bit's share is the sum of cost / buyer count over its items. Costs with the same buyer count are summed
+    # together first, so the only division left is one per distinct buyer count.
+    bits, bit_rows = np.unique(np.array(pair_bits, dtype=np.int64), return_inverse=True)
+    split_counts, split_columns = np.unique(buyer_counts[pair_items], return_inverse=True)
+    totals = np.zeros((len(bits), len(split_counts)), dtype=np.int64)
+    np.add.at(totals, (bit_rows, split_columns), items.cost_micros()[pair_items])
+
+    return round_shares(items, {
+        bit: sum((Fraction(total, count) for total, count in zip(row, split_counts.tolist()) if total), Fraction(0))
+        for bit, row in zip(bits.tolist(), totals.tolist())
+    })
+
+
+def round_shares(items, shares):
+    """
+    Rounds exact shares (bit -> millionths of a dollar) of items up to the cent, the same way decimal_shares would.
+    """
+    cents = {}
+    inexact = set()
+    for bit, share in shares.items():
+        # Decimal rounds shares like 1/3 a little up or down, which only changes the rounded result when the exact
+        # amount is a whole number of cents. Those bits (and any with huge denominators) get the Decimal result.
+        if share.denominator > MAX_EXACT_DENOMINATOR or (share / MICROS_PER_CENT).denominator == 1:
+            inexact.add(bit)
+        else:
+            cents[bit] = ceil(share / MICROS_PER_CENT)
+    amounts = {bit: Decimal(amount).scaleb(-2) for bit, amount in cents.items()}
+    if inexact:
+        amounts.update(decimal_shares(items, inexact))
+    return amounts
+
+
+class RunningShares(object):
+    """
+    The exact share of every buyer bit of a receipt, kept up to date one item at a time as items' buyers change.
+    """
+
+    def __init__(self, receipt):
+        self.items = ReceiptItems(receipt, bought_only=False)
+        self.indexes = {item_id: index for index, item_id in enumerate(self.items.ids)}
+        self.costs = self.items.cost_micros().tolist()
+        self.totals = defaultdict(Fraction)
+        # Number of items each bit is a buyer of, since buying only free items still gets a (zero) share.
+        self.item_counts = Counter()
+        for index in range(len(self.items)):
+            self._add(index, 1)
+
+    def __contains__(self, item_id):
+        return item_id in self.indexes
+
+    def _add(self, index, sign):
+        bits = list(iter_bits(self.items.buyers[index]))
+        for bit in bits:
+            self.totals[bit] += Fraction(sign * self.costs[index], len(bits))
+            self.item_counts[bit] += sign
+            if not self.item_counts[bit]:
+                del self.totals[bit], self.item_counts[bit]
+        return bits
+
+    def set_buyers(self, item_id, buyers):
+        """
+        Moves an item's share from its old buyers to its new ones. Returns the bits whose shares changed.
+        """
+        index = self.indexes[item_id]
+        old_bits = self._add(index, -1)
+        self.items.buyers[index] = buyers
+        return set(old_bits).union(self._add(index, 1))
+
+    def shares(self, bits=None):
+        """
+        What each bit (or each of the given bits that still buys something) owes, rounded like calculate_shares.
+        """
+        if bits is None:
+            return round_shares(self.items, self.totals)
+        return round_shares(self.items, {bit: self.totals[bit] for bit in bits if bit in self.totals})
+
+
+def save_covers(receipt, payer, amounts, users=None):
+    """
+    Sets the cover of every user in amounts (by id) other than the payer, and deletes the receipt's other covers.
+    If users (ids) are given, only their covers are changed: the ones in amounts are set and the rest deleted.
+    Covers are written with one upsert per batch of rows and one delete, so this should run in a transaction. Cover
+    signals aren't sent, so the balances are adjusted here instead.
+    """
+    old_covers = Cover.objects.filter(transaction=receipt).exclude(user=payer)
+    if users is not None:
+        old_covers = old_covers.filter(user__in=[*users, *amounts])
+    old_payers = {}
+    entries = []
+    for payer_id, user_id, amount in old_covers.values_list("transaction_payer", "user", "amount"):
+        old_payers[user_id] = payer_id
+        entries.append((payer_id, user_id, -to_cents(amount)))
+    table = connection.ops.quote_name(Cover._meta.db_table)
+    date = connection.ops.adapt_datefield_value(receipt.date)
+    rows = []
+    for user_id, amount in amounts.items():
+        if user_id != payer.buy_index:
+            rows.append([date, payer.buy_index, user_id, connection.ops.adapt_decimalfield_value(amount, 5, 2)])
+            entries.append((old_payers.get(user_id, payer.buy_index), user_id, to_cents(amount)))
+    kept = [payer.buy_index, *amounts]
+    removed = None if users is None else [user_id for user_id in users if user_id not in kept]
+    with connection.cursor() as cursor:
+        for batch in batches(rows, ["transaction_id", "transaction_payer_id", "user_id", "amount"]):
+            # SQLite and PostgreSQL both have this upsert. Existing covers keep their payer, only the amount changes.
+            cursor.execute(
+                "INSERT INTO {} (transaction_id, transaction_payer_id, user_id, amount) VALUES {} "
+                "ON CONFLICT (transaction_id, user_id) DO UPDATE SET amount = excluded.amount"
+                .format(table, ", ".join(["(%s, %s, %s, %s)"] * len(batch))),
+                [value for row in batch for value in row],
+            )
+        if removed is None:
+            cursor.execute("DELETE FROM {} WHERE transaction_id = %s AND user_id NOT IN ({})"
+                           .format(table, ", ".join(["%s"] * len(kept))), [date, *kept])
+        elif removed:
+            cursor.execute("DELETE FROM {} WHERE transaction_id = %s AND user_id IN ({})"
+                           .format(table, ", ".join(["%s"] * len(removed))), [date, *removed])
+    adjust_balances(entries)
+    bump_version(receipt_key(receipt.date))
@@ -0,0 +1,16 @@
+"""
+The SQLite backend, with transactions that take the write lock as soon as they start.
+Use it by setting the database ENGINE to "cost_claimer.sqlite".
+"""
+from django.db.backends.sqlite3 import base
+
+from .. import database
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def _start_transaction_under_autocommit(self):
+        # A transaction that reads before it writes can't wait for another writer once it has read, so SQLite fails
+        # it with "database is locked" right away. Starting with the write lock means it waits out the busy timeout
+        # like any other write. Every transaction here (atomic blocks) is there to write.
+        self.cursor().execute(database.SQLITE_BEGIN)
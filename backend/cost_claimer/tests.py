@@ -1,3 +1,960 @@
-from django.test import TestCase
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
 
-# Create your tests here.
+import numpy as np
+from channels.layers import InMemoryChannelLayer
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, OperationalError, connection
+from django.db.models.signals import pre_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework.test import APIClient
+
+from .benchmarks import ReceiptParser, suites, synthetic_receipt_html
+from .budgets import CallFailed, Fixture, act, calls, close_lobbies, measure, over_budget, run_budgets, set_active_users
+from .consumers import GroupCostWorker
+from .database import retry_when_locked
+from .ledger import get_balances, get_settle_up, ledger_differences, settle_up
+from .lobby_store import MemoryLobbyStore, lobby_store, new_state
+from .models import Balance, Cover, Item, Payment, Receipt, User, iter_bits, make_bitset
+from .review_lobby import (LOBBY_DELTA_VERSION, PRELOAD_ITEMS, TAKEOVER_SECONDS, GroupLobbyOrganizer,
+                           recalculate_receipt, user_amounts)
+from .scheduler import Scheduler
+from .shards import HashRing, worker_channels
+from .splits import ReceiptItems, RunningShares, calculate_shares, decimal_shares
+from .thumbnails import render_thumbnail
+from .urls import urlpatterns
+from .user_directory import user_directory
+
+# benchmarks puts receipt_parser on the path.
+import ReceiptOCR  # noqa: E402
+
+
+class SyntheticReceiptTests(TestCase):
+
+    def test_parser_reads_synthetic_receipt(self):
+        receipt = ReceiptParser.build_receipt(synthetic_receipt_html(30, 10), "2020-01-01", 1)
+        self.assertEqual(receipt.itemCount, 30)
+        self.assertEqual(len(receipt.items), 10)
+        self.assertTrue(all(item.count == 3 for item in receipt.items.values()))
+        self.assertEqual(Decimal(receipt.total), Decimal(receipt.subtotal) + Decimal(receipt.tax))
+
+    def test_ingest_benchmark(self):
+        results = suites["ingest"]({"sizes": [5, 20], "repeat": 1})
+        self.assertEqual(len(results), 8)
+        self.assertEqual({result["name"] for result in results},
+                         {"parse", "aggregate", "upload_bulk", "upload_two_calls"})
+
+
+class ReceiptParserTests(SimpleTestCase):
+
+    def test_unknown_taxes_stop_the_upload_before_images_are_copied(self):
+        with tempfile.TemporaryDirectory() as directory:
+            receipt = ReceiptParser.Receipt(1, "2020-01-01")
+            receipt.sourceDir = directory
+            receipt.add_item("Item", "1.00", "item.jpeg")
+            os.makedirs(os.path.join(directory, "2020-01-01_files"))
+            Image.new("RGB", (10, 10)).save(os.path.join(directory, "2020-01-01_files", "item.jpeg"))
+            receipt.fetch_uploaded = lambda: None
+            working_dir = os.path.join(directory, "project", "receipt_parser")
+            os.makedirs(working_dir)
+            cwd = os.getcwd()
+            os.chdir(working_dir)
+            try:
+                with self.assertRaises(ReceiptParser.UnknownTaxes):
+                    receipt.post(unknownPolicy="fail")
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(os.listdir(os.path.join(directory, "project")), ["receipt_parser"])
+
+
+def upload_unless_failing(receipt, taxIndex=None, unknownPolicy="ask"):
+    # Stands in for Receipt.post: the first receipt is rejected and the third can't reach the server.
+    if receipt.date == "2020-01-03":
+        raise ConnectionError("Server unreachable")
+    return receipt.date != "2020-01-01"
+
+
+class ReceiptBatchTests(SimpleTestCase):
+
+    def test_failures_are_collected_from_every_stage(self):
+        post = ReceiptParser.Receipt.post
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, "2020-01-0{}.html".format(day)) for day in range(1, 5)]
+            for path in paths:
+                with open(path, "w") as receiptFile:
+                    receiptFile.write(synthetic_receipt_html(6, 3) if not path.endswith("02.html") else "<html>")
+            ReceiptParser.Receipt.post = upload_unless_failing
+            try:
+                with redirect_stdout(StringIO()):
+                    failures = ReceiptParser.parse_receipts(paths, 1, workers=2)
+            finally:
+                ReceiptParser.Receipt.post = post
+            self.assertEqual(sorted((path, stage) for path, stage, _ in failures),
+                             [(paths[0], "upload"), (paths[1], "parse"), (paths[2], "upload")])
+            self.assertIn("ConnectionError", dict((path, error) for path, _, error in failures)[paths[2]])
+
+            report = StringIO()
+            with redirect_stdout(report):
+                ReceiptParser.print_failure_report(failures, len(paths))
+            self.assertEqual(report.getvalue().splitlines()[0], "1 of 4 receipts uploaded")
+            self.assertEqual(len(report.getvalue().splitlines()), 4)
+
+    def test_images_are_only_copied_when_they_changed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source, destination = os.path.join(directory, "source.jpeg"), os.path.join(directory, "copy.jpeg")
+            with open(source, "wb") as image:
+                image.write(b"image")
+            self.assertTrue(ReceiptParser.copy_image(source, destination))
+            self.assertFalse(ReceiptParser.copy_image(source, destination))
+            # Same size, different bytes
+            with open(destination, "wb") as image:
+                image.write(b"imagf")
+            self.assertTrue(ReceiptParser.copy_image(source, destination))
+            with open(destination, "rb") as image:
+                self.assertEqual(image.read(), b"image")
+
+
+class TaxabilityTests(TestCase):
+
+    def test_items_are_looked_up_by_name_then_image(self):
+        with tempfile.TemporaryDirectory() as directory:
+            index = ReceiptParser.TaxabilityIndex(os.path.join(directory, "taxability.json"))
+            index.names, index.images = {"Milk": False, "Soap": True}, {"battery.jpeg": True, "milk.jpeg": True}
+            receipt = ReceiptParser.Receipt(1, "2020-01-01")
+            receipt.add_item("Milk", "3.48", "milk.jpeg")
+            receipt.add_item("New Batteries", "5.00", "battery.jpeg")
+            receipt.add_item("Mystery", "1.00", "mystery.jpeg")
+            with self.assertRaisesRegex(ReceiptParser.UnknownTaxes, "Mystery"):
+                receipt.resolve_taxes(index, "fail")
+            self.assertEqual({name: item.taxed for name, item in receipt.items.items()},
+                             {"Milk": False, "New Batteries": True, "Mystery": None})
+
+            # Taxes assumed by the policy aren't remembered, only the ones that were known.
+            known = receipt.resolve_taxes(index, "untaxed")
+            self.assertEqual([item.name for item in known], ["Milk", "New Batteries"])
+            for item in known:
+                index.record(item)
+            index.save()
+            reloaded = ReceiptParser.TaxabilityIndex(index.path)
+            self.assertEqual(reloaded.names, {"Milk": False, "Soap": True, "New Batteries": True})
+            self.assertEqual(reloaded.images, {"battery.jpeg": True, "milk.jpeg": False})
+
+    def test_later_receipts_win(self):
+        payer = User.objects.create(buy_index=1, bit=0, name="Payer")
+        for date, taxed in [("2020-01-02", True), ("2020-01-01", False), ("2020-01-03", False)]:
+            receipt = Receipt.objects.create(date=date, subtotal=1, tax=0, total=1, tax_rate=0, payer=payer)
+            Item.objects.create(name="Milk", count=1, price=1, receipt=receipt, imgSrc="milk.jpeg", taxed=taxed)
+        Item.objects.create(name="Soap", count=1, price=1, receipt=receipt, imgSrc="", taxed=True)
+        response = APIClient().get("/cost_claimer/taxability/")
+        self.assertEqual(response.data, {"names": {"Milk": False, "Soap": True}, "images": {"milk.jpeg": False}})
+
+
+def text_lines_page(count):
+    # A white page with a black band where each line of text would be.
+    page = np.full((30 * count + 10, 200), 255, np.uint8)
+    for line in range(count):
+        page[10 + 30 * line:20 + 30 * line, 20:180] = 0
+    return page
+
+
+class ReceiptOCRTests(SimpleTestCase):
+
+    def test_pages_are_binarized_straightened_and_split_into_lines(self):
+        page = text_lines_page(3)
+        ink = page == 0
+        self.assertTrue((ReceiptOCR.binarize(np.where(ink, 30, 220).astype(np.uint8)) == ink).all())
+        tilted = Image.fromarray((ink * 255).astype(np.uint8)).rotate(2, expand=True)
+        self.assertEqual(ReceiptOCR.find_skew(np.asarray(tilted) > 127), -2.0)
+
+        # Specks too thin to be text aren't lines.
+        page[105:107, 20:180] = 0
+        lines = ReceiptOCR.split_lines(page)
+        self.assertEqual([line.shape for line in lines], [(10 + 2 * ReceiptOCR.LINE_PADDING, 200)] * 3)
+        self.assertTrue(all((line == 0).any() for line in lines))
+
+    def test_receipt_is_built_from_ocred_lines(self):
+        text = ["WALMART 08/01/20", "GV MILK 1GAL 007874235186 F 3.48 N", "BATTERIES 004133300000 5.00 X",
+                "GV MILK 1GAL 007874235186 F 3.48 N", "SUBTOTAL 11.96", "TAX 1 8.000 % 0.40", "TOTAL 12.36"]
+        lines = iter(text)
+        ocr_line, cache_dir = ReceiptOCR.ocr_line, ReceiptOCR.OCR_CACHE_DIR
+        with tempfile.TemporaryDirectory() as directory:
+            imagePath = os.path.join(directory, "receipt.png")
+            Image.fromarray(text_lines_page(len(text))).save(imagePath)
+            ReceiptOCR.ocr_line = lambda line: next(lines)
+            ReceiptOCR.OCR_CACHE_DIR = os.path.join(directory, "cache")
+            try:
+                # Runs the lines in this process, since the stub wouldn't reach a process pool.
+                pool = SimpleNamespace(map=map)
+                receipt = ReceiptOCR.read_ocr_receipt(imagePath, 1, pool)
+                # The lines come from the cache the second time, so there are none left to OCR.
+                self.assertEqual(ReceiptOCR.read_ocr_receipt(imagePath, 1, pool).items.keys(),
+                                 receipt.items.keys())
+            finally:
+                ReceiptOCR.ocr_line, ReceiptOCR.OCR_CACHE_DIR = ocr_line, cache_dir
+        self.assertEqual((receipt.date, receipt.subtotal, receipt.tax, receipt.total, receipt.taxRate),
+                         ("2020-08-01", "11.96", "0.40", "12.36", "0.0800"))
+        self.assertEqual({name: (item.count, item.price, item.imgSrc, item.taxed)
+                          for name, item in receipt.items.items()}, {
+            "GV MILK 1GAL (007874235186)": (2, "3.48", None, False),
+            "BATTERIES (004133300000)": (1, "5.00", None, True),
+        })
+        with self.assertRaises(ValueError):
+            ReceiptOCR.build_ocr_receipt(["SUBTOTAL 1.00"], 1, "2020-08-01")
+
+
+class ThumbnailTests(SimpleTestCase):
+
+    def test_threads_rendering_the_same_thumbnail_dont_collide(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "item.png")
+            Image.new("RGBA", (800, 600), (200, 100, 50, 255)).save(source)
+            destination = os.path.join(directory, "medium", "item.png.jpeg")
+            etags, errors = [], []
+
+            def render():
+                try:
+                    etags.append(render_thumbnail(source, destination, "medium", "JPEG"))
+                except Exception as error:
+                    errors.append(error)
+
+            threads = [threading.Thread(target=render) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(len(set(etags)), 1)
+            with Image.open(destination) as thumbnail:
+                self.assertEqual(thumbnail.size, (360, 270))
+            with open(destination + ".etag") as etag_file:
+                self.assertEqual(etag_file.read(), etags[0])
+            self.assertEqual(sorted(os.listdir(os.path.dirname(destination))), ["item.png.jpeg", "item.png.jpeg.etag"])
+
+
+class ItemImageTests(TestCase):
+
+    def test_items_without_an_image_have_no_link(self):
+        User.objects.create(buy_index=1, bit=0, name="Payer")
+        response = APIClient().post("/cost_claimer/upload/receipt_items/", {
+            "date": "2020-08-01", "payer": 1, "subtotal": "1.00", "tax": "0.00", "total": "1.00",
+            "tax_rate": "0.0000",
+            "items": [{"name": "Paper", "count": 1, "price": "1.00", "taxed": False},
+                      {"name": "Online", "count": 1, "price": "0.00", "imgSrc": "online.jpeg", "taxed": False}],
+        }, format="json")
+        self.assertEqual(response.status_code, 200)
+        items = APIClient().get("/cost_claimer/receipt/2020-08-01/", {"size": "medium"}).data["items"]
+        self.assertEqual({item["name"]: item["src"] for item in items}, {
+            "Paper": None,
+            "Online": "cost_claimer/thumbnail/medium/2020-08-01/online.jpeg",
+        })
+
+
+class ReceiptUploadTests(TestCase):
+
+    def upload(self, payer=1, total="1.00", items=("Item",)):
+        return APIClient().post("/cost_claimer/upload/receipt_items/", {
+            "date": "2020-08-01", "payer": payer, "subtotal": "1.00", "tax": "0.00", "total": total,
+            "tax_rate": "0.0000",
+            "items": [{"name": name, "count": 1, "price": "0.50", "taxed": False} for name in items],
+        }, format="json")
+
+    def test_items_are_only_added_to_a_matching_receipt(self):
+        User.objects.create(buy_index=1, bit=0, name="Payer")
+        User.objects.create(buy_index=2, bit=1, name="Other")
+        self.assertEqual(self.upload().status_code, 200)
+        response = self.upload(items=("Item", "Another"))
+        self.assertEqual((response.status_code, response.data["added"], response.data["duplicates"]), (200, 1, 1))
+
+        response = self.upload(payer=2, total="2.00", items=("Third",))
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data["conflicts"], ["total", "payer"])
+        receipt = Receipt.objects.get(date="2020-08-01")
+        self.assertEqual((receipt.total, receipt.payer_id), (Decimal("1.00"), 1))
+        self.assertEqual(sorted(receipt.item_set.values_list("name", flat=True)), ["Another", "Item"])
+
+    def test_bad_uploads_are_rejected(self):
+        User.objects.create(buy_index=1, bit=0, name="Payer")
+        client = APIClient()
+        upload = {"date": "2020-08-01", "payer": 1, "subtotal": "1.00", "tax": "0.00", "total": "1.00",
+                  "tax_rate": "0.0000"}
+        for date, taxed in [("notadate", False), ("2020-08-01", "yes"), ("2020-08-01", "0")]:
+            response = client.post("/cost_claimer/upload/receipt_items/", {**upload, "date": date, "items": json.dumps(
+                [{"name": "Item", "count": 1, "price": "1.00", "taxed": taxed}]
+            )})
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Receipt.objects.exists())
+
+        response = client.post("/cost_claimer/upload/receipt_items/", {**upload, "items": json.dumps(
+            [{"name": "Untaxed", "count": 1, "price": "0.50", "taxed": "false"},
+             {"name": "Taxed", "count": 1, "price": "0.50", "taxed": "true"}]
+        )})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(Item.objects.values_list("name", "taxed")), {"Untaxed": False, "Taxed": True})
+
+
+class AccountTests(TestCase):
+
+    def test_failed_saves_leave_shared_users_alone(self):
+        fixture = Fixture(10)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        uuid = fixture.session(worker)
+        username = fixture.users[0].username
+
+        def fail(sender, **kwargs):
+            raise DatabaseError("disk I/O error")
+
+        pre_save.connect(fail, sender=User)
+        try:
+            with self.assertRaises(CallFailed):
+                act(worker, uuid, "change_password", password="password", new_password="new")
+            with self.assertRaises(CallFailed):
+                act(worker, uuid, "change_username", password="password", new_username="renamed")
+        finally:
+            pre_save.disconnect(fail, sender=User)
+        self.assertEqual(user_directory.authenticate(username, "password").buy_index, fixture.users[0].buy_index)
+        self.assertIsNone(user_directory.authenticate(username, "new"))
+        self.assertIsNone(user_directory.by_username("renamed"))
+
+        act(worker, uuid, "change_password", password="password", new_password="new")
+        self.assertIsNone(user_directory.authenticate(username, "password"))
+        self.assertEqual(user_directory.authenticate(username, "new").buy_index, fixture.users[0].buy_index)
+        user_directory.invalidate()
+
+
+class ReceiptIndexTests(TestCase):
+
+    def setUp(self):
+        self.payer = User.objects.create(buy_index=1, bit=0, name="Payer")
+        for day in range(1, 6):
+            Receipt.objects.create(date="2020-01-0{}".format(day), subtotal=1, tax=0, total=1, tax_rate=0,
+                                   payer=self.payer)
+        self.client = APIClient()
+
+    def index(self, status=200, **params):
+        response = self.client.get("/cost_claimer/receipt_index/", params)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def test_pages_follow_the_cursor(self):
+        pages, cursor = [], None
+        while True:
+            data = self.index(limit=2, **({"cursor": cursor} if cursor else {})).data
+            pages.append(data["receipts"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(pages, [["2020-01-01", "2020-01-02"], ["2020-01-03", "2020-01-04"], ["2020-01-05"]])
+        self.assertEqual(self.index(since="2020-01-02", until="2020-01-04").data,
+                         {"receipts": ["2020-01-02", "2020-01-03", "2020-01-04"], "next_cursor": None})
+        self.assertEqual(self.index(since="2020-01-02", limit=3).data["next_cursor"], "2020-01-04")
+
+    def test_bad_parameters_are_rejected(self):
+        self.index(400, since="notadate")
+        self.index(400, cursor="2020-13-01")
+        self.index(400, limit="many")
+
+    def test_etag_changes_when_receipts_do(self):
+        etag = self.index()["ETag"]
+        response = self.client.get("/cost_claimer/receipt_index/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertNotEqual(self.index(limit=2)["ETag"], etag)
+
+        Receipt.objects.create(date="2020-01-06", subtotal=1, tax=0, total=1, tax_rate=0, payer=self.payer)
+        response = self.client.get("/cost_claimer/receipt_index/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.data["receipts"][-1], "2020-01-06")
+
+
+class ResponseCacheTests(TestCase):
+
+    def setUp(self):
+        self.payer = User.objects.create(buy_index=1, bit=0, name="Payer")
+        self.buyer = User.objects.create(buy_index=2, bit=1, name="Buyer")
+        self.receipt = Receipt.objects.create(date="2020-01-01", subtotal=1, tax=0, total=1, tax_rate=0,
+                                              payer=self.payer)
+        self.item = Item.objects.create(name="Milk", count=1, price=1, receipt=self.receipt, imgSrc="", taxed=False)
+        self.client = APIClient()
+
+    def get(self, path):
+        """
+        Returns the response data, and whether it was built from the receipt and item rows instead of the cache.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get("/cost_claimer/" + path).data
+        tables = (Receipt._meta.db_table, Item._meta.db_table)
+        return data, any(table in query["sql"] for query in queries.captured_queries for table in tables)
+
+    def test_receipts_are_cached_until_they_change(self):
+        for path in ("receipt/2020-01-01/", "receipts/", "valid_receipts/"):
+            self.assertTrue(self.get(path)[1])
+            self.assertFalse(self.get(path)[1])
+
+        self.item.name = "Oat Milk"
+        self.item.save()
+        data, built = self.get("receipt/2020-01-01/")
+        self.assertEqual(([item["name"] for item in data["items"]], built), (["Oat Milk"], True))
+
+        Cover.objects.create(transaction=self.receipt, transaction_payer=self.payer, user=self.buyer,
+                             amount=Decimal("0.50"))
+        self.assertTrue(self.get("receipt/2020-01-01/")[1])
+        self.assertFalse(self.get("receipt/2020-01-01/")[1])
+
+        self.receipt.total = Decimal("2.00")
+        self.receipt.save()
+        Receipt.objects.create(date="2020-01-02", subtotal=1, tax=0, total=1, tax_rate=0, payer=self.payer)
+        self.assertEqual(self.get("receipt/2020-01-01/")[0]["total"], "2.00")
+        self.assertEqual([receipt["total"] for receipt in self.get("receipts/")[0]], ["2.00", "1.00"])
+        self.assertEqual(self.get("valid_receipts/")[0], ["2020-01-01", "2020-01-02"])
+
+
+class BuyerBitsTests(TestCase):
+
+    def test_legacy_users_keep_their_bits(self):
+        users = [User.objects.create(buy_index=buy_index, name=str(buy_index)) for buy_index in (1, 4, 128)]
+        self.assertEqual([user.bit for user in users], [0, 2, 7])
+        self.assertEqual(User.objects.create(name="New").bit, 8)
+
+    def test_bits_of_deleted_buyers_are_not_reused(self):
+        users = [User.objects.create(name="User {}".format(index)) for index in range(3)]
+        legacy = User.objects.create(buy_index=64, name="Legacy")
+        self.assertEqual([user.bit for user in users + [legacy]], [0, 1, 2, 6])
+        receipt = Receipt.objects.create(date="2020-01-01", subtotal=3, tax=0, total=3, tax_rate=0, payer=users[0])
+        Item.objects.create(name="Item", count=1, price=3, receipt=receipt, imgSrc="",
+                            buyers=make_bitset([users[0].bit, users[2].bit, legacy.bit]))
+        users[2].delete()
+        legacy.delete()
+        self.assertEqual(User.objects.create(name="New").bit, 7)
+        self.assertEqual(User.objects.create(buy_index=64, name="New Legacy").bit, 8)
+        self.assertEqual(recalculate_receipt(receipt), {users[0].buy_index: Decimal("1.00")})
+
+    def test_wide_buyers_round_trip(self):
+        users = [User.objects.create(name="User {}".format(index)) for index in range(100)]
+        receipt = Receipt.objects.create(date="2020-01-01", subtotal=4, tax=0, total=4, tax_rate=0, payer=users[0])
+        buyers = make_bitset(users[index].bit for index in (0, 9, 64, 99))
+        item = Item.objects.create(name="Item", count=1, price=4, receipt=receipt, imgSrc="", buyers=buyers)
+        item.refresh_from_db()
+        self.assertEqual(item.buyers, buyers)
+        self.assertEqual(list(iter_bits(item.buyers)), [users[index].bit for index in (0, 9, 64, 99)])
+        self.assertEqual(recalculate_receipt(receipt),
+                         {users[index].buy_index: Decimal("1.00") for index in (0, 9, 64, 99)})
+
+
+class SplitTests(TestCase):
+
+    def test_shares_match_decimal_calculation(self):
+        users = [User.objects.create(name="User {}".format(index)) for index in range(70)]
+        generator = random.Random(16)
+        for day in range(1, 21):
+            receipt = Receipt.objects.create(date="2020-01-{:02}".format(day), subtotal=0, tax=0, total=0,
+                                             tax_rate=Decimal(generator.choice(["0", "0.07", "0.0825", "0.0999"])),
+                                             payer=users[0])
+            for index in range(generator.randint(1, 40)):
+                # Whole dollars split 3 or 6 ways land right on cent boundaries.
+                price = generator.choice([Decimal(generator.randint(1, 5)), Decimal(generator.randint(1, 9999)) / 100])
+                bits = generator.sample(range(70), generator.choice([1, 2, 3, 6, 7, generator.randint(1, 70)]))
+                Item.objects.create(name=str(index), count=generator.randint(1, 3), price=price, receipt=receipt,
+                                    imgSrc="", taxed=generator.random() < 0.5,
+                                    buyers=make_bitset(users[bit].bit for bit in bits))
+            items = ReceiptItems(receipt)
+            self.assertEqual(calculate_shares(items), decimal_shares(items))
+
+    def test_covers_are_replaced(self):
+        users = [User.objects.create(name="User {}".format(index)) for index in range(3)]
+        receipt = Receipt.objects.create(date="2020-01-01", subtotal=2, tax=0, total=2, tax_rate=0, payer=users[0])
+        item = Item.objects.create(name="Item", count=1, price=2, receipt=receipt, imgSrc="",
+                                   buyers=make_bitset(user.bit for user in users))
+        recalculate_receipt(receipt)
+        self.assertEqual(dict(Cover.objects.filter(transaction=receipt).values_list("user", "amount")),
+                         {users[1].buy_index: Decimal("0.67"), users[2].buy_index: Decimal("0.67")})
+        item.buyers = make_bitset(user.bit for user in users[:2])
+        item.save()
+        recalculate_receipt(receipt)
+        self.assertEqual(dict(Cover.objects.filter(transaction=receipt).values_list("user", "amount")),
+                         {users[1].buy_index: Decimal("1.00")})
+
+    def test_running_shares_match_full_recalculation(self):
+        users = [User.objects.create(name="User {}".format(index)) for index in range(12)]
+        receipt = Receipt.objects.create(date="2020-01-01", subtotal=0, tax=0, total=0, tax_rate=Decimal("0.0825"),
+                                         payer=users[0])
+        generator = random.Random(17)
+        items = [Item.objects.create(name=str(index), count=1, price=generator.choice([Decimal(3), Decimal("0.00"),
+                                                                                      Decimal("7.99")]),
+                                     receipt=receipt, imgSrc="", taxed=index % 2 == 0) for index in range(15)]
+        running = RunningShares(receipt)
+        for _ in range(100):
+            item = generator.choice(items)
+            item.buyers = make_bitset(user.bit for user in generator.sample(users, generator.randint(0, 4)))
+            item.save()
+            changed = running.set_buyers(item.id, item.buyers)
+            expected = calculate_shares(ReceiptItems(receipt))
+            self.assertEqual(running.shares(), expected)
+            self.assertEqual(running.shares(changed), {bit: expected[bit] for bit in changed if bit in expected})
+
+    def test_lobby_skips_buyers_deleted_mid_review(self):
+        fixture = Fixture(10)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        fixture.session(worker, lobby=True)
+        lobby = GroupLobbyOrganizer._lobbies[fixture.date]
+        buyer, deleted = [user for user in fixture.users[1:] if user.buy_index != fixture.receipt.payer_id][:2]
+        try:
+            lobby.start_item_viewing()
+            set_active_users(lobby, [buyer, deleted])
+            deleted.delete()
+            lobby.view_next_item()
+            self.assertEqual(Item.objects.get(pk=lobby.items[0].pk).buyers, make_bitset([buyer.bit]))
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+    def test_lobby_keeps_covers_up_to_date(self):
+        fixture = Fixture(100)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        fixture.session(worker, lobby=True)
+        lobby = GroupLobbyOrganizer._lobbies[fixture.date]
+        try:
+            lobby.start_item_viewing()
+            for users in (fixture.users[1:3], fixture.users[2:5], [], fixture.users[:1]):
+                set_active_users(lobby, users)
+                lobby.view_next_item()
+                covers = dict(Cover.objects.filter(transaction=fixture.receipt).exclude(user=fixture.receipt.payer)
+                              .values_list("user", "amount"))
+                expected = user_amounts(calculate_shares(ReceiptItems(fixture.receipt)))
+                self.assertEqual(lobby.final_shares(), expected)
+                self.assertEqual(covers, {user: amount for user, amount in expected.items()
+                                          if user != fixture.receipt.payer_id})
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+
+class LedgerTests(TestCase):
+
+    def setUp(self):
+        self.users = [User.objects.create(name="User {}".format(index)) for index in range(4)]
+        self.receipt = Receipt.objects.create(date="2020-01-01", subtotal=9, tax=0, total=9, tax_rate=0,
+                                              payer=self.users[0])
+
+    def test_balances_follow_covers_and_payments(self):
+        cover = Cover.objects.create(transaction=self.receipt, transaction_payer=self.users[0], user=self.users[1],
+                                     amount=Decimal("3.50"))
+        Payment.objects.create(transaction_payer=self.users[0], user=self.users[1], amount=Decimal("1.25"))
+        payment = Payment.objects.create(transaction_payer=self.users[2], user=self.users[0], amount=Decimal("2.00"))
+        self.assertEqual(get_balances(self.users[0]), {self.users[1].buy_index: 225, self.users[2].buy_index: 200})
+        self.assertEqual(get_balances(self.users[2]), {self.users[0].buy_index: -200})
+
+        cover = Cover.objects.get(pk=cover.pk)
+        cover.amount = Decimal("1.00")
+        cover.transaction_payer = self.users[3]
+        cover.save()
+        Payment(pk=payment.pk, transaction_payer=self.users[2], user=self.users[0], amount=Decimal("0.50")).save()
+        self.assertEqual(ledger_differences(), [])
+
+        Item.objects.create(name="Item", count=1, price=9, receipt=self.receipt, imgSrc="",
+                            buyers=make_bitset(user.bit for user in self.users[1:]))
+        recalculate_receipt(self.receipt)
+        self.assertEqual(ledger_differences(), [])
+        self.receipt.delete()
+        self.assertEqual(ledger_differences(), [])
+        self.assertEqual(get_balances(self.users[1]), {self.users[0].buy_index: 125})
+        self.users[2].delete()
+        self.assertFalse(Balance.objects.filter(user_b=self.users[2].pk).exists())
+        self.assertEqual(ledger_differences(), [])
+
+    def test_covers_and_balances_for_many_users_are_saved_in_batches(self):
+        users = self.users + [User.objects.create(name="User {}".format(index)) for index in range(4, 400)]
+        Item.objects.create(name="Item", count=1, price=400, receipt=self.receipt, imgSrc="",
+                            buyers=make_bitset(user.bit for user in users))
+        with CaptureQueriesContext(connection) as queries:
+            recalculate_receipt(self.receipt)
+        upserts = [query["sql"] for query in queries.captured_queries if query["sql"].startswith("INSERT")]
+        self.assertEqual(len([sql for sql in upserts if Cover._meta.db_table in sql]), 2)
+        self.assertEqual(len([sql for sql in upserts if Balance._meta.db_table in sql]), 2)
+        self.assertEqual(Cover.objects.filter(transaction=self.receipt).count(), len(users) - 1)
+        self.assertEqual(ledger_differences(), [])
+
+    def test_rebuild_fixes_wrong_balances(self):
+        Cover.objects.create(transaction=self.receipt, transaction_payer=self.users[0], user=self.users[1],
+                             amount=Decimal("3.50"))
+        Balance.objects.update(cents=1)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_ledger", "--verify", stdout=StringIO(), stderr=StringIO())
+        call_command("rebuild_ledger", stdout=StringIO())
+        call_command("rebuild_ledger", "--verify", stdout=StringIO())
+        self.assertEqual(get_balances(self.users[1]), {self.users[0].buy_index: -350})
+
+    def test_settle_up_zeroes_every_net(self):
+        generator = random.Random(19)
+        for _ in range(50):
+            nets = Counter()
+            for _ in range(generator.randint(0, 40)):
+                creditor, debtor = generator.sample(range(12), 2)
+                cents = generator.choice([500, generator.randint(1, 10000)])
+                nets[creditor] += cents
+                nets[debtor] -= cents
+            nets = {user_id: cents for user_id, cents in nets.items() if cents}
+            transfers = settle_up(nets)
+            settled = Counter(nets)
+            for debtor, creditor, cents in transfers:
+                self.assertGreater(cents, 0)
+                settled[debtor] += cents
+                settled[creditor] -= cents
+            self.assertFalse(any(settled.values()))
+            self.assertLessEqual(len(transfers), max(0, len(nets) - 1))
+        self.assertEqual(settle_up({1: 300, 2: -300, 3: 500, 4: -200, 5: -300}), [(2, 1, 300), (5, 3, 300), (4, 3, 200)])
+
+    def test_settle_up_is_cached_until_the_ledger_changes(self):
+        first, second = (user.buy_index for user in self.users[:2])
+        # The first user paid the second back before the second covered them for anything.
+        Payment.objects.create(transaction_payer=self.users[1], user=self.users[0], amount=Decimal("4.00"))
+        self.assertEqual(get_settle_up(), [{"from_user": second, "to_user": first, "amount": "4.00"}])
+        with self.assertNumQueries(1):
+            get_settle_up()
+        Cover.objects.create(transaction=self.receipt, transaction_payer=self.users[1], user=self.users[0],
+                             amount=Decimal("8.00"))
+        self.assertEqual(get_settle_up(), [{"from_user": first, "to_user": second, "amount": "4.00"}])
+
+
+class RecomputeCoversTests(TestCase):
+
+    def test_dry_run_reports_then_covers_are_fixed(self):
+        users = [User.objects.create(name="User {}".format(index)) for index in range(3)]
+        for day in (1, 2, 3):
+            receipt = Receipt.objects.create(date="2020-01-0{}".format(day), subtotal=3, tax=0, total=3, tax_rate=0,
+                                             payer=users[0])
+            Item.objects.create(name="Item", count=1, price=3, receipt=receipt, imgSrc="",
+                                buyers=make_bitset(user.bit for user in users[:day]))
+            recalculate_receipt(receipt)
+        Cover.objects.filter(transaction="2020-01-02").update(amount=Decimal("9.99"))
+        Cover.objects.filter(transaction="2020-01-03", user=users[2]).delete()
+
+        output = StringIO()
+        call_command("recompute_covers", "--dry-run", "--workers", "1", "--chunk-size", "2", stdout=output)
+        self.assertEqual(output.getvalue().splitlines()[:2], ["2020-01-02 User 1: 9.99 -> 1.50",
+                                                              "2020-01-03 User 2: none -> 1.00"])
+        self.assertIn("Would change 2 covers on 2 of 3 receipts", output.getvalue())
+        call_command("recompute_covers", "--since", "2020-01-03", "--workers", "1", stdout=StringIO())
+        output = StringIO()
+        call_command("recompute_covers", "--dry-run", "--workers", "1", stdout=output)
+        self.assertIn("Would change 1 covers on 1 of 3 receipts", output.getvalue())
+
+
+class SchedulerTests(SimpleTestCase):
+
+    def test_calls_run_in_deadline_order_on_one_thread(self):
+        scheduler = Scheduler("test-scheduler")
+        calls, threads = [], set()
+        finished = threading.Event()
+
+        def call(name):
+            calls.append(name)
+            threads.add(threading.current_thread().name)
+            if name == "last":
+                finished.set()
+
+        start = time.monotonic()
+        scheduler.call_at(start + 0.06, call, "last")
+        scheduler.call_at(start + 0.02, call, "first")
+        scheduler.call_at(start + 0.04, call, "cancelled").cancel()
+        scheduler.call_at(start + 0.04, call, "second")
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(calls, ["first", "second", "last"])
+        self.assertEqual(threads, {"test-scheduler"})
+        self.assertEqual(scheduler.runs, 3)
+
+
+class LobbyStoreTests(TestCase):
+
+    def test_transitions_are_atomic(self):
+        store = MemoryLobbyStore()
+        store.transition("2020-01-01", lambda state: (new_state(), None))
+
+        def join(user_id):
+            for _ in range(50):
+                store.transition("2020-01-01", lambda state: ({**state, "all_users": state["all_users"] + [user_id]},
+                                                              None))
+
+        threads = [threading.Thread(target=join, args=(user_id,)) for user_id in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(Counter(store.get("2020-01-01")["all_users"]), {user_id: 50 for user_id in range(4)})
+        self.assertEqual(store.transition("2020-01-01", lambda state: (None, len(state["all_users"]))), 200)
+        self.assertIsNone(store.get("2020-01-01"))
+
+    def test_workers_taking_turns_keep_covers_up_to_date(self):
+        fixture = Fixture(100)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        fixture.session(worker, lobby=True)
+        first = GroupLobbyOrganizer._lobbies[fixture.date]
+        second = GroupLobbyOrganizer.Lobby(first.channel_layer, Receipt.objects.get(date=fixture.date))
+        try:
+            first.start_item_viewing()
+            turns = (fixture.users[1:3], fixture.users[2:5], [], fixture.users[:1], fixture.users[4:6])
+            for turn, users in enumerate(turns):
+                lobby = (second, first)[turn % 2]
+                set_active_users(lobby, users)
+                lobby.view_next_item()
+                covers = dict(Cover.objects.filter(transaction=fixture.receipt).exclude(user=fixture.receipt.payer)
+                              .values_list("user", "amount"))
+                expected = user_amounts(calculate_shares(ReceiptItems(fixture.receipt)))
+                self.assertEqual(lobby.final_shares(), expected)
+                self.assertEqual(covers, {user: amount for user, amount in expected.items()
+                                          if user != fixture.receipt.payer_id})
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+    def test_worker_losing_the_race_to_move_on_leaves_the_item_alone(self):
+        fixture = Fixture(10)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        fixture.session(worker, lobby=True)
+        first = GroupLobbyOrganizer._lobbies[fixture.date]
+        second = GroupLobbyOrganizer.Lobby(first.channel_layer, Receipt.objects.get(date=fixture.date))
+        try:
+            first.start_item_viewing()
+            set_active_users(first, fixture.users[1:3])
+            # The second worker read the lobby when other users were picked, then the first moved on before it did.
+            stale = {**first.get_state(), "active_users": [user.buy_index for user in fixture.users[4:6]]}
+            first.view_next_item()
+            second.get_state = lambda: stale
+            second.view_next_item()
+            self.assertEqual(Item.objects.get(pk=first.items[0].pk).buyers,
+                             make_bitset(user.bit for user in fixture.users[1:3]))
+            self.assertEqual(first.get_state()["item_index"], 1)
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+    def test_another_worker_finishes_an_abandoned_countdown(self):
+        fixture = Fixture(10)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        fixture.session(worker, lobby=True)
+        first = GroupLobbyOrganizer._lobbies[fixture.date]
+        try:
+            first.activate_user(fixture.users[0])
+            self.assertTrue(first.timers)
+            self.assertIsNotNone(first.get_state()["deadline"])
+            # The first worker goes away partway through the countdown.
+            first.cancel_countdown()
+            GroupLobbyOrganizer._lobbies.clear()
+            first.transition(lambda state: ({**state, "deadline": time.time() - TAKEOVER_SECONDS - 1}, None))
+
+            # Another worker's sweep finds it, without anyone in the lobby sending a message.
+            self.assertEqual(lobby_store.overdue(time.time() - TAKEOVER_SECONDS), [fixture.date])
+            GroupLobbyOrganizer.finish_overdue_countdowns(first.channel_layer)
+            second = GroupLobbyOrganizer._lobbies[fixture.date]
+            self.assertIsNot(second, first)
+            state = second.get_state()
+            self.assertTrue(state["viewing"])
+            self.assertEqual(state["item_index"], 0)
+            self.assertEqual(state["all_users"], [fixture.users[0].buy_index])
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+    def test_finished_lobby_closes_its_sessions(self):
+        fixture = Fixture(10)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        uuid = fixture.session(worker, lobby=True)
+        lobby = GroupLobbyOrganizer._lobbies[fixture.date]
+        try:
+            lobby.start_item_viewing()
+            for _ in range(len(lobby.items)):
+                lobby.view_next_item()
+            self.assertIsNone(lobby.get_state())
+            # The websocket consumer passes the close on to the worker with its session's uuid.
+            worker.lobby_close({"type": "lobby_close", "uuid": uuid, "receipt_date": fixture.date})
+            self.assertIsNone(worker.sessions[uuid].lobby)
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+
+class RecordingChannelLayer(InMemoryChannelLayer):
+
+    def __init__(self):
+        super().__init__()
+        self.group_messages = []
+
+    async def group_send(self, group, message):
+        self.group_messages.append(message)
+        await super().group_send(group, message)
+
+
+class LobbyDeltaTests(TestCase):
+
+    def test_moving_on_sends_one_frame(self):
+        fixture = Fixture(10)
+        user_directory.invalidate()
+        worker = fixture.worker()
+        fixture.session(worker, lobby=True)
+        lobby = GroupLobbyOrganizer._lobbies[fixture.date]
+        Item.objects.filter(receipt=fixture.receipt).update(imgSrc="item.jpeg")
+        try:
+            lobby.start_item_viewing()
+            set_active_users(lobby, fixture.users[1:3])
+            lobby.channel_layer = RecordingChannelLayer()
+            lobby.view_next_item()
+            self.assertEqual(len(lobby.channel_layer.group_messages), 1)
+            delta = lobby.channel_layer.group_messages[0]["update"]
+            self.assertEqual((delta["type"], delta["version"]), ("lobby_delta", LOBBY_DELTA_VERSION))
+            types = [update["type"] for update in delta["updates"]]
+            self.assertEqual(types[0], "lobby_item_change")
+            self.assertEqual(delta["updates"][0]["preload"],
+                             [item["src"] for item in lobby.serialized_items[2:2 + PRELOAD_ITEMS]])
+            self.assertTrue(delta["updates"][0]["preload"])
+            self.assertIn("lobby_user_change", types)
+            self.assertEqual(len(set(types)), len(types))
+
+            lobby.channel_layer.group_messages.clear()
+            lobby.send_time(3)
+            self.assertEqual([message["update"] for message in lobby.channel_layer.group_messages],
+                             [{"type": "lobby_time_change", "time": 3}])
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+
+class ShardTests(SimpleTestCase):
+
+    def test_adding_a_shard_only_moves_sessions_onto_it(self):
+        uuids = ["session-{}".format(index) for index in range(2000)]
+        before = HashRing(worker_channels(4))
+        after = HashRing(worker_channels(5))
+        shard_sizes = Counter(before.node(uuid) for uuid in uuids)
+        self.assertEqual(len(shard_sizes), 4)
+        self.assertGreater(min(shard_sizes.values()), len(uuids) / 4 * 0.7)
+        moved = [uuid for uuid in uuids if before.node(uuid) != after.node(uuid)]
+        self.assertEqual({after.node(uuid) for uuid in moved}, {"user_action.4"})
+        self.assertLess(len(moved), len(uuids) / 5 * 1.3)
+
+    def test_one_shard_is_the_plain_channel(self):
+        self.assertEqual(worker_channels(1), ["user_action"])
+
+
+class ShardedLobbyTests(TestCase):
+
+    def test_lobby_with_users_on_two_shards_keeps_covers_up_to_date(self):
+        fixture = Fixture(100)
+        user_directory.invalidate()
+        # Each shard is its own process, with its own lobby handles.
+        process_lobbies = GroupLobbyOrganizer._lobbies
+        shard_lobbies = [{}, {}]
+        workers, sessions = [], []
+        try:
+            for shard in range(2):
+                GroupLobbyOrganizer._lobbies = shard_lobbies[shard]
+                workers.append(fixture.worker())
+                sessions.append(fixture.session(workers[shard], user_index=shard, lobby=True))
+            shard_lobbies[0][fixture.date].start_item_viewing()
+            for turn, status in enumerate(["true", "false", "true", "true", "false", "true"]):
+                shard = turn % 2
+                GroupLobbyOrganizer._lobbies = shard_lobbies[shard]
+                lobby = shard_lobbies[shard][fixture.date]
+                act(workers[shard], sessions[shard], "change_status", new_status=status)
+                # The countdown goes off on this shard, right away.
+                lobby.cancel_countdown()
+                lobby.view_next_item()
+                lobby.cancel_countdown()
+                covers = dict(Cover.objects.filter(transaction=fixture.receipt).exclude(user=fixture.receipt.payer)
+                              .values_list("user", "amount"))
+                expected = user_amounts(calculate_shares(ReceiptItems(fixture.receipt)))
+                self.assertEqual(lobby.final_shares(), expected)
+                self.assertEqual(covers, {user: amount for user, amount in expected.items()
+                                          if user != fixture.receipt.payer_id})
+        finally:
+            for lobbies in shard_lobbies:
+                GroupLobbyOrganizer._lobbies = lobbies
+                close_lobbies()
+            GroupLobbyOrganizer._lobbies = process_lobbies
+            user_directory.invalidate()
+
+
+    def test_user_can_only_log_in_on_one_shard(self):
+        fixture = Fixture(10)
+        user_directory.invalidate()
+        user = fixture.users[0]
+        workers = [fixture.worker(), fixture.worker()]
+        try:
+            for shard, worker in enumerate(workers):
+                worker.session_connect({"uuid": "shard-{}".format(shard)})
+            self.assertEqual(act(workers[0], "shard-0", "login", username=user.username,
+                                 password=user.password)["type"], "user_change")
+            response = act(workers[1], "shard-1", "login", username=user.username, password=user.password)
+            self.assertEqual(response["message"], "You are already logged in.")
+
+            # Logging out, or the session going away, lets the user log in somewhere else.
+            workers[0].session_disconnect({"uuid": "shard-0"})
+            self.assertEqual(act(workers[1], "shard-1", "login", username=user.username,
+                                 password=user.password)["type"], "user_change")
+        finally:
+            close_lobbies()
+            user_directory.invalidate()
+
+
+class QueryPlanTests(TestCase):
+
+    def test_hot_queries_use_indexes(self):
+        results = suites["query_plans"]({"sizes": [1000], "repeat": 1})
+        self.assertEqual([result["name"] for result in results if result["full_scan"]], [])
+
+
+class BudgetTests(TestCase):
+
+    def test_every_endpoint_and_action_has_a_budget(self):
+        self.assertEqual(set(GroupCostWorker.action_params) - set(calls), set())
+        fixture = Fixture(10)
+        for name in calls:
+            measure(fixture, name, 1)
+        self.assertEqual({pattern.callback for pattern in urlpatterns} - fixture.views, set())
+
+    def test_calls_stay_within_budget(self):
+        self.assertEqual(over_budget(run_budgets([100, 2500]), timed=False), [])
+
+
+class LockRetryTests(TransactionTestCase):
+
+    def test_locked_writes_are_retried(self):
+        attempts = []
+
+        @retry_when_locked
+        def write():
+            attempts.append(len(attempts))
+            if len(attempts) < 3:
+                raise OperationalError("database is locked")
+            return "written"
+
+        self.assertEqual(write(), "written")
+        self.assertEqual(len(attempts), 3)
+
+    def test_other_errors_are_not_retried(self):
+        attempts = []
+
+        @retry_when_locked
+        def write():
+            attempts.append(len(attempts))
+            raise OperationalError("no such table: cost_claimer_item")
+
+        with self.assertRaises(OperationalError):
+            write()
+        self.assertEqual(len(attempts), 1)
@@ -0,0 +1,129 @@
+import hashlib
+import io
+import os
+import re as regex
+import tempfile
+
+from django.conf import settings
+from PIL import Image, features
+
+# Longest side in pixels of every size variant. The review page shows items at 180px, so medium covers 2x screens.
+THUMBNAIL_SIZES = {
+    "small": 120,
+    "medium": 360,
+}
+
+WEBP_SUPPORTED = features.check("webp")
+
+CONTENT_TYPES = {
+    "WEBP": "image/webp",
+    "JPEG": "image/jpeg",
+}
+
+_date_pattern = regex.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# (thumbnail path, mtime) -> ETag, so the sidecar files are only read once per process.
+_etags = {}
+
+
+class UnknownImage(Exception):
+    pass
+
+
+def negotiate_format(accept_header):
+    return "WEBP" if WEBP_SUPPORTED and "image/webp" in accept_header else "JPEG"
+
+
+def source_path(receipt_date, img_src):
+    # Both parts come from URLs, so make sure they can't point outside the image directory.
+    if not _date_pattern.match(receipt_date) or not img_src or os.path.basename(img_src) != img_src or \
+            img_src.startswith("."):
+        raise UnknownImage(img_src)
+    return os.path.join(settings.RECEIPT_IMAGE_DIR, receipt_date, img_src)
+
+
+def thumbnail_path(receipt_date, img_src, size, image_format):
+    return os.path.join(
+        settings.THUMBNAIL_CACHE_DIR, size, receipt_date, "{}.{}".format(img_src, image_format.lower())
+    )
+
+
+def write_atomically(path, data):
+    # Written under a temporary name first so readers never see a partial file. The name is unique to this call, so
+    # threads and processes writing the same file at once don't write over each other's.
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                     delete=False) as temporary:
+        try:
+            temporary.write(data)
+        except BaseException:
+            temporary.close()
+            os.remove(temporary.name)
+            raise
+    os.replace(temporary.name, path)
+
+
+def render_thumbnail(source, destination, size, image_format):
+    """
+    Writes a resized copy of source to destination and returns its ETag (a hash of the written bytes).
+    """
+    try:
+        image = Image.open(source)
+    except OSError:
+        raise UnknownImage(source)
+    with image:
+        image.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]), Image.LANCZOS)
+        if image_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGBA")
+            flattened = Image.new("RGB", image.size, (255, 255, 255))
+            flattened.paste(image, mask=image.split()[3])
+            image = flattened
+        thumbnail = io.BytesIO()
+        image.save(thumbnail, image_format, quality=80)
+    thumbnail = thumbnail.getvalue()
+    etag = hashlib.sha256(thumbnail).hexdigest()[:32]
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    write_atomically(destination + ".etag", etag.encode())
+    write_atomically(destination, thumbnail)
+    return etag
+
+
+def get_thumbnail(receipt_date, img_src, size, image_format):
+    """
+    Returns the path and ETag of a thumbnail, rendering it first if it's missing or older than its source image.
+    """
+    if size not in THUMBNAIL_SIZES or image_format not in CONTENT_TYPES:
+        raise UnknownImage(img_src)
+    source = source_path(receipt_date, img_src)
+    destination = thumbnail_path(receipt_date, img_src, size, image_format)
+    try:
+        source_mtime = os.stat(source).st_mtime_ns
+    except OSError:
+        raise UnknownImage(img_src)
+    try:
+        destination_mtime = os.stat(destination).st_mtime_ns
+    except OSError:
+        destination_mtime = None
+
+    if destination_mtime is None or destination_mtime < source_mtime:
+        etag = render_thumbnail(source, destination, size, image_format)
+        _etags[(destination, os.stat(destination).st_mtime_ns)] = etag
+        return destination, etag
+
+    key = (destination, destination_mtime)
+    if key not in _etags:
+        try:
+            with open(destination + ".etag") as etag_file:
+                _etags[key] = etag_file.read().strip()
+        except OSError:
+            return destination, render_thumbnail(source, destination, size, image_format)
+    return destination, _etags[key]
+
+
+def make_thumbnails(receipt_date, img_src):
+    """
+    Renders every size and format of an item image ahead of time.
+    """
+    formats = ["WEBP", "JPEG"] if WEBP_SUPPORTED else ["JPEG"]
+    for size in THUMBNAIL_SIZES:
+        for image_format in formats:
+            get_thumbnail(receipt_date, img_src, size, image_format)
@@ -5,10 +5,15 @@ from . import views
 urlpatterns = [
     path('upload/receipt/', views.add_receipt),
     path('upload/items/', views.add_items),
+    path('upload/receipt_items/', views.add_receipt_items),
+    path('taxability/', views.get_taxability),
     re_path('user/(.*)/', views.get_user),
     path('users/', views.get_user),
     re_path(r'receipt/(.*)/', views.get_receipt),
     path('receipts/', views.get_receipt),
     path('valid_receipts/', views.get_valid_receipts),
+    path('receipt_index/', views.get_receipt_index),
+    path('settle_up/', views.get_settle_up_transfers),
+    path('thumbnail/<str:size>/<str:receipt_date>/<str:img_src>', views.get_thumbnail),
     re_path(r'.*/$', views.index),
 ]
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from .cache_versions import USERS_KEY, get_version
+from .models import User, iter_bits
+
+
+class UserDirectory(object):
+    """
+    Every User, loaded once per process and looked up by id, bit, name, username or roommate label.
+    Saves and deletes in this process clear it right away through signals. Changes made by other processes
+    (like the admin site for the worker) are noticed by checking the users CacheVersion every CHECK_INTERVAL seconds.
+    Users handed out are shared, so only change them right before saving them.
+    """
+    CHECK_INTERVAL = 2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = None
+        self._version = None
+        self._checked_at = 0
+
+    def invalidate(self):
+        self._indexes = None
+
+    def _load(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._indexes is not None and now - self._checked_at < self.CHECK_INTERVAL:
+                return self._indexes
+            version = get_version(USERS_KEY)
+            self._checked_at = now
+            if self._indexes is not None and version == self._version:
+                return self._indexes
+            users = list(User.objects.order_by("buy_index"))
+            self._indexes = {
+                "all": users,
+                "id": {user.buy_index: user for user in users},
+                "bit": {user.bit: user for user in users if user.bit is not None},
+                "name": {user.name: user for user in users},
+                "username": {user.username: user for user in users if user.username},
+                "label": {user.label: user for user in users if user.bit is not None},
+            }
+            self._version = version
+            return self._indexes
+
+    def all(self):
+        return list(self._load()["all"])
+
+    def others(self, user):
+        return [other for other in self._load()["all"] if other.buy_index != user.buy_index]
+
+    def get(self, buy_index):
+        try:
+            return self._load()["id"].get(int(buy_index))
+        except (TypeError, ValueError):
+            return None
+
+    def by_bit(self, bit):
+        return self._load()["bit"].get(bit)
+
+    def buyers(self, bitset):
+        """
+        Returns the users whose bits are set, skipping bits left behind by deleted users.
+        """
+        bits = self._load()["bit"]
+        return [bits[bit] for bit in iter_bits(bitset) if bit in bits]
+
+    def by_name(self, name):
+        return self._load()["name"].get(name)
+
+    def by_username(self, username):
+        return self._load()["username"].get(username)
+
+    def by_label(self, label):
+        return self._load()["label"].get(label)
+
+    def authenticate(self, username, password):
+        user = self.by_username(username)
+        if user is not None and user.password is not None and user.password == password:
+            return user
+        return None
+
+
+user_directory = UserDirectory()
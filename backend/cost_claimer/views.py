@@ -1,33 +1,85 @@
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.http import FileResponse, Http404
 from django.shortcuts import redirect
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 
+import hashlib
 import json
-from decimal import Decimal
+from datetime import date as Date
+from decimal import Decimal, InvalidOperation
 
-from .models import Receipt, Item, User
+from .cache_versions import LEDGER_KEY, RECEIPTS_KEY, bump_version, get_version_info, receipt_key
+from .database import retry_when_locked
+from .ledger import get_settle_up
+from .models import Receipt, Item
+from .response_cache import cached_data
 from .serializers import ReceiptSerializer, ItemSerializer, UserSerializer
+from .user_directory import user_directory
+from . import thumbnails
+
+
+RECEIPT_INDEX_PAGE_SIZE = 100
+RECEIPT_INDEX_MAX_PAGE_SIZE = 1000
+
+# Receipt fields that an upload to an existing receipt has to match
+RECEIPT_TOTALS = ("subtotal", "tax", "total", "tax_rate")
 
 
 def getDecimals(data, *args):
     return [Decimal(data[key]) for key in args]
 
 
+def getBoolean(value):
+    # Form encoded uploads send booleans as strings, and bool("false") would be True.
+    if isinstance(value, bool):
+        return value
+    if value in ("true", "false"):
+        return value == "true"
+    raise ValueError("Expected a boolean, got {!r}".format(value))
+
+
+def plural(count, noun):
+    return "{} {}{}".format(count, noun, "s" if count != 1 else "")
+
+
+def versioned_validators(request, key):
+    """
+    Returns an ETag and Last-Modified timestamp for a response built from the rows versioned by key.
+    The ETag covers the full path too, since the query string changes what is returned.
+    """
+    version, modified = get_version_info(key)
+    digest = hashlib.sha1(request.get_full_path().encode()).hexdigest()[:16]
+    return '"{}-{}"'.format(version, digest), modified and int(modified.timestamp())
+
+
+def add_validators(response, etag, modified):
+    response["ETag"] = etag
+    if modified:
+        response["Last-Modified"] = http_date(modified)
+    return response
+
+
 def index(request):
     hostname = request.get_host().split(":")[0]
     return redirect("http://{}:3000/".format(hostname))
 
 
 @api_view(['POST'])
+@retry_when_locked
 def add_receipt(request):
     if request.method == 'POST':
         date = request.data["date"]
         if Receipt.objects.filter(date=date).exists():
             return Response("Receipt Already Exists", status=409)
-        payer = User.objects.filter(buy_index=request.data["payer"]).first()
+        payer = user_directory.get(request.data["payer"])
         if payer:
             subtotal, tax, total, tax_rate = getDecimals(request.data, "subtotal", "tax", "total", "tax_rate")
-            Receipt(date=date, subtotal=subtotal, tax=tax, total=total, tax_rate=tax_rate, payer=payer).save()
+            Receipt.objects.create(date=date, subtotal=subtotal, tax=tax, total=total, tax_rate=tax_rate, payer=payer)
             return Response("Receipt Added")
         else:
             return Response("Unknown User for Payer", status=406)
@@ -35,6 +87,7 @@ def add_receipt(request):
 
 
 @api_view(['POST'])
+@retry_when_locked
 def add_items(request):
     if request.method == 'POST':
         newItems = 0
@@ -54,7 +107,7 @@ def add_items(request):
                     name=item["name"],
                     count=int(item["count"]),
                     price=Decimal(item["price"]),
-                    imgSrc=item["imgSrc"],
+                    imgSrc=item.get("imgSrc") or "",
                     taxed=item["taxed"]
                 ).save()
         if newItems:
@@ -67,22 +120,116 @@ def add_items(request):
     return Response("Invalid Request")
 
 
+@api_view(['POST'])
+@retry_when_locked
+def add_receipt_items(request):
+    """
+    Uploads a receipt and all of its items in one transaction.
+    A receipt that already exists only gets the items it doesn't have yet, and only if its totals and payer match the
+    upload. Otherwise nothing changes and the fields that differ are returned as conflicts.
+    """
+    if request.method == 'POST':
+        try:
+            date = Date.fromisoformat(request.data["date"])
+            items = request.data["items"]
+            if isinstance(items, str):
+                items = json.loads(items)
+            itemValues = [{
+                "name": item["name"],
+                "count": int(item["count"]),
+                "price": Decimal(item["price"]),
+                # Items without an image leave it out.
+                "imgSrc": item.get("imgSrc") or "",
+                "taxed": getBoolean(item["taxed"]),
+            } for item in items]
+            receiptValues = dict(zip(RECEIPT_TOTALS, getDecimals(request.data, *RECEIPT_TOTALS)))
+        except (KeyError, TypeError, ValueError, InvalidOperation):
+            return Response("Invalid Receipt Upload", status=400)
+        payer = user_directory.get(request.data.get("payer"))
+        if not payer:
+            return Response("Unknown User for Payer", status=406)
+
+        try:
+            with transaction.atomic():
+                receipt = Receipt.objects.filter(date=date).first()
+                receiptCreated = receipt is None
+                if receiptCreated:
+                    receipt = Receipt.objects.create(date=date, payer=payer, **receiptValues)
+                    knownNames = set()
+                else:
+                    conflicts = [field for field, value in receiptValues.items() if getattr(receipt, field) != value]
+                    if receipt.payer_id != payer.buy_index:
+                        conflicts.append("payer")
+                    if conflicts:
+                        return Response({
+                            "message": "Receipt Already Exists With a Different {}".format(", ".join(conflicts)),
+                            "receipt_created": False,
+                            "conflicts": conflicts,
+                        }, status=409)
+                    knownNames = set(Item.objects.filter(receipt=receipt).values_list("name", flat=True))
+
+                newItems = []
+                outcomes = []
+                for values in itemValues:
+                    if values["name"] in knownNames:
+                        outcomes.append({"name": values["name"], "status": "duplicate"})
+                    else:
+                        knownNames.add(values["name"])
+                        newItems.append(Item(receipt=receipt, **values))
+                        outcomes.append({"name": values["name"], "status": "added"})
+                Item.objects.bulk_create(newItems)
+                if newItems and not receiptCreated:
+                    # bulk_create doesn't send the signals that would normally do this.
+                    bump_version(receipt_key(receipt.date))
+        except IntegrityError:
+            # Another upload created the receipt or added some of the same items after they were checked for.
+            return Response("Receipt Changed During Upload, Try Again", status=409)
+
+        duplicateCount = len(outcomes) - len(newItems)
+        if newItems:
+            message = "Added {}".format(plural(len(newItems), "New Item"))
+            if duplicateCount:
+                message += ", Ignored {}".format(plural(duplicateCount, "Duplicate Item"))
+        else:
+            message = "All Items Were Duplicates, None Added"
+        if receiptCreated:
+            message = "Receipt Added, " + message
+        return Response({
+            "message": message,
+            "receipt_created": receiptCreated,
+            "added": len(newItems),
+            "duplicates": duplicateCount,
+            "items": outcomes,
+        }, status=200 if newItems or receiptCreated else 409)
+    return Response("Invalid Request")
+
+
+@api_view(['GET'])
+def get_taxability(request):
+    """
+    Whether every uploaded item was taxed, by item name and by image name, for seeding the receipt parser.
+    Later receipts win when the same item was marked differently.
+    """
+    if request.method == 'GET':
+        names, images = {}, {}
+        for name, imgSrc, taxed in Item.objects.order_by("receipt_id", "id").values_list("name", "imgSrc", "taxed"):
+            names[name] = taxed
+            if imgSrc:
+                images[imgSrc] = taxed
+        return Response({"names": names, "images": images})
+    return Response("Invalid Request")
+
+
 @api_view(['GET'])
 def get_user(request, roommate=None):
     if request.method == 'GET':
-        data = None
         if roommate:
-            roommateIndex = None
-            for buy_index, buyName in User.buy_indexes:
-                if buyName == roommate:
-                    roommateIndex = buy_index
-                    break
-            if roommateIndex:
-                data = User.objects.filter(buy_index=roommateIndex).first()
-            if not data:
+            user = user_directory.by_label(roommate)
+            if not user:
                 return Response("No Associated Roommate Found")
+            data = [user]
         else:
-            data = User.objects.all()
+            data = user_directory.all()
         results = UserSerializer(data, context={'request': request}, many=True).data
         return Response(results)
     return Response("Invalid Request")
@@ -92,16 +239,32 @@ def get_user(request, roommate=None):
 def get_receipt(request, receipt_date=None):
     if request.method == 'GET':
         if receipt_date:
-            receiptEntry = Receipt.objects.filter(date=receipt_date).first()
-            if receiptEntry:
+            imageSize = request.query_params.get("size")
+
+            def build():
+                try:
+                    receiptEntry = Receipt.objects.filter(date=receipt_date).first()
+                except ValidationError:
+                    return None
+                if not receiptEntry:
+                    return None
                 receiptDetails = ReceiptSerializer(receiptEntry, context={'request': request}).data
-                itemList = Item.objects.filter(receipt=receiptEntry)
-                itemData = ItemSerializer(itemList, context={'request': request}, many=True).data
-                return Response({**dict(receiptDetails), "items": itemData})
+                # Going through item_set hands every item the receipt, so makeURL doesn't fetch it again per item.
+                itemData = ItemSerializer(receiptEntry.item_set.all(), many=True, context={
+                    'request': request,
+                    'image_size': imageSize,
+                }).data
+                return {**dict(receiptDetails), "items": itemData}
+
+            payload = cached_data("receipt:{}:{}".format(receipt_date, imageSize), [receipt_key(receipt_date)], build)
+            if payload:
+                return Response(payload)
             else:
                 return Response("Receipt not found.")
         else:
-            results = ReceiptSerializer(Receipt.objects.all(), context={'request': request}, many=True).data
+            results = cached_data("receipts", [RECEIPTS_KEY], lambda: ReceiptSerializer(
+                Receipt.objects.all(), context={'request': request}, many=True
+            ).data)
             return Response(results)
     return Response("Invalid Request")
 
@@ -109,5 +272,74 @@ def get_receipt(request, receipt_date=None):
 @api_view(['GET'])
 def get_valid_receipts(request):
     if request.method == "GET":
-        all_receipts = ReceiptSerializer(Receipt.objects.all(), context={'request': request}, many=True).data
-        return Response([receipt["date"] for receipt in all_receipts])
+        etag, modified = versioned_validators(request, RECEIPTS_KEY)
+        notModified = get_conditional_response(request, etag=etag, last_modified=modified)
+        if notModified is not None:
+            return add_validators(notModified, etag, modified)
+        dates = cached_data("valid_receipts", [RECEIPTS_KEY], lambda: [
+            str(receipt_date) for receipt_date in Receipt.objects.order_by("date").values_list("date", flat=True)
+        ])
+        return add_validators(Response(dates), etag, modified)
+
+
+@api_view(['GET'])
+def get_settle_up_transfers(request):
+    """
+    The fewest transfers (or close to it) that would settle every balance in the household.
+    """
+    if request.method == "GET":
+        etag, modified = versioned_validators(request, LEDGER_KEY)
+        notModified = get_conditional_response(request, etag=etag, last_modified=modified)
+        if notModified is not None:
+            return add_validators(notModified, etag, modified)
+        return add_validators(Response(get_settle_up()), etag, modified)
+
+
+@api_view(['GET'])
+def get_receipt_index(request):
+    """
+    Receipt dates in order, optionally between since and until (inclusive), a page at a time.
+    Pass the returned next_cursor as cursor to get the following page; it is null on the last page.
+    """
+    if request.method == "GET":
+        etag, modified = versioned_validators(request, RECEIPTS_KEY)
+        notModified = get_conditional_response(request, etag=etag, last_modified=modified)
+        if notModified is not None:
+            return add_validators(notModified, etag, modified)
+
+        try:
+            bounds = {
+                lookup: Date.fromisoformat(request.query_params[param])
+                for param, lookup in [("since", "date__gte"), ("until", "date__lte"), ("cursor", "date__gt")]
+                if param in request.query_params
+            }
+            limit = int(request.query_params.get("limit", RECEIPT_INDEX_PAGE_SIZE))
+        except ValueError:
+            return Response("Invalid Receipt Index Parameters", status=400)
+        limit = max(1, min(limit, RECEIPT_INDEX_MAX_PAGE_SIZE))
+
+        dates = cached_data("receipt_index:{}:{}".format(sorted(bounds.items()), limit), [RECEIPTS_KEY], lambda: [
+            str(receipt_date) for receipt_date in
+            Receipt.objects.filter(**bounds).order_by("date").values_list("date", flat=True)[:limit + 1]
+        ])
+        return add_validators(Response({
+            "receipts": dates[:limit],
+            "next_cursor": dates[limit - 1] if len(dates) > limit else None,
+        }), etag, modified)
+
+
+@require_safe
+def get_thumbnail(request, size, receipt_date, img_src):
+    image_format = thumbnails.negotiate_format(request.META.get("HTTP_ACCEPT", ""))
+    try:
+        path, etag = thumbnails.get_thumbnail(receipt_date, img_src, size, image_format)
+    except thumbnails.UnknownImage:
+        raise Http404("Unknown Image")
+    etag = '"{}"'.format(etag)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = FileResponse(open(path, "rb"), content_type=thumbnails.CONTENT_TYPES[image_format])
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=86400)
+    patch_vary_headers(response, ["Accept"])
+    return response
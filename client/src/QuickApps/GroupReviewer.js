@@ -1,4 +1,5 @@
 import React from "react";
+import {unstable_batchedUpdates} from "react-dom";
 import styled from "styled-components";
 
 import {Label, GroupBlock, MyButton, MyInput, MyImage, UserRequired,
@@ -133,13 +134,21 @@ function makeShares(users, self_id, payer_id, shares) {
 }
 
 function fixItem(item) {
-    item.src = `http://${ipAddress}:8000/${item.src}`;
+    // Items from paper receipts have no image.
+    item.src = item.src === null ? null : `http://${ipAddress}:8000/${item.src}`;
     const price = Number(item.price);
     item.total_price = (item.count * price * (item.taxed ? 1.08 : 1)).toFixed(2);
     item.taxed = item.taxed ? "Yes" : "No";
     item.price = price.toFixed(2);
 }
 
+// Starts loading the images of items the lobby will show next, so they're cached by the time they're shown.
+function preloadImages(sources) {
+    for (const source of sources || []) {
+        new Image().src = `http://${ipAddress}:8000/${source}`;
+    }
+}
+
 class GroupReviewer extends React.Component {
 
     constructor(props) {
@@ -171,7 +180,9 @@ class GroupReviewer extends React.Component {
             ["lobby_finished", this.onLobbyFinish],
             ["lobby_error", this.displayError],
             ["lobby_item_claim", this.onLobbyItemClaim],
+            ["lobby_delta", this.onLobbyDelta],
         ];
+        this.lobbyUpdateHandlers = Object.fromEntries(this.listeners);
     };
 
     componentDidMount() {
@@ -226,11 +237,12 @@ class GroupReviewer extends React.Component {
         this.displayError({message: "Please fill in all fields."});
     };
 
-    onLobbyJoin = ({lobby_state: {all_users, active_users, time, item, exclusive_active_user}}) => {
+    onLobbyJoin = ({lobby_state: {all_users, active_users, time, item, exclusive_active_user, preload}}) => {
         this.inLobby = true;
         if (item !== null) {
             fixItem(item);
         }
+        preloadImages(preload);
         const {user: {user_id: self_id}} = this.props;
         this.setState(({
             onlineUsers: new Set(all_users),
@@ -254,8 +266,9 @@ class GroupReviewer extends React.Component {
         this.setState({time});
     };
 
-    onLobbyItemChange = ({item, active_users}) => {
+    onLobbyItemChange = ({item, active_users, preload}) => {
         fixItem(item);
+        preloadImages(preload);
         this.setState(({pageMaker}) => {
             if (pageMaker !== this.makeItemViewingPage) {
                 return {
@@ -288,6 +301,19 @@ class GroupReviewer extends React.Component {
         })
     };
 
+    // Deltas hold the updates from one lobby event, which are applied in order and rendered once.
+    // Updates this version doesn't know about (from a newer server) are skipped.
+    onLobbyDelta = ({updates}) => {
+        unstable_batchedUpdates(() => {
+            for (const update of updates) {
+                const handler = this.lobbyUpdateHandlers[update.type];
+                if (handler && handler !== this.onLobbyDelta) {
+                    handler(update);
+                }
+            }
+        });
+    };
+
     joinLobby = () => {
         const receipt_date = this.input1.current.value.trim();
         if (receipt_date) {
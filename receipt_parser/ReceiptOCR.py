@@ -0,0 +1,203 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import json
+import os
+import re as regex
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+from ReceiptParser import Receipt, add_tax_arguments, ask_payer, load_tax_index, print_failure_report
+
+# OCR results are stored here by image hash so re-running a receipt doesn't OCR it again.
+OCR_CACHE_DIR = ".ocr_cache"
+# Bump this when preprocessing changes so old cached results aren't reused.
+OCR_CACHE_VERSION = 1
+
+# Angles (in degrees) tried when straightening a photo
+DESKEW_ANGLES = np.arange(-5, 5.25, 0.25)
+# Rows with less than this fraction of dark pixels are treated as the gap between two lines
+LINE_INK_THRESHOLD = 0.005
+LINE_PADDING = 4
+
+# Item lines look like "GV MILK 1GAL 007874235186 F 3.48 N"
+ITEM_LINE = regex.compile(
+    r"^(?P<name>.+?)\s+(?P<upc>\d{6,14})\s*[A-Z]?\s+(?P<price>\d+\.\d\d)\s*(?P<flag>[NXOT])?\s*$"
+)
+SUBTOTAL_LINE = regex.compile(r"^SUB\s?TOTAL\s+\$?(?P<amount>\d+\.\d\d)")
+TAX_LINE = regex.compile(r"^TAX\s*\d?\s+(?P<rate>\d+\.\d+)\s*%\s+\$?(?P<amount>\d+\.\d\d)")
+TOTAL_LINE = regex.compile(r"^TOTAL\s+\$?(?P<amount>\d+\.\d\d)")
+DATE_LINE = regex.compile(r"(?P<month>\d\d)/(?P<day>\d\d)/(?P<year>\d\d)\b")
+
+# An N or O at the end of an item line means it wasn't taxed, an X or T means it was.
+TAXED_FLAGS = {"X": True, "T": True, "N": False, "O": False}
+
+
+def image_digest(imagePath):
+    digest = hashlib.sha256(str(OCR_CACHE_VERSION).encode())
+    with open(imagePath, "rb") as imageFile:
+        for chunk in iter(lambda: imageFile.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def binarize(pixels):
+    """
+    Returns a boolean array that is True for ink, using Otsu's threshold on the grayscale pixels.
+    """
+    histogram = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weightBelow = np.cumsum(histogram)
+    weightAbove = weightBelow[-1] - weightBelow
+    sumBelow = np.cumsum(histogram * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        meanBelow = sumBelow / weightBelow
+        meanAbove = (sumBelow[-1] - sumBelow) / weightAbove
+        betweenVariance = weightBelow * weightAbove * (meanBelow - meanAbove) ** 2
+    threshold = int(np.nanargmax(betweenVariance))
+    return pixels <= threshold
+
+
+def find_skew(ink):
+    """
+    Finds the rotation that lines the text up with the rows, which is when the row sums are the most uneven.
+    """
+    # A smaller copy is plenty for finding the angle.
+    scale = max(1, max(ink.shape) // 800)
+    sample = Image.fromarray((ink[::scale, ::scale] * 255).astype(np.uint8))
+    scores = [np.var(np.asarray(sample.rotate(angle, expand=True)).sum(axis=1, dtype=np.int64))
+              for angle in DESKEW_ANGLES]
+    return float(DESKEW_ANGLES[int(np.argmax(scores))])
+
+
+def preprocess(imagePath):
+    """
+    Returns the straightened, binarized receipt as a uint8 array of black text on white.
+    """
+    with Image.open(imagePath) as image:
+        grayscale = image.convert("L")
+    ink = binarize(np.asarray(grayscale))
+    angle = find_skew(ink)
+    if angle:
+        rotated = Image.fromarray((ink * 255).astype(np.uint8)).rotate(angle, expand=True, resample=Image.BILINEAR)
+        ink = np.asarray(rotated) > 127
+    return np.where(ink, 0, 255).astype(np.uint8)
+
+
+def split_lines(page):
+    """
+    Splits a preprocessed page into horizontal bands with one line of text each.
+    """
+    inkPerRow = (page == 0).mean(axis=1)
+    hasInk = np.concatenate(([False], inkPerRow > LINE_INK_THRESHOLD, [False]))
+    edges = np.flatnonzero(hasInk[1:] != hasInk[:-1])
+    lines = []
+    for top, bottom in zip(edges[::2], edges[1::2]):
+        if bottom - top < 3:
+            continue
+        lines.append(page[max(0, top - LINE_PADDING):bottom + LINE_PADDING])
+    return lines
+
+
+def ocr_line(line):
+    # Page segmentation mode 7 treats the image as one line of text.
+    return pytesseract.image_to_string(Image.fromarray(line), config="--psm 7").strip()
+
+
+def ocr_receipt(imagePath, pool):
+    """
+    Returns the text lines of a receipt photo, from the cache if it has been OCRed before.
+    """
+    cachePath = os.path.join(OCR_CACHE_DIR, image_digest(imagePath) + ".json")
+    try:
+        with open(cachePath) as cacheFile:
+            return json.load(cacheFile)
+    except (OSError, ValueError):
+        pass
+    lines = [text for text in pool.map(ocr_line, split_lines(preprocess(imagePath))) if text]
+    os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+    with open(cachePath + ".tmp", "w") as cacheFile:
+        json.dump(lines, cacheFile)
+    os.replace(cachePath + ".tmp", cachePath)
+    return lines
+
+
+def build_ocr_receipt(lines, payer, receiptDate=None):
+    """
+    Builds a Receipt from OCRed lines. Item names get their UPC added since paper receipts abbreviate them.
+    """
+    if receiptDate is None:
+        for line in lines:
+            date = DATE_LINE.search(line)
+            if date:
+                receiptDate = "20{}-{}-{}".format(date["year"], date["month"], date["day"])
+                break
+        else:
+            raise ValueError("No date found on receipt")
+    receipt = Receipt(payer, receiptDate)
+    for line in lines:
+        line = line.upper()
+        if SUBTOTAL_LINE.match(line):
+            receipt.subtotal = SUBTOTAL_LINE.match(line)["amount"]
+        elif TAX_LINE.match(line):
+            tax = TAX_LINE.match(line)
+            receipt.tax = tax["amount"]
+            receipt.taxRate = "{:.4f}".format(float(tax["rate"]) / 100)
+        elif TOTAL_LINE.match(line):
+            receipt.total = TOTAL_LINE.match(line)["amount"]
+        elif ITEM_LINE.match(line):
+            item = ITEM_LINE.match(line)
+            receipt.add_item(
+                name="{} ({})".format(item["name"].strip(), item["upc"]),
+                price=item["price"],
+                # Paper receipts don't have item images.
+                imgSrc=None,
+                taxed=TAXED_FLAGS.get(item["flag"]),
+            )
+    if not receipt.items:
+        raise ValueError("No items found on receipt")
+    return receipt
+
+
+def read_ocr_receipt(imagePath, payer, pool, receiptDate=None):
+    return build_ocr_receipt(ocr_receipt(imagePath, pool), payer, receiptDate)
+
+
+def parse_ocr_receipts(imagePaths, payer, workers=None, receiptDate=None, taxIndex=None, unknownPolicy="ask"):
+    """
+    OCRs and uploads receipt photos one at a time, with the lines of each photo spread across the process pool.
+    Returns a list of (path, stage, error) for every receipt that didn't make it.
+    """
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for imagePath in imagePaths:
+            try:
+                receipt = read_ocr_receipt(imagePath, payer, pool, receiptDate)
+            except Exception as error:
+                failures.append((imagePath, "parse", repr(error)))
+                continue
+            print("Uploading {} ({} items)".format(receipt.date, receipt.itemCount))
+            try:
+                if not receipt.post(taxIndex, unknownPolicy):
+                    failures.append((imagePath, "upload", "Rejected by the server"))
+            except Exception as error:
+                failures.append((imagePath, "upload", repr(error)))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uploads photographed or scanned paper Walmart receipts.")
+    parser.add_argument("images", nargs="+", help="Receipt photos or scans, one receipt per image")
+    parser.add_argument("--date", default=None,
+                        help="Receipt date (YYYY-MM-DD), if it can't be read off of the receipt")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes used to OCR lines (defaults to the number of cores)")
+    add_tax_arguments(parser)
+    args = parser.parse_args()
+
+    failures = parse_ocr_receipts(args.images, ask_payer(), args.workers, args.date,
+                                  load_tax_index(args.reseed_taxes), args.unknown_taxes)
+    print_failure_report(failures, len(args.images))
+    exit(1 if failures else 0)
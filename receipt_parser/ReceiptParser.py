@@ -1,22 +1,111 @@
 from bs4 import BeautifulSoup
-import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import argparse
+from decimal import Decimal
+import glob
+import hashlib
 import json
+import re as regex
 import requests
 from shutil import copyfile
 import os
 
+# lxml builds the document tree several times faster than the builtin parser, but it isn't required.
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
 # This should be the path from the root of the project to where receipt images should be stored.
 # Use forward slashes
 RELATIVE_IMAGE_EXPORT_PATH = "backend/static/receipt_items"
 
+RECEIPT_NAME_PATTERN = regex.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Image copies are mostly waiting on the disk, so a handful of threads keeps it busy.
+IMAGE_COPY_WORKERS = 8
+
+# Remembers which items are taxed so they only have to be asked about once.
+TAX_INDEX_PATH = "taxability.json"
+# What to do with items that aren't in the tax index
+UNKNOWN_TAX_POLICIES = ["ask", "taxed", "untaxed", "fail"]
+
+# Shared so every request to the server reuses a pooled keep-alive connection.
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+
+class UnknownTaxes(Exception):
+    pass
+
+
+class TaxabilityIndex:
+    """
+    Persistent lookup of whether items are taxed, by item name or by image name when the name is new.
+    It is seeded from the items already on the server and updated after every upload.
+    """
+
+    def __init__(self, path=TAX_INDEX_PATH):
+        self.path = path
+        self.names = {}
+        self.images = {}
+        try:
+            with open(path) as indexFile:
+                index = json.load(indexFile)
+            self.names, self.images = index["names"], index["images"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def __len__(self):
+        return len(self.names)
+
+    def seed(self):
+        response = session.get("http://localhost:8000/cost_claimer/taxability/")
+        response.raise_for_status()
+        index = response.json()
+        self.names.update(index["names"])
+        self.images.update(index["images"])
+        self.save()
+
+    def lookup(self, item):
+        if item.name in self.names:
+            return self.names[item.name]
+        if item.imgSrc:
+            return self.images.get(item.imgSrc)
+        return None
+
+    def record(self, item):
+        self.names[item.name] = item.taxed
+        if item.imgSrc:
+            self.images[item.imgSrc] = item.taxed
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as indexFile:
+            json.dump({"names": self.names, "images": self.images}, indexFile)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def ask_taxed(item):
+    print("Is {} for {} taxed? (y/n) ".format(item.name, item.price), )
+    while True:
+        taxed = input()
+        if taxed == "y":
+            return True
+        elif taxed == "n":
+            return False
+        print("Expected y or n")
+
 
 class Item:
 
-    def __init__(self, name, price, imgSrc):
+    def __init__(self, name, price, imgSrc, taxed=None):
         self.name = name
         self.count = 1
         self.price = price
         self.imgSrc = imgSrc
+        # None until it is known, paper receipts print it but order pages don't.
+        self.taxed = taxed
 
     def add_another(self):
         self.count = self.count + 1
@@ -48,86 +137,224 @@ class Receipt:
         self.subtotal = 0
         self.tax = 0
         self.total = 0
+        # Directory holding the saved page, its images are in <sourceDir>/<date>_files/
+        self.sourceDir = "."
 
-    def add_item(self, name, price, imgSrc):
+    def add_item(self, name, price, imgSrc, taxed=None):
         if name in self.items:
             self.items[name].add_another()
         else:
-            self.items[name] = Item(name, price, imgSrc)
+            self.items[name] = Item(name, price, imgSrc, taxed)
         self.itemCount += 1
 
-    def post(self):
-        receiptResponse = requests.post("http://localhost:8000/cost_claimer/upload/receipt/", data={
-            "payer": self.payer,
-            "date": self.date,
-            "subtotal": self.subtotal,
-            "tax": self.tax,
-            "total": self.total,
-            "tax_rate": self.taxRate,
-        })
-        print(receiptResponse.content.decode("utf-8")[1:-1])
-        if not receiptResponse.ok:
-            print("Item Posting Aborted")
-            return
-        items = []
-        item_src_path = "./{}_files/".format(self.date)
+    def resolve_taxes(self, taxIndex=None, unknownPolicy="ask"):
+        """
+        Fills in whether every item is taxed, first from the tax index and then according to unknownPolicy.
+        Returns the items whose taxes were actually known, as opposed to assumed by the policy.
+        """
+        unknown = []
+        for item in self.items.values():
+            if item.taxed is None and taxIndex is not None:
+                item.taxed = taxIndex.lookup(item)
+            if item.taxed is None:
+                unknown.append(item)
+        if unknown and unknownPolicy == "fail":
+            raise UnknownTaxes("Unknown taxes for {}".format(", ".join(item.name for item in unknown)))
+        for item in unknown:
+            if unknownPolicy == "taxed":
+                item.taxed = True
+            elif unknownPolicy == "untaxed":
+                item.taxed = False
+            else:
+                item.taxed = ask_taxed(item)
+        if unknownPolicy in ("taxed", "untaxed"):
+            return [item for item in self.items.values() if item not in unknown]
+        return list(self.items.values())
+
+    def fetch_uploaded(self):
+        """
+        Returns this receipt as it was already uploaded, with its items, or None if it hasn't been uploaded yet.
+        """
+        response = session.get("http://localhost:8000/cost_claimer/receipt/{}/".format(self.date))
+        response.raise_for_status()
+        uploaded = response.json()
+        return uploaded if isinstance(uploaded, dict) else None
+
+    def conflicts(self, uploaded):
+        # The totals that differ from the uploaded receipt's, the server won't add items to it if any do.
+        totals = {"subtotal": self.subtotal, "tax": self.tax, "total": self.total, "tax_rate": self.taxRate}
+        return [field for field, value in totals.items() if Decimal(str(value)) != Decimal(uploaded[field])]
+
+    def post(self, taxIndex=None, unknownPolicy="ask"):
+        uploaded = self.fetch_uploaded()
+        if uploaded is not None:
+            conflicts = self.conflicts(uploaded)
+            if conflicts:
+                print("Receipt {} Already Exists With a Different {}".format(self.date, ", ".join(conflicts)))
+                return False
+            # Items that are already uploaded won't be added again, so there's no need to ask about their taxes.
+            for uploadedItem in uploaded["items"]:
+                item = self.items.get(uploadedItem["name"])
+                if item is not None and item.taxed is None:
+                    item.taxed = uploadedItem["taxed"]
+        # Raises UnknownTaxes before any images are copied, so a receipt that can't be uploaded leaves nothing behind.
+        knownItems = self.resolve_taxes(taxIndex, unknownPolicy)
+        items = [{
+            "name": item.name,
+            "count": item.count,
+            "price": item.price,
+            "taxed": item.taxed,
+            **({"imgSrc": item.imgSrc} if item.imgSrc else {}),
+        } for item in self.items.values()]
+        item_src_path = "{}/{}_files/".format(self.sourceDir, self.date)
         cwd = os.getcwd().replace("\\", "/")
         item_dst_path = "{}/{}/{}".format(cwd[:cwd.rfind("/")], RELATIVE_IMAGE_EXPORT_PATH, self.date)
         os.makedirs(item_dst_path, exist_ok=True)
         item_dst_path += "/"
-        for item in self.items.values():
-            taxed = None
-            print("Is {} for {} taxed? (y/n) ".format(item.name, item.price), )
-            while taxed is None:
-                taxed = input()
-                if taxed == "y":
-                    taxed = True
-                elif taxed == "n":
-                    taxed = False
-                else:
-                    print("Expected y or n")
-                    taxed = None
-            items.append({
-                "name": item.name,
-                "count": item.count,
-                "price": item.price,
-                "imgSrc": item.imgSrc,
-                "taxed": taxed,
+        with ThreadPoolExecutor(IMAGE_COPY_WORKERS) as copyPool:
+            # Images are copied in the background while the items are uploaded.
+            copies = {
+                copyPool.submit(copy_image, item_src_path+item.imgSrc, item_dst_path+item.imgSrc): item.imgSrc
+                for item in self.items.values() if item.imgSrc
+            }
+            uploadResponse = session.post("http://localhost:8000/cost_claimer/upload/receipt_items/", json={
+                "payer": self.payer,
+                "date": self.date,
+                "subtotal": self.subtotal,
+                "tax": self.tax,
+                "total": self.total,
+                "tax_rate": self.taxRate,
+                "items": items,
             })
-            copyfile(item_src_path+item.imgSrc, item_dst_path+item.imgSrc)
-        itemResponse = requests.post("http://localhost:8000/cost_claimer/upload/items/", data={
-            "date": self.date,
-            "items": json.dumps(items),
-        })
-        print(itemResponse.content.decode("utf-8")[1:-1])
+            print(response_message(uploadResponse))
+            copied, skipped, missing = 0, 0, []
+            for copy in as_completed(copies):
+                try:
+                    if copy.result():
+                        copied += 1
+                    else:
+                        skipped += 1
+                except OSError:
+                    missing.append(copies[copy])
+        print("Copied {} images, {} were already up to date".format(copied, skipped))
+        if missing:
+            print("Could not copy images: {}".format(", ".join(sorted(missing))))
+        if not uploadResponse.ok:
+            return False
+        if taxIndex is not None:
+            for item in knownItems:
+                taxIndex.record(item)
+            taxIndex.save()
         print("Upload complete, images were put into {}".format(item_dst_path))
+        return not missing
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def parse_receipt(receiptDate, payer):
+def copy_image(src, dst):
+    """
+    Copies an item image unless the destination already has the same file.
+    Returns whether anything was copied.
+    """
+    if os.path.isfile(dst) and os.path.getsize(src) == os.path.getsize(dst) and file_digest(src) == file_digest(dst):
+        return False
+    copyfile(src, dst)
+    return True
+
+
+def response_message(response):
+    try:
+        body = response.json()
+    except ValueError:
+        return response.text
+    return body["message"] if isinstance(body, dict) else body
+
+
+def build_receipt(receiptHtml, receiptDate, payer):
     receipt = Receipt(payer, receiptDate)
-    with open(receiptDate + ".html", "r") as receiptFile:
-        receiptDoc = BeautifulSoup(receiptFile.read(), 'html.parser')
-        for item in receiptDoc.find("ul", "results-list").div.contents:
-            itemDetails = item.div.div
-            srcSlash = itemDetails.img["src"].rfind("/")
-            receipt.add_item(
-                name=itemDetails.img["alt"],
-                price=itemDetails.div.div.span.string[1:],
-                imgSrc=itemDetails.img["src"][srcSlash+1:] if srcSlash >= 0 else itemDetails.img["src"]
+    receiptDoc = BeautifulSoup(receiptHtml, HTML_PARSER)
+    for item in receiptDoc.find("ul", "results-list").div.contents:
+        itemDetails = item.div.div
+        srcSlash = itemDetails.img["src"].rfind("/")
+        receipt.add_item(
+            name=itemDetails.img["alt"],
+            price=itemDetails.div.div.span.string[1:],
+            imgSrc=itemDetails.img["src"][srcSlash+1:] if srcSlash >= 0 else itemDetails.img["src"]
+        )
+    totals = receiptDoc.find("div", "receipt-summary-v2").div.div.table
+    receipt.subtotal = totals.tbody.tr.td.nextSibling.string[1:]
+    receipt.tax = totals.tbody.tr.nextSibling.td.nextSibling.string[1:]
+    receipt.total = totals.nextSibling.tr.td.nextSibling.h2.string[1:]
+    return receipt
+
+
+def read_receipt(receiptPath, payer):
+    receiptDate = os.path.splitext(os.path.basename(receiptPath))[0]
+    with open(receiptPath, "r") as receiptFile:
+        receipt = build_receipt(receiptFile.read(), receiptDate, payer)
+    receipt.sourceDir = os.path.dirname(receiptPath) or "."
+    return receipt
+
+
+def parse_receipt(receiptDate, payer, taxIndex=None, unknownPolicy="ask"):
+    return read_receipt(receiptDate + ".html", payer).post(taxIndex, unknownPolicy)
+
+
+def find_receipts(patterns):
+    receiptPaths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            # Saved pages sit next to other html files (like the ones in <date>_files/), so only take dated ones.
+            receiptPaths.extend(
+                path for path in sorted(glob.glob(os.path.join(pattern, "*.html")))
+                if RECEIPT_NAME_PATTERN.match(os.path.splitext(os.path.basename(path))[0])
             )
-        totals = receiptDoc.find("div", "receipt-summary-v2").div.div.table
-        receipt.subtotal = totals.tbody.tr.td.nextSibling.string[1:]
-        receipt.tax = totals.tbody.tr.nextSibling.td.nextSibling.string[1:]
-        receipt.total = totals.nextSibling.tr.td.nextSibling.h2.string[1:]
-    receipt.post()
+        elif RECEIPT_NAME_PATTERN.match(pattern):
+            receiptPaths.append(pattern + ".html")
+        else:
+            receiptPaths.extend(sorted(glob.glob(pattern)))
+    return receiptPaths
 
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Error: No receipt date given.")
-        exit(1)
-    receiptDate = sys.argv[1]
-    user_list = json.loads(requests.get("http://localhost:8000/cost_claimer/users/").content.decode("utf-8"))
+def parse_receipts(receiptPaths, payer, workers=None, taxIndex=None, unknownPolicy="ask"):
+    """
+    Parses receipt pages across a process pool and uploads each one as soon as it is parsed.
+    Uploading stays in this process since it asks about taxes.
+    Returns a list of (path, stage, error) for every receipt that didn't make it.
+    """
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(read_receipt, receiptPath, payer): receiptPath for receiptPath in receiptPaths}
+        for future in as_completed(pending):
+            receiptPath = pending[future]
+            try:
+                receipt = future.result()
+            except Exception as error:
+                failures.append((receiptPath, "parse", repr(error)))
+                continue
+            print("Uploading {} ({} items)".format(receipt.date, receipt.itemCount))
+            try:
+                if not receipt.post(taxIndex, unknownPolicy):
+                    failures.append((receiptPath, "upload", "Rejected by the server or missing images"))
+            except Exception as error:
+                failures.append((receiptPath, "upload", repr(error)))
+    return failures
+
+
+def print_failure_report(failures, receiptCount):
+    print("{} of {} receipts uploaded".format(receiptCount - len(failures), receiptCount))
+    for receiptPath, stage, error in sorted(failures):
+        print("  {} failed to {}: {}".format(receiptPath, stage, error))
+
+
+def ask_payer():
+    user_list = json.loads(session.get("http://localhost:8000/cost_claimer/users/").content.decode("utf-8"))
     user_list.sort(key=lambda user: user["user_id"])
     ids = set()
     print("Who paid?")
@@ -138,4 +365,53 @@ if __name__ == "__main__":
     while payer_id not in ids:
         print("Unknown id")
         payer_id = int(input("Enter id: "))
-    parse_receipt(receiptDate, payer_id)
+    return payer_id
+
+
+def load_tax_index(reseed=False):
+    taxIndex = TaxabilityIndex()
+    if reseed or len(taxIndex) == 0:
+        try:
+            taxIndex.seed()
+            print("Loaded taxes for {} items from the server".format(len(taxIndex)))
+        except (requests.RequestException, ValueError, KeyError) as error:
+            print("Could not load taxes from the server: {}".format(error))
+    return taxIndex
+
+
+def add_tax_arguments(parser):
+    parser.add_argument("--unknown-taxes", choices=UNKNOWN_TAX_POLICIES, default="ask",
+                        help="What to do with items that haven't been seen before: ask, assume taxed or untaxed, "
+                             "or fail the receipt so it can be uploaded later (defaults to ask)")
+    parser.add_argument("--reseed-taxes", action="store_true",
+                        help="Reload which items are taxed from the server before uploading")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uploads saved Walmart receipt pages.")
+    parser.add_argument("receipts", nargs="+",
+                        help="A receipt date (YYYY-MM-DD), or directories/globs of saved receipt pages to batch upload")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes used to parse a batch (defaults to the number of cores)")
+    add_tax_arguments(parser)
+    args = parser.parse_args()
+    taxIndex = load_tax_index(args.reseed_taxes)
+
+    batch = len(args.receipts) > 1 or any(
+        os.path.isdir(receipt) or receipt.endswith(".html") or glob.has_magic(receipt) for receipt in args.receipts
+    )
+    if batch:
+        receiptPaths = find_receipts(args.receipts)
+        if not receiptPaths:
+            print("Error: No receipt pages found.")
+            exit(1)
+        print("Found {} receipts".format(len(receiptPaths)))
+        failures = parse_receipts(receiptPaths, ask_payer(), args.workers, taxIndex, args.unknown_taxes)
+        print_failure_report(failures, len(receiptPaths))
+        exit(1 if failures else 0)
+    else:
+        try:
+            parse_receipt(args.receipts[0], ask_payer(), taxIndex, args.unknown_taxes)
+        except UnknownTaxes as error:
+            print("Error: {}".format(error))
+            exit(1)
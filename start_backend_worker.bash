@@ -2,4 +2,4 @@
 
 source venv/scripts/activate
 cd backend
-python manage.py runworker user_action
+python manage.py run_workers